@@ -0,0 +1,304 @@
+"""
+Batched, masked depth metrics on CPU or GPU.
+
+Every metric takes ground truth and prediction tensors of shape [B, ...] and a
+boolean mask of the valid pixels, and reduces either over each item of the batch
+(reduction="frame", returns [B]) or over all valid pixels of the batch
+(reduction="video", returns a scalar). Videos that do not fit in memory are
+evaluated in chunks of frames with MetricAccumulator and streaming_median.
+
+Shared by unidepth.utils.evaluation_depth and the MegaSaM video depth evaluation.
+"""
+
+import math
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+import torch
+
+# prediction range of the log metrics when clamping is asked for (log_clamp),
+# so that shifted predictions stay finite; off by default
+LOG_CLAMP = (1e-3, 1e6)
+D_AUC_EXPONENTS = (0.01, 5.0, 100)
+
+
+def _flat(x: torch.Tensor) -> torch.Tensor:
+    return x.reshape(x.shape[0], -1)
+
+
+def masked_sum(x: torch.Tensor, mask: torch.Tensor, reduction: str = "frame"):
+    x = torch.where(mask, x, torch.zeros_like(x))
+    if reduction == "video":
+        return x.sum()
+    return _flat(x).sum(dim=-1)
+
+
+def masked_count(mask: torch.Tensor, reduction: str = "frame"):
+    if reduction == "video":
+        return mask.sum()
+    return _flat(mask).sum(dim=-1)
+
+
+def masked_mean(x: torch.Tensor, mask: torch.Tensor, reduction: str = "frame"):
+    return masked_sum(x, mask, reduction) / masked_count(mask, reduction)
+
+
+def masked_std(x: torch.Tensor, mask: torch.Tensor, reduction: str = "frame"):
+    """Unbiased standard deviation of the valid values, as torch.std."""
+    mean = masked_mean(x, mask, reduction)
+    if reduction == "frame":
+        mean = mean.reshape((-1,) + (1,) * (x.ndim - 1))
+    var = masked_sum((x - mean) ** 2, mask, reduction)
+    return torch.sqrt(var / (masked_count(mask, reduction) - 1))
+
+
+def _sorted_valid(x: torch.Tensor, mask: torch.Tensor, reduction: str):
+    """[B', N] values sorted ascending, invalid ones last as +inf, and counts."""
+    if reduction == "video":
+        x = x[mask].reshape(1, -1)
+        return x.sort(dim=-1).values, torch.tensor([x.shape[-1]], device=x.device)
+    x = torch.where(mask, x, torch.full_like(x, float("inf")))
+    return _flat(x).sort(dim=-1).values, masked_count(mask)
+
+
+def masked_median(
+    x: torch.Tensor, mask: torch.Tensor, reduction: str = "frame", lower: bool = False
+):
+    """Median of the valid values, NaN where there are none.
+
+    As np.median, or as torch.median (the lower of the two middle values for an
+    even count) if lower.
+    """
+    values, counts = _sorted_valid(x, mask, reduction)
+    last = max(values.shape[-1] - 1, 0)
+    lo = ((counts - 1) // 2).clamp(0, last)
+    hi = lo if lower else (counts // 2).clamp(0, last)
+    if values.shape[-1] == 0:
+        median = torch.full(counts.shape, float("nan"), device=x.device)
+    else:
+        median = (
+            values.gather(-1, lo[:, None]) + values.gather(-1, hi[:, None])
+        ).squeeze(-1) / 2
+        median = torch.where(counts > 0, median, torch.full_like(median, float("nan")))
+    return median[0] if reduction == "video" else median
+
+
+def _float_keys(x: torch.Tensor) -> torch.Tensor:
+    """Order-preserving int32 keys of the float32 bits."""
+    bits = x.float().contiguous().view(torch.int32)
+    return torch.where(bits < 0, bits ^ 0x7FFFFFFF, bits)
+
+
+def _float_from_keys(keys: torch.Tensor) -> torch.Tensor:
+    bits = torch.where(keys < 0, keys ^ 0x7FFFFFFF, keys)
+    return bits.view(torch.float32)
+
+
+def streaming_median(
+    chunks: Callable[[], Iterable[torch.Tensor]], lower: bool = False
+) -> torch.Tensor:
+    """Exact median of a stream of 1-D tensors in two passes.
+
+    Radix select on the float32 bits: the first pass histograms the upper 16
+    bits of the keys, the second the lower 16 bits of those in the bin of the
+    middle ranks. Nothing but the chunks and two histograms is held in memory.
+
+    Args:
+        chunks: callable returning a fresh iterable of 1-D tensors, called twice.
+        lower: torch.median semantics instead of np.median.
+
+    Returns:
+        float32 scalar tensor, NaN if the stream is empty.
+    """
+    num_bins = 1 << 16
+    counts = None
+    for x in chunks():
+        high = (_float_keys(x) >> 16) + (num_bins // 2)
+        hist = torch.bincount(high.reshape(-1).long(), minlength=num_bins)
+        counts = hist if counts is None else counts + hist
+    total = 0 if counts is None else int(counts.sum())
+    if total == 0:
+        return torch.tensor(float("nan"))
+    ranks = [(total - 1) // 2] if lower else sorted({(total - 1) // 2, total // 2})
+    cum = counts.cumsum(0)
+    bins = torch.searchsorted(cum, torch.tensor(ranks, device=cum.device), right=True)
+    bins = bins.tolist()
+    below = [int(cum[b] - counts[b]) for b in bins]
+
+    low_counts = [torch.zeros_like(counts) for _ in ranks]
+    for x in chunks():
+        keys = _float_keys(x).reshape(-1)
+        high = (keys >> 16) + (num_bins // 2)
+        for hist, b in zip(low_counts, bins):
+            low = keys[high == b] & (num_bins - 1)
+            hist += torch.bincount(low.long(), minlength=num_bins)
+
+    values = []
+    for rank, b, offset, hist in zip(ranks, bins, below, low_counts):
+        rank = torch.tensor([rank - offset], device=hist.device)
+        low = int(torch.searchsorted(hist.cumsum(0), rank, right=True)[0])
+        key = ((b - num_bins // 2) << 16) | low
+        values.append(_float_from_keys(torch.tensor(key, dtype=torch.int32)))
+    return torch.stack(values).mean()
+
+
+def median_scale_align(gt, pred, mask, reduction: str = "frame", lower: bool = False):
+    """pred scaled by median(gt) / median(pred)."""
+    scale = masked_median(gt, mask, reduction, lower) / masked_median(
+        pred, mask, reduction, lower
+    )
+    if reduction == "frame":
+        scale = scale.reshape((-1,) + (1,) * (pred.ndim - 1))
+    return pred * scale
+
+
+def lstsq_scale_shift_align(gt, pred, mask, stability: float = 1e-9):
+    """pred with the per-frame least-squares scale and shift onto gt."""
+    n = masked_count(mask).to(pred.dtype)
+    sum_p = masked_sum(pred, mask)
+    sum_pp = masked_sum(pred * pred, mask)
+    A = torch.stack(
+        [torch.stack([sum_pp, sum_p], -1), torch.stack([sum_p, n], -1)], -2
+    ) + stability * torch.eye(2, device=pred.device, dtype=pred.dtype)
+    b = torch.stack([masked_sum(pred * gt, mask), masked_sum(gt, mask)], -1)
+    scale, shift = torch.linalg.solve(A, b[..., None])[..., 0].unbind(-1)
+    shape = (-1,) + (1,) * (pred.ndim - 1)
+    return pred * scale.reshape(shape) + shift.reshape(shape)
+
+
+def median_scale_shift(
+    gt: torch.Tensor, pred: torch.Tensor, mask: torch.Tensor, eps: float = 1e-6
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Robust video scale and shift of pred onto gt from medians.
+
+    scale = median((gt - median(gt) + eps) / (pred - median(pred) + eps)) and
+    shift = median(gt - scale * pred), over all valid pixels.
+    """
+
+    def valid():
+        yield gt[mask], pred[mask]
+
+    return streaming_median_scale_shift(valid, eps)
+
+
+def streaming_median_scale_shift(
+    chunks: Callable[[], Iterable[Tuple[torch.Tensor, torch.Tensor]]],
+    eps: float = 1e-6,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """median_scale_shift over a stream of valid (gt, pred) 1-D tensors."""
+    gt_median = streaming_median(lambda: (g for g, _ in chunks()))
+    pred_median = streaming_median(lambda: (p for _, p in chunks()))
+    scale = streaming_median(
+        lambda: ((g - gt_median + eps) / (p - pred_median + eps) for g, p in chunks())
+    )
+    shift = streaming_median(lambda: (g - scale * p for g, p in chunks()))
+    return scale, shift
+
+
+def _ratio(gt, pred):
+    return torch.maximum(gt / pred, pred / gt)
+
+
+def _log_diff(gt, pred, log_clamp=None):
+    """log(pred) - log(gt), with pred clamped to the (min, max) log_clamp."""
+    if log_clamp is not None:
+        pred = pred.clamp(*log_clamp)
+    return torch.log(pred) - torch.log(gt)
+
+
+def _log10_error(gt, pred, log_clamp):
+    return torch.abs(_log_diff(gt, pred, log_clamp)) / math.log(10.0)
+
+
+# per-pixel errors whose masked mean (square root for the rms ones) is the metric
+PIXEL_ERRORS = {
+    "d1": lambda gt, pred, log_clamp: (_ratio(gt, pred) < 1.25).float(),
+    "d2": lambda gt, pred, log_clamp: (_ratio(gt, pred) < 1.25**2).float(),
+    "d3": lambda gt, pred, log_clamp: (_ratio(gt, pred) < 1.25**3).float(),
+    "rmse": lambda gt, pred, log_clamp: (gt - pred) ** 2,
+    "rmselog": lambda gt, pred, log_clamp: _log_diff(gt, pred, log_clamp) ** 2,
+    "arel": lambda gt, pred, log_clamp: torch.abs(gt - pred) / gt,
+    "sqrel": lambda gt, pred, log_clamp: (gt - pred) ** 2 / gt,
+    "log10": lambda gt, pred, log_clamp: _log10_error(gt, pred, log_clamp),
+    "tau": lambda gt, pred, log_clamp: (_ratio(gt, pred) < 1.03).float(),
+}
+ROOT_METRICS = ("rmse", "rmselog")
+
+
+def _mean_metric(name):
+    def metric(gt, pred, mask, reduction="frame", log_clamp=None):
+        value = masked_mean(PIXEL_ERRORS[name](gt, pred, log_clamp), mask, reduction)
+        return torch.sqrt(value) if name in ROOT_METRICS else value
+
+    return metric
+
+
+def silog(gt, pred, mask, reduction="frame", log_clamp=None):
+    return 100 * masked_std(_log_diff(gt, pred, log_clamp), mask, reduction)
+
+
+def medianlog(gt, pred, mask, reduction="frame", log_clamp=None):
+    log_diff = _log_diff(gt, pred, log_clamp)
+    return 100 * masked_median(log_diff, mask, reduction, lower=True).abs()
+
+
+def d_auc(gt, pred, mask, reduction="frame", log_clamp=None):
+    """Area under the delta(exponent) curve for exponents in (0.01, 5)."""
+    values, counts = _sorted_valid(_ratio(gt, pred), mask, reduction)
+    exponents = torch.linspace(*D_AUC_EXPONENTS, device=gt.device)
+    thresholds = (1.25**exponents).expand(values.shape[0], -1).contiguous()
+    inliers = torch.searchsorted(values, thresholds) / counts[:, None]
+    auc = torch.trapz(inliers, exponents, dim=-1) / D_AUC_EXPONENTS[1]
+    return auc[0] if reduction == "video" else auc
+
+
+METRICS = {name: _mean_metric(name) for name in PIXEL_ERRORS}
+METRICS.update({"silog": silog, "medianlog": medianlog, "d_auc": d_auc})
+
+
+def compute_metrics(
+    gt: torch.Tensor,
+    pred: torch.Tensor,
+    mask: torch.Tensor,
+    names: Optional[Sequence[str]] = None,
+    reduction: str = "frame",
+    log_clamp: Optional[Tuple[float, float]] = None,
+) -> Dict[str, torch.Tensor]:
+    """Metrics of METRICS, [B] tensors per frame or scalars per video.
+
+    The log metrics clamp the prediction to log_clamp, e.g. LOG_CLAMP, if given.
+    """
+    names = METRICS.keys() if names is None else names
+    return {
+        name: METRICS[name](gt, pred, mask, reduction, log_clamp) for name in names
+    }
+
+
+class MetricAccumulator:
+    """Video metrics accumulated over chunks of frames.
+
+    Only the metrics of PIXEL_ERRORS, which are means over the valid pixels, can
+    be accumulated. Sums are kept in float64.
+    """
+
+    def __init__(
+        self,
+        names: Sequence[str] = ("arel", "rmselog", "d1", "d2", "d3"),
+        log_clamp: Optional[Tuple[float, float]] = None,
+    ):
+        self.names = list(names)
+        self.log_clamp = log_clamp
+        self.sums = {name: 0.0 for name in self.names}
+        self.count = 0
+
+    def update(self, gt: torch.Tensor, pred: torch.Tensor, mask: torch.Tensor):
+        for name in self.names:
+            error = PIXEL_ERRORS[name](gt, pred, self.log_clamp).double()
+            self.sums[name] += masked_sum(error, mask, "video")
+        self.count += int(mask.sum())
+
+    def compute(self) -> Dict[str, float]:
+        result = {}
+        for name in self.names:
+            value = float(self.sums[name]) / self.count
+            result[name] = value**0.5 if name in ROOT_METRICS else value
+        return result
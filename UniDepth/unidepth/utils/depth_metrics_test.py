@@ -0,0 +1,68 @@
+"""
+streaming_median against torch.median, torch.quantile and np.median.
+
+    cd UniDepth && python -m pytest unidepth/utils/depth_metrics_test.py
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from unidepth.utils import depth_metrics  # noqa: E402
+
+RTOL = 1e-6
+
+
+def _values(num_values, seed=0):
+    """float32 values of both signs, with ties and signed zeros."""
+    rng = np.random.default_rng(seed)
+    values = rng.normal(scale=10.0, size=num_values).astype(np.float32)
+    values[::7] = np.round(values[::7])
+    values[::11] = 0.0
+    values[::13] = -0.0
+    return torch.from_numpy(values)
+
+
+def _chunks(values, chunk_size):
+    """Callable returning a fresh stream of chunks, with an empty one inside."""
+    return lambda: iter(
+        [values[:0]] + list(torch.split(values, chunk_size)) + [values[:0]]
+    )
+
+
+@pytest.mark.parametrize("num_values", [1, 2, 999, 1000])
+@pytest.mark.parametrize("chunk_size", [1, 64, 4096])
+def test_matches_np_median(num_values, chunk_size):
+    values = _values(num_values)
+    median = depth_metrics.streaming_median(_chunks(values, chunk_size))
+    assert median.dtype == torch.float32
+    np.testing.assert_allclose(
+        median.item(), np.median(values.double().numpy()), rtol=RTOL
+    )
+    np.testing.assert_allclose(
+        median.item(), torch.quantile(values, 0.5).item(), rtol=RTOL
+    )
+
+
+@pytest.mark.parametrize("num_values", [1, 2, 999, 1000])
+@pytest.mark.parametrize("chunk_size", [1, 64, 4096])
+def test_lower_matches_torch_median(num_values, chunk_size):
+    values = _values(num_values, seed=1)
+    median = depth_metrics.streaming_median(_chunks(values, chunk_size), lower=True)
+    # the lower middle value is returned exactly
+    assert median.item() == torch.median(values).item()
+
+
+def test_all_negative():
+    values = -torch.arange(1, 11, dtype=torch.float32)
+    median = depth_metrics.streaming_median(_chunks(values, 3))
+    lower = depth_metrics.streaming_median(_chunks(values, 3), lower=True)
+    assert median.item() == -5.5
+    assert lower.item() == -6.0
+
+
+def test_empty_stream_is_nan():
+    values = torch.zeros(0)
+    assert torch.isnan(depth_metrics.streaming_median(_chunks(values, 4)))
+    assert torch.isnan(depth_metrics.streaming_median(lambda: iter([])))
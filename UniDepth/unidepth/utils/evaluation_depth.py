@@ -4,6 +4,7 @@ from functools import partial
 import torch
 import torch.nn.functional as F
 
+from unidepth.utils import depth_metrics
 from unidepth.utils.chamfer_distance import ChamferDistance
 
 chamfer_cls = ChamferDistance()
@@ -132,19 +133,24 @@ DICT_METRICS_D = {
 def eval_depth(
     gts: torch.Tensor, preds: torch.Tensor, masks: torch.Tensor, max_depth=None
 ):
-    summary_metrics = defaultdict(list)
+    # per-frame metrics of the whole batch at once, see depth_metrics
     preds = F.interpolate(preds, gts.shape[-2:], mode="bilinear")
-    for i, (gt, pred, mask) in enumerate(zip(gts, preds, masks)):
-        if max_depth is not None:
-            mask = mask & (gt <= max_depth)
-        for name, fn in DICT_METRICS.items():
-            if name in ["tau", "d1", "arel"]:
-                for rescale_fn in ["ssi", "si"]:
-                    summary_metrics[f"{name}_{rescale_fn}"].append(
-                        fn(gt[mask], eval(rescale_fn)(gt[mask], pred[mask]))
-                    )
-            summary_metrics[name].append(fn(gt[mask], pred[mask]).mean())
-    return {name: torch.stack(vals, dim=0) for name, vals in summary_metrics.items()}
+    if max_depth is not None:
+        masks = masks & (gts <= max_depth)
+    rescaled = {
+        "ssi": depth_metrics.lstsq_scale_shift_align(gts, preds, masks),
+        "si": depth_metrics.median_scale_align(gts, preds, masks, lower=True),
+    }
+    summary_metrics = {}
+    for name in DICT_METRICS:
+        fn = depth_metrics.METRICS[name]
+        if name in ["tau", "d1", "arel"]:
+            for rescale_fn in ["ssi", "si"]:
+                summary_metrics[f"{name}_{rescale_fn}"] = fn(
+                    gts, rescaled[rescale_fn], masks
+                )
+        summary_metrics[name] = fn(gts, preds, masks)
+    return summary_metrics
 
 
 def eval_3d(
@@ -24,9 +24,12 @@
 # pylint: disable=undefined-loop-variable
 
 import collections
+import collections.abc
+import mmap
 import os
 import struct
 import sys
+import time
 import numpy as np
 
 
@@ -67,6 +70,52 @@ CAMERA_MODEL_IDS = dict(
     [(camera_model.model_id, camera_model) for camera_model in CAMERA_MODELS]
 )
 
+# Fixed-size parts of the binary records, packed as COLMAP writes them.
+IMAGE_DTYPE = np.dtype([
+    ("id", "<i4"),
+    ("qvec", "<f8", (4,)),
+    ("tvec", "<f8", (3,)),
+    ("camera_id", "<i4"),
+])
+POINT2D_DTYPE = np.dtype([("xy", "<f8", (2,)), ("point3D_id", "<i8")])
+POINT3D_DTYPE = np.dtype([
+    ("id", "<u8"),
+    ("xyz", "<f8", (3,)),
+    ("rgb", "u1", (3,)),
+    ("error", "<f8"),
+    ("track_length", "<u8"),
+])
+TRACK_ELEM_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+# Columnar models. The variable-length parts of record k are
+# xys[point2D_offsets[k]:point2D_offsets[k + 1]] and
+# track_*[track_offsets[k]:track_offsets[k + 1]].
+ImageArrays = collections.namedtuple(
+    "ImageArrays",
+    [
+        "ids",
+        "qvecs",
+        "tvecs",
+        "camera_ids",
+        "names",
+        "point2D_offsets",
+        "xys",
+        "point3D_ids",
+    ],
+)
+Point3DArrays = collections.namedtuple(
+    "Point3DArrays",
+    [
+        "ids",
+        "xyz",
+        "rgb",
+        "error",
+        "track_offsets",
+        "track_image_ids",
+        "track_point2D_idxs",
+    ],
+)
+
 
 def read_next_bytes(fid, num_bytes, format_char_sequence, endian_character="<"):
   """Read and unpack the next bytes from a binary file.
@@ -80,6 +129,63 @@ def read_next_bytes(fid, num_bytes, format_char_sequence, endian_character="<"):
   return struct.unpack(endian_character + format_char_sequence, data)
 
 
+class RecordView(collections.abc.Mapping):
+  """Read-only id -> namedtuple mapping over a columnar model.
+
+  Records are built on access, so that code written against the dicts of
+  namedtuples keeps working without materializing every record.
+  """
+
+  def __init__(self, ids, make_record):
+    self.ids = ids
+    self.make_record = make_record
+    self.order = np.argsort(ids, kind="stable")
+    self.sorted_ids = ids[self.order]
+
+  def __getitem__(self, key):
+    pos = np.searchsorted(self.sorted_ids, key)
+    if pos == len(self.sorted_ids) or self.sorted_ids[pos] != key:
+      raise KeyError(key)
+    return self.make_record(self.order[pos])
+
+  def __iter__(self):
+    return iter(self.ids.tolist())
+
+  def __len__(self):
+    return len(self.ids)
+
+
+def map_model_file(path):
+  """Read-only memory map of a binary model file and its uint8 array view."""
+  with open(path, "rb") as fid:
+    buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+  return buf, np.frombuffer(buf, dtype=np.uint8)
+
+
+def gather_records(data, offsets, dtype):
+  """[N] records of dtype copied from the byte offsets of a uint8 array.
+
+  Row i of the strided view holds the itemsize bytes starting at i, so one
+  fancy index copies all records without a file-sized temporary.
+  """
+  dtype = np.dtype(dtype)
+  windows = np.lib.stride_tricks.as_strided(
+      data,
+      shape=(max(len(data) - dtype.itemsize + 1, 0), dtype.itemsize),
+      strides=(1, 1),
+      writeable=False,
+  )
+  return windows[offsets].view(dtype).reshape(-1)
+
+
+def element_offsets(starts, counts, itemsize):
+  """Byte offsets of counts[k] consecutive itemsize elements from starts[k]."""
+  first = np.cumsum(counts) - counts
+  return np.repeat(starts - itemsize * first, counts) + itemsize * np.arange(
+      np.sum(counts), dtype=np.int64
+  )
+
+
 def read_cameras_text(path):
   """see: src/base/reconstruction.cc
 
@@ -176,50 +282,75 @@ def read_images_text(path):
   return images
 
 
+def read_images_arrays(path_to_model_file):
+  """Reads images.bin into an ImageArrays.
+
+  Only the record offsets, the names and the numbers of 2D points are read
+  in the loop over the memory-mapped file; the fixed-size fields and the 2D
+  points of all images are then decoded at once by gather_records.
+  """
+  buf, data = map_model_file(path_to_model_file)
+  num_reg_images = struct.unpack_from("<Q", buf, 0)[0]
+  unpack_count = struct.Struct("<Q").unpack_from
+  starts, names, point_starts, counts = [], [], [], []
+  offset = 8
+  for _ in range(num_reg_images):
+    starts.append(offset)
+    name_start = offset + IMAGE_DTYPE.itemsize
+    name_end = buf.find(b"\0", name_start)  # look for the ASCII 0 entry
+    names.append(buf[name_start:name_end].decode("utf-8"))
+    num_points2D = unpack_count(buf, name_end + 1)[0]
+    point_starts.append(name_end + 9)
+    counts.append(num_points2D)
+    offset = name_end + 9 + POINT2D_DTYPE.itemsize * num_points2D
+  starts = np.array(starts, dtype=np.int64)
+  point_starts = np.array(point_starts, dtype=np.int64)
+  counts = np.array(counts, dtype=np.int64)
+
+  headers = gather_records(data, starts, IMAGE_DTYPE)
+  points = gather_records(
+      data,
+      element_offsets(point_starts, counts, POINT2D_DTYPE.itemsize),
+      POINT2D_DTYPE,
+  )
+  return ImageArrays(
+      ids=np.int64(headers["id"]),
+      qvecs=np.ascontiguousarray(headers["qvec"]),
+      tvecs=np.ascontiguousarray(headers["tvec"]),
+      camera_ids=np.int64(headers["camera_id"]),
+      names=names,
+      point2D_offsets=np.concatenate([[0], np.cumsum(counts)]),
+      xys=np.ascontiguousarray(points["xy"]),
+      point3D_ids=np.ascontiguousarray(points["point3D_id"]),
+  )
+
+
+def images_view(arrays):
+  """id -> Image mapping over an ImageArrays."""
+  offsets = arrays.point2D_offsets
+
+  def make_record(k):
+    points = slice(offsets[k], offsets[k + 1])
+    return Image(
+        id=int(arrays.ids[k]),
+        qvec=arrays.qvecs[k],
+        tvec=arrays.tvecs[k],
+        camera_id=int(arrays.camera_ids[k]),
+        name=arrays.names[k],
+        xys=arrays.xys[points],
+        point3D_ids=arrays.point3D_ids[points],
+    )
+
+  return RecordView(arrays.ids, make_record)
+
+
 def read_images_binary(path_to_model_file):
   """see: src/base/reconstruction.cc
 
   void Reconstruction::ReadImagesBinary(const std::string& path)
   void Reconstruction::WriteImagesBinary(const std::string& path)
   """
-  images = {}
-  with open(path_to_model_file, "rb") as fid:
-    num_reg_images = read_next_bytes(fid, 8, "Q")[0]
-    for image_index in range(num_reg_images):
-      binary_image_properties = read_next_bytes(
-          fid, num_bytes=64, format_char_sequence="idddddddi"
-      )
-      image_id = binary_image_properties[0]
-      qvec = np.array(binary_image_properties[1:5])
-      tvec = np.array(binary_image_properties[5:8])
-      camera_id = binary_image_properties[8]
-      image_name = ""
-      current_char = read_next_bytes(fid, 1, "c")[0]
-      while current_char != b"\x00":  # look for the ASCII 0 entry
-        image_name += current_char.decode("utf-8")
-        current_char = read_next_bytes(fid, 1, "c")[0]
-      num_points2D = read_next_bytes(
-          fid, num_bytes=8, format_char_sequence="Q"
-      )[0]
-      x_y_id_s = read_next_bytes(
-          fid,
-          num_bytes=24 * num_points2D,
-          format_char_sequence="ddq" * num_points2D,
-      )
-      xys = np.column_stack(
-          [tuple(map(float, x_y_id_s[0::3])), tuple(map(float, x_y_id_s[1::3]))]
-      )
-      point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
-      images[image_id] = Image(
-          id=image_id,
-          qvec=qvec,
-          tvec=tvec,
-          camera_id=camera_id,
-          name=image_name,
-          xys=xys,
-          point3D_ids=point3D_ids,
-      )
-  return images
+  return images_view(read_images_arrays(path_to_model_file))
 
 
 def read_points3D_text(path):
@@ -254,42 +385,71 @@ def read_points3D_text(path):
   return points3D
 
 
+def read_points3d_arrays(path_to_model_file):
+  """Reads points3D.bin into a Point3DArrays.
+
+  Only the record offsets and track lengths are read in the loop over the
+  memory-mapped file; the fixed-size fields and the tracks of all points are
+  then decoded at once by gather_records.
+  """
+  buf, data = map_model_file(path_to_model_file)
+  num_points = struct.unpack_from("<Q", buf, 0)[0]
+  unpack_length = struct.Struct("<Q").unpack_from
+  length_offset = POINT3D_DTYPE.fields["track_length"][1]
+  starts, lengths = [], []
+  offset = 8
+  for _ in range(num_points):
+    starts.append(offset)
+    track_length = unpack_length(buf, offset + length_offset)[0]
+    lengths.append(track_length)
+    offset += POINT3D_DTYPE.itemsize + TRACK_ELEM_DTYPE.itemsize * track_length
+  starts = np.array(starts, dtype=np.int64)
+  lengths = np.array(lengths, dtype=np.int64)
+
+  headers = gather_records(data, starts, POINT3D_DTYPE)
+  tracks = gather_records(
+      data,
+      element_offsets(
+          starts + POINT3D_DTYPE.itemsize, lengths, TRACK_ELEM_DTYPE.itemsize
+      ),
+      TRACK_ELEM_DTYPE,
+  )
+  return Point3DArrays(
+      ids=np.int64(headers["id"]),
+      xyz=np.ascontiguousarray(headers["xyz"]),
+      rgb=np.ascontiguousarray(headers["rgb"]),
+      error=np.ascontiguousarray(headers["error"]),
+      track_offsets=np.concatenate([[0], np.cumsum(lengths)]),
+      track_image_ids=np.ascontiguousarray(tracks["image_id"]),
+      track_point2D_idxs=np.ascontiguousarray(tracks["point2D_idx"]),
+  )
+
+
+def points3d_view(arrays):
+  """id -> Point3D mapping over a Point3DArrays."""
+  offsets = arrays.track_offsets
+
+  def make_record(k):
+    track = slice(offsets[k], offsets[k + 1])
+    return Point3D(
+        id=int(arrays.ids[k]),
+        xyz=arrays.xyz[k],
+        rgb=arrays.rgb[k],
+        error=arrays.error[k],
+        image_ids=arrays.track_image_ids[track],
+        point2D_idxs=arrays.track_point2D_idxs[track],
+    )
+
+  return RecordView(arrays.ids, make_record)
+
+
 def read_points3d_binary(path_to_model_file):
   """see: src/base/reconstruction.cc
 
   void Reconstruction::ReadPoints3DBinary(const std::string& path)
   void Reconstruction::WritePoints3DBinary(const std::string& path)
   """
-  points3D = {}
-  with open(path_to_model_file, "rb") as fid:
-    num_points = read_next_bytes(fid, 8, "Q")[0]
-    for point_line_index in range(num_points):
-      binary_point_line_properties = read_next_bytes(
-          fid, num_bytes=43, format_char_sequence="QdddBBBd"
-      )
-      point3D_id = binary_point_line_properties[0]
-      xyz = np.array(binary_point_line_properties[1:4])
-      rgb = np.array(binary_point_line_properties[4:7])
-      error = np.array(binary_point_line_properties[7])
-      track_length = read_next_bytes(
-          fid, num_bytes=8, format_char_sequence="Q"
-      )[0]
-      track_elems = read_next_bytes(
-          fid,
-          num_bytes=8 * track_length,
-          format_char_sequence="ii" * track_length,
-      )
-      image_ids = np.array(tuple(map(int, track_elems[0::2])))
-      point2D_idxs = np.array(tuple(map(int, track_elems[1::2])))
-      points3D[point3D_id] = Point3D(
-          id=point3D_id,
-          xyz=xyz,
-          rgb=rgb,
-          error=error,
-          image_ids=image_ids,
-          point2D_idxs=point2D_idxs,
-      )
-  return points3D
+  return points3d_view(read_points3d_arrays(path_to_model_file))
 
 
 def read_model(path, ext):
@@ -347,11 +507,14 @@ def main():
     print("Usage: python read_model.py path/to/model/folder [.txt,.bin]")
     return
 
+  start = time.perf_counter()
   cameras, images, points3D = read_model(path=sys.argv[1], ext=sys.argv[2])
+  load_seconds = time.perf_counter() - start
 
   print("num_cameras:", len(cameras))
   print("num_images:", len(images))
   print("num_points3D:", len(points3D))
+  print("loaded in %.2f s" % load_seconds)
 
 
 if __name__ == "__main__":
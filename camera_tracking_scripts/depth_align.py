@@ -0,0 +1,153 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Batched scale/shift alignment of mono disparity to metric depth.
+
+Computes the `aligns` tuple of the tracking scripts for a whole clip with
+batched tensor ops instead of per-frame cv2.resize and np.median calls.
+Frames are processed in chunks on CPU or GPU. Per-frame medians are exact and
+match np.median, including masked (non-sky) medians. The clip-wide percentile
+of the normalization scale is estimated from a seeded uniform subsample once
+the clip exceeds `max_percentile_samples` pixels.
+"""
+
+# pylint: disable=invalid-name
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def masked_median(x, mask):
+  """Row-wise median of x over mask, as np.median of x[mask] per row.
+
+  Args:
+    x: [B, P] tensor.
+    mask: [B, P] bool tensor.
+
+  Returns:
+    [B] medians, the mean of the two middle values for even counts and NaN
+    for empty rows.
+  """
+  n = mask.sum(dim=1, keepdim=True)
+  x_sorted = torch.sort(x.masked_fill(~mask, float("inf")), dim=1).values
+  lo = torch.gather(x_sorted, 1, torch.clamp((n - 1) // 2, min=0))
+  hi = torch.gather(x_sorted, 1, torch.clamp(n // 2, max=x.shape[1] - 1))
+  median = 0.5 * (lo + hi)
+  return median.masked_fill(n == 0, float("nan")).squeeze(1)
+
+
+def scale_shift(mono_disp, gt_disp, mask):
+  """Per-frame median scale and shift from mono to metric disparity.
+
+  Args:
+    mono_disp: [B, P] mono disparity.
+    gt_disp: [B, P] metric disparity.
+    mask: [B, P] bool mask of the pixels used.
+
+  Returns:
+    ([B] scales, [B] shifts).
+  """
+  gt_disp_ms = gt_disp - masked_median(gt_disp, mask)[:, None] + 1e-8
+  mono_disp_ms = mono_disp - masked_median(mono_disp, mask)[:, None] + 1e-8
+  scale = masked_median(gt_disp_ms / mono_disp_ms, mask)
+  shift = masked_median(gt_disp - scale[:, None] * mono_disp, mask)
+  return scale, shift
+
+
+def align_clip(
+    mono_disps,
+    metric_depths,
+    sky_disp=None,
+    sky_ratio=0.5,
+    device="cpu",
+    chunk_frames=64,
+    percentile=98,
+    max_percentile_samples=2**24,
+    seed=0,
+):
+  """Aligns the Depth-Anything disparity of a clip to UniDepth metric depth.
+
+  Args:
+    mono_disps: [N, h, w] mono disparity, or a list of such frames.
+    metric_depths: [N, H, W] metric depth, or a list of such frames.
+    sky_disp: if set, frames with more than sky_ratio of their mono disparity
+      below sky_disp are aligned on the pixels above it only.
+    sky_ratio: see sky_disp.
+    device: torch device of the batched ops.
+    chunk_frames: frames processed at a time.
+    percentile: percentile of the aligned disparity used for normalization.
+    max_percentile_samples: above this many pixels, the percentile is taken
+      over a uniform subsample of this size.
+    seed: seed of that subsample.
+
+  Returns:
+    aligns: (align_scale, align_shift, normalize_scale), as the tracking
+      scripts computed them.
+    mono_disp: [N, H, W] float32 mono disparity resized to the metric depth
+      resolution (cv2.INTER_NEAREST_EXACT).
+  """
+  num_frames = len(mono_disps)
+  height, width = metric_depths[0].shape
+  mono_disp = np.empty((num_frames, height, width), dtype=np.float32)
+  scales = []
+  shifts = []
+  for k in range(0, num_frames, chunk_frames):
+    disp = torch.from_numpy(
+        np.float32(np.stack(mono_disps[k : k + chunk_frames]))
+    ).to(device)
+    depth = torch.from_numpy(
+        np.float32(np.stack(metric_depths[k : k + chunk_frames]))
+    ).to(device)
+    disp = F.interpolate(
+        disp[:, None], (height, width), mode="nearest-exact"
+    )[:, 0]
+    mono_disp[k : k + chunk_frames] = disp.cpu().numpy()
+
+    disp = disp.flatten(1)
+    depth = depth.flatten(1)
+    gt_disp = 1.0 / (depth + 1e-8)
+    # avoid some bug from UniDepth
+    gt_disp = torch.where(
+        (depth < 2.0) & (disp < 0.02), torch.full_like(gt_disp, 1e-2), gt_disp
+    )
+
+    mask = torch.ones_like(disp, dtype=torch.bool)
+    if sky_disp is not None:
+      # avoid cases sky dominate entire video
+      sky = (disp < sky_disp).float().mean(dim=1, keepdim=True) > sky_ratio
+      mask = ~sky | (disp > sky_disp)
+
+    scale, shift = scale_shift(disp, gt_disp, mask)
+    scales.append(scale.cpu().numpy())
+    shifts.append(shift.cpu().numpy())
+
+  scales = np.concatenate(scales)
+  shifts = np.concatenate(shifts)
+  ss_product = scales * shifts
+  med_idx = np.argmin(np.abs(ss_product - np.median(ss_product)))
+  align_scale = scales[med_idx]
+  align_shift = shifts[med_idx]
+
+  values = mono_disp.reshape(-1)
+  if values.shape[0] > max_percentile_samples:
+    rng = np.random.default_rng(seed)
+    values = values[
+        rng.integers(0, values.shape[0], size=max_percentile_samples)
+    ]
+  normalize_scale = (
+      np.percentile(align_scale * values + align_shift, percentile) / 2.0
+  )
+  return (align_scale, align_shift, normalize_scale), mono_disp
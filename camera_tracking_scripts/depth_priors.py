@@ -0,0 +1,93 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Parallel loading of the per-frame mono disparity and metric depth files.
+
+The Depth-Anything .npy and UniDepth .npz files are loaded by a thread pool
+(file reads, zlib and cv2.resize release the GIL) directly into preallocated
+clip arrays. Optionally the result is kept in a single consolidated
+uncompressed .npz per scene, which later runs read in one sequential pass.
+"""
+
+import concurrent.futures
+import os
+
+import cv2
+import numpy as np
+
+
+def _sources(paths):
+  return np.array(
+      ["%s:%d" % (os.path.abspath(p), os.stat(p).st_mtime_ns) for p in paths]
+  )
+
+
+def load_depth_priors(
+    mono_disp_paths, metric_depth_paths, num_workers=8, cache_path=None
+):
+  """Loads the depth priors of a clip.
+
+  Args:
+    mono_disp_paths: per-frame Depth-Anything disparity .npy files.
+    metric_depth_paths: per-frame UniDepth .npz files with depth and fov.
+    num_workers: loader threads.
+    cache_path: optional consolidated .npz of the priors. Used if it was
+      written from the same files, otherwise (re)written.
+
+  Returns:
+    mono_disp: [N, H, W] float32 mono disparity, resized to the metric depth
+      resolution (cv2.INTER_NEAREST_EXACT).
+    metric_depth: [N, H, W] float32 metric depth.
+    fovs: [N] UniDepth field of view.
+  """
+  sources = _sources(list(mono_disp_paths) + list(metric_depth_paths))
+  if cache_path and os.path.isfile(cache_path):
+    with np.load(cache_path) as data:
+      if np.array_equal(data["sources"], sources):
+        return data["mono_disp"], data["metric_depth"], data["fov"]
+
+  num_frames = min(len(mono_disp_paths), len(metric_depth_paths))
+  with np.load(metric_depth_paths[0]) as uni_data:
+    height, width = uni_data["depth"].shape
+  mono_disp = np.empty((num_frames, height, width), dtype=np.float32)
+  metric_depth = np.empty((num_frames, height, width), dtype=np.float32)
+  fovs = np.empty(num_frames, dtype=np.float64)
+
+  def load(t):
+    with np.load(metric_depth_paths[t]) as uni_data:
+      metric_depth[t] = uni_data["depth"]
+      fovs[t] = np.asarray(uni_data["fov"]).reshape(-1)[0]
+    mono_disp[t] = cv2.resize(
+        np.float32(np.load(mono_disp_paths[t])),
+        (width, height),
+        interpolation=cv2.INTER_NEAREST_EXACT,
+    )
+
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as pool:
+    # list() re-raises the first loading error
+    list(pool.map(load, range(num_frames)))
+
+  if cache_path:
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    tmp_path = cache_path + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        sources=sources,
+        mono_disp=mono_disp,
+        metric_depth=metric_depth,
+        fov=fovs,
+    )
+    os.replace(tmp_path, cache_path)
+  return mono_disp, metric_depth, fovs
@@ -0,0 +1,173 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Memory-mapped store of preprocessed tracking frames.
+
+image_stream() is consumed twice, by the droid.track loop and again inside
+droid.terminate, and re-decodes, resizes and re-aligns every frame on each
+pass. FrameStore records the tuples the first pass yields into .npy files and
+replays them from memory maps afterwards, including on later runs of the same
+scene with the same alignment.
+
+The store lives in `<root>/<scene>_<key>/`, where key hashes the frame list,
+the alignment and the intrinsics. It holds one `item<i>.npy` per tensor
+position of the yielded tuples. `meta.json` is written last and marks the
+store complete; the other stores of the scene are then deleted, so that only
+the latest one is kept on disk.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import torch
+
+
+def store_key(image_list, aligns, K, sources=(), **params):
+  """Hashes everything the preprocessed frames depend on.
+
+  Images and the other source files enter with their (path, size, mtime), so
+  that regenerating e.g. the depth priors in place invalidates the store.
+  """
+  sha1 = hashlib.sha1()
+  for path in list(image_list) + list(sources):
+    stat = os.stat(path)
+    sha1.update(
+        ("%s:%d:%d\n" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        .encode()
+    )
+  sha1.update(np.asarray(aligns, dtype=np.float64).tobytes())
+  sha1.update(np.asarray(K, dtype=np.float64).tobytes())
+  sha1.update(json.dumps(params, sort_keys=True).encode())
+  return sha1.hexdigest()[:16]
+
+
+class FrameStore:
+  """Records a frame stream once and replays it from memory maps."""
+
+  def __init__(
+      self, root, scene_name, image_list, aligns, K, sources=(), **params
+  ):
+    """Opens the store of a scene.
+
+    Args:
+      root: cache directory, e.g. cache_frames.
+      scene_name: scene name.
+      image_list: image paths of the stream.
+      aligns: (align_scale, align_shift, normalize_scale).
+      K: [3, 3] intrinsics.
+      sources: further files the frames are computed from, e.g. the mono and
+        metric depth priors.
+      **params: any further stream options, e.g. use_depth or stride.
+    """
+    key = store_key(image_list, aligns, K, sources, **params)
+    self.root = root
+    self.scene_name = scene_name
+    self.path = os.path.join(root, "%s_%s" % (scene_name, key))
+    # image_stream only yields every stride-th frame
+    self.num_frames = len(range(0, len(image_list), params.get("stride", 1)))
+
+  @property
+  def complete(self):
+    return os.path.isfile(os.path.join(self.path, "meta.json"))
+
+  def stream(self, make_stream):
+    """Replays the store if complete, otherwise records make_stream()."""
+    if self.complete:
+      return self.replay()
+    return self.record(make_stream())
+
+  def record(self, stream):
+    """Yields the items of stream while writing them to the store.
+
+    The store is only marked complete once stream is exhausted.
+
+    Args:
+      stream: generator of (t, tensor, ...) tuples.
+
+    Yields:
+      The items of stream, unchanged.
+    """
+    os.makedirs(self.path, exist_ok=True)
+    arrays = None
+    count = 0
+    for item in stream:
+      if arrays is None:
+        arrays = [
+            np.lib.format.open_memmap(
+                os.path.join(self.path, "item%d.npy" % i),
+                mode="w+",
+                dtype=x.numpy().dtype,
+                shape=(self.num_frames,) + tuple(x.shape),
+            )
+            if torch.is_tensor(x)
+            else None
+            for i, x in enumerate(item)
+        ]
+        ts = np.zeros(self.num_frames, dtype=np.int64)
+      for array, x in zip(arrays, item):
+        if array is not None:
+          array[count] = x.numpy()
+      ts[count] = item[0]
+      count += 1
+      yield item
+
+    if arrays is None:
+      return
+    for array in arrays:
+      if array is not None:
+        array.flush()
+    np.save(os.path.join(self.path, "t.npy"), ts[:count])
+    meta = {
+        "num_items": len(arrays),
+        "tensor_items": [i for i, a in enumerate(arrays) if a is not None],
+        "count": count,
+    }
+    tmp_path = os.path.join(self.path, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+      json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+    self.evict_others()
+
+  def evict_others(self):
+    """Deletes the stores of the scene other than this one."""
+    pattern = re.compile(re.escape(self.scene_name) + "_[0-9a-f]{16}")
+    for name in os.listdir(self.root):
+      path = os.path.join(self.root, name)
+      if (
+          pattern.fullmatch(name)
+          and path != self.path
+          and os.path.isdir(path)
+      ):
+        shutil.rmtree(path, ignore_errors=True)
+
+  def replay(self):
+    """Yields the recorded tuples, with tensors backed by the memory maps."""
+    with open(os.path.join(self.path, "meta.json")) as f:
+      meta = json.load(f)
+    ts = np.load(os.path.join(self.path, "t.npy"))
+    # copy-on-write, so that the yielded tensors are writable
+    arrays = {
+        i: np.load(os.path.join(self.path, "item%d.npy" % i), mmap_mode="c")
+        for i in meta["tensor_items"]
+    }
+    for k in range(meta["count"]):
+      yield tuple(
+          torch.from_numpy(arrays[i][k]) if i in arrays else int(ts[k])
+          for i in range(meta["num_items"])
+      )
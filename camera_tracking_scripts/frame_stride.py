@@ -0,0 +1,106 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Frame-stride tracking for high-frame-rate input.
+
+With --stride k only every k-th frame is tracked. The poses of the skipped
+frames are recovered by SE3 interpolation between the neighbouring tracked
+frames: the camera moves with a constant twist in its own frame,
+c2w(t) = c2w(a) exp(alpha log(c2w(a)^-1 c2w(b))). Frames after the last
+tracked frame are extrapolated along the last segment.
+"""
+
+import json
+import os
+
+from lietorch import SE3  # pylint: disable=g-importing-member
+import numpy as np
+import torch
+
+
+def tracked_frames(num_frames, stride):
+  """Indices of the frames tracked with the given stride."""
+  return np.arange(0, num_frames, stride)
+
+
+def interpolate_poses(poses, tracked, num_frames):
+  """Interpolates the poses of all frames from those of the tracked frames.
+
+  Args:
+    poses: [M, 7] world-to-camera poses of the tracked frames, as lietorch
+      SE3 data (tx, ty, tz, qx, qy, qz, qw).
+    tracked: [M] increasing frame indices of poses.
+    num_frames: number of frames of the clip.
+
+  Returns:
+    [num_frames, 7] world-to-camera poses; tracked frames keep their pose.
+  """
+  poses = np.asarray(poses)
+  tracked = np.asarray(tracked)
+  if tracked.shape[0] == 1:
+    return np.repeat(poses, num_frames, axis=0)
+
+  frames = np.arange(num_frames)
+  a = np.clip(
+      np.searchsorted(tracked, frames, side="right") - 1,
+      0,
+      tracked.shape[0] - 2,
+  )
+  b = a + 1
+  alpha = (frames - tracked[a]) / (tracked[b] - tracked[a])
+
+  c2w = SE3(torch.as_tensor(poses, device="cpu")).inv()
+  c2w_a = c2w[torch.as_tensor(a)]
+  c2w_b = c2w[torch.as_tensor(b)]
+  twist = (c2w_a.inv() * c2w_b).log()
+  alpha = torch.as_tensor(alpha, dtype=twist.dtype)[:, None]
+  full = (c2w_a * SE3.exp(alpha * twist)).inv().data.numpy()
+  full[tracked] = poses
+  return full
+
+
+def nearest_tracked(tracked, num_frames):
+  """Index into tracked of the tracked frame nearest to every frame."""
+  tracked = np.asarray(tracked)
+  frames = np.arange(num_frames)
+  right = np.clip(np.searchsorted(tracked, frames), 0, tracked.shape[0] - 1)
+  left = np.clip(right - 1, 0, None)
+  use_left = np.abs(frames - tracked[left]) <= np.abs(tracked[right] - frames)
+  return np.where(use_left, left, right)
+
+
+def save_stride_info(path, stride, frame_indices, full_poses, seconds):
+  """Writes the full-rate poses and the tracking summary of a run.
+
+  Args:
+    path: reconstruction directory, e.g. reconstructions/<scene>.
+    stride: tracking stride.
+    frame_indices: clip indices of the frames stored in the reconstruction.
+    full_poses: [N, 7] world-to-camera poses of every frame of the clip.
+    seconds: tracking wall time.
+  """
+  np.save(os.path.join(path, "frame_indices.npy"), frame_indices)
+  np.save(os.path.join(path, "poses_full.npy"), full_poses)
+  with open(os.path.join(path, "tracking.json"), "w") as f:
+    json.dump(
+        {
+            "stride": stride,
+            "num_frames": int(full_poses.shape[0]),
+            "num_stored": int(len(frame_indices)),
+            "seconds": seconds,
+        },
+        f,
+        indent=2,
+    )
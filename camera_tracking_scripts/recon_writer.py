@@ -0,0 +1,195 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Streaming writer of the frames and disparities of a tracking run.
+
+Frames and sensor depths are written to reconstructions/<scene>/images.npy and
+disps.npy through memory maps as the tracking loop produces them, instead of
+being collected in Python lists and copied into full arrays at the end.
+
+The writer also publishes its progress to live.npy, a one-record header
+(capacity, count, closed) that is memory-mapped like the data. count is
+updated after the frame and its disparity are in the shared page cache, so
+a viewer that maps the header (LiveReader, used by visualize_live.py) sees
+new frames as soon as they are appended, without reading or stat-ing the
+data files. The header and the data files are created under a temporary name
+and renamed into place, so a new run never truncates files a viewer has
+mapped; a viewer detects the new run by the new inode of live.npy.
+"""
+
+import os
+
+import numpy as np
+
+LIVE_DTYPE = np.dtype(
+    [("capacity", "<u8"), ("count", "<u8"), ("closed", "<u8")]
+)
+
+
+def _create_memmap(path, dtype, shape):
+  """New .npy memory map, renamed into place instead of overwriting path."""
+  tmp_path = path + ".tmp.npy"
+  array = np.lib.format.open_memmap(
+      tmp_path, mode="w+", dtype=dtype, shape=shape
+  )
+  os.replace(tmp_path, path)
+  return array
+
+
+class ReconstructionWriter:
+  """Appends frames and disparities to memory-mapped .npy files."""
+
+  def __init__(self, path, num_frames, eps=1e-6):
+    """Prepares the reconstruction directory.
+
+    Args:
+      path: reconstruction directory, e.g. reconstructions/<scene>.
+      num_frames: number of frames that will be appended.
+      eps: disparities are stored as 1 / (depth + eps).
+    """
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self.num_frames = num_frames
+    self.eps = eps
+    self.count = 0
+    self.images = None
+    self.disps = None
+    self.live = _create_memmap(self.live_path, LIVE_DTYPE, (1,))
+    self.live["capacity"] = num_frames
+
+  @property
+  def images_path(self):
+    return os.path.join(self.path, "images.npy")
+
+  @property
+  def disps_path(self):
+    return os.path.join(self.path, "disps.npy")
+
+  @property
+  def live_path(self):
+    return os.path.join(self.path, "live.npy")
+
+  def append(self, image, depth):
+    """Appends a [3, H, W] uint8 frame and its [H, W] depth."""
+    image = np.asarray(image)
+    disp = 1.0 / (np.asarray(depth) + self.eps)
+    if self.images is None:
+      self.images = _create_memmap(
+          self.images_path, image.dtype, (self.num_frames,) + image.shape
+      )
+      self.disps = _create_memmap(
+          self.disps_path, disp.dtype, (self.num_frames,) + disp.shape
+      )
+    self.images[self.count] = image
+    self.disps[self.count] = disp
+    self.count += 1
+    # publish the frame
+    self.live["count"] = self.count
+
+  def close(self, num_frames):
+    """Finishes the files and reopens them read-only.
+
+    Args:
+      num_frames: number of frames of the reconstruction. Frames appended
+        beyond it are dropped, which rewrites the files.
+
+    Returns:
+      (images [N, 3, H, W], disps [N, H, W]) read-only memory maps.
+    """
+    if num_frames > self.count:
+      raise ValueError(
+          "Reconstruction has %d frames, but only %d were appended."
+          % (num_frames, self.count)
+      )
+    for array, path in (
+        (self.images, self.images_path),
+        (self.disps, self.disps_path),
+    ):
+      array.flush()
+      if num_frames < self.num_frames:
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, array[:num_frames])
+        os.replace(tmp_path, path)
+    self.live["count"] = num_frames
+    self.live["closed"] = 1
+    self.live.flush()
+    self.images = self.disps = self.live = None
+    return (
+        np.load(self.images_path, mmap_mode="r"),
+        np.load(self.disps_path, mmap_mode="r"),
+    )
+
+
+class LiveReader:
+  """Follows the frames published by a ReconstructionWriter."""
+
+  def __init__(self, path):
+    """Prepares the reader; nothing is mapped before reconnect().
+
+    Args:
+      path: reconstruction directory, e.g. reconstructions/<scene>.
+    """
+    self.path = path
+    self.header = None
+    self.inode = None
+    self.images = None
+    self.disps = None
+
+  @property
+  def live_path(self):
+    return os.path.join(self.path, "live.npy")
+
+  def reconnect(self):
+    """Maps the header of a new run, if there is one.
+
+    A single stat of live.npy; call it occasionally, not per frame.
+
+    Returns:
+      True if a new run was found.
+    """
+    try:
+      inode = os.stat(self.live_path).st_ino
+    except FileNotFoundError:
+      return False
+    if inode == self.inode:
+      return False
+    self.header = np.load(self.live_path, mmap_mode="r")
+    self.inode = inode
+    self.images = self.disps = None
+    return True
+
+  @property
+  def count(self):
+    """Number of published frames, read from the mapped header."""
+    return 0 if self.header is None else int(self.header["count"][0])
+
+  @property
+  def capacity(self):
+    return 0 if self.header is None else int(self.header["capacity"][0])
+
+  @property
+  def closed(self):
+    return self.header is not None and bool(self.header["closed"][0])
+
+  def frame(self, index):
+    """([3, H, W] BGR uint8 frame, [H, W] disparity) of a published frame."""
+    if index >= self.count:
+      raise IndexError("Frame %d is not published yet." % index)
+    if self.images is None:
+      self.images = np.load(
+          os.path.join(self.path, "images.npy"), mmap_mode="r"
+      )
+      self.disps = np.load(os.path.join(self.path, "disps.npy"), mmap_mode="r")
+    return self.images[index], self.disps[index]
@@ -26,6 +26,7 @@
 import sys
 
 sys.path.append("base/droid_slam")
+sys.path.append("cvd_opt")
 
 from tqdm import tqdm
 import numpy as np
@@ -34,10 +35,22 @@ import cv2
 import os
 import glob
 import argparse
+import functools
+import time
 from lietorch import SE3
 
 import torch.nn.functional as F
 from droid import Droid
+from lean_output import save_npz
+from lean_output import save_output
+from depth_align import align_clip
+from depth_priors import load_depth_priors
+from frame_store import FrameStore
+from frame_stride import interpolate_poses
+from frame_stride import nearest_tracked
+from frame_stride import save_stride_info
+from frame_stride import tracked_frames
+from recon_writer import ReconstructionWriter
 
 
 def image_stream(
@@ -50,7 +63,7 @@ def image_stream(
     stride=1,
 ):
   """image generator."""
-  del scene_name, stride
+  del scene_name
 
   fx, fy, cx, cy = (
       K[0, 0],
@@ -60,6 +73,8 @@ def image_stream(
   )  # np.loadtxt(os.path.join(datapath, 'calibration.txt')).tolist()
 
   for t, (image_file) in enumerate(image_list):
+    if t % stride:
+      continue
     image = cv2.imread(image_file)
     # depth = cv2.imread(depth_file, cv2.IMREAD_ANYDEPTH) / 5000.
     # depth = np.float32(np.load(depth_file)) / 300.0
@@ -108,22 +123,21 @@ def image_stream(
 
 
 def save_full_reconstruction(
-    droid, full_traj, rgb_list, senor_depth_list, motion_prob, scene_name
+    droid,
+    full_traj,
+    recon_writer,
+    motion_prob,
+    scene_name,
+    output_format="npz",
 ):
   """Save full reconstruction."""
   from pathlib import Path
   t = full_traj.shape[0]
-  images = np.array(rgb_list[:t])  # droid.video.images[:t].cpu().numpy()
-  disps = 1.0 / (np.array(senor_depth_list[:t]) + 1e-6)
+  images, disps = recon_writer.close(t)
 
   poses = full_traj  # .cpu().numpy()
   intrinsics = droid.video.intrinsics[:t].cpu().numpy()
 
-  Path("reconstructions/{}".format(scene_name)).mkdir(
-      parents=True, exist_ok=True
-  )
-  np.save("reconstructions/{}/images.npy".format(scene_name), images)
-  np.save("reconstructions/{}/disps.npy".format(scene_name), disps)
   np.save("reconstructions/{}/poses.npy".format(scene_name), poses)
   np.save(
       "reconstructions/{}/intrinsics.npy".format(scene_name), intrinsics * 8.0
@@ -142,17 +156,30 @@ def save_full_reconstruction(
   print("K ", K)
   print("img_data ", images.shape)
   print("disp_data ", disps.shape)
-
-  max_frames = min(1000, images.shape[0])
-  print("outputs/%s_droid.npz" % scene_name)
+  print("outputs/%s_droid" % scene_name)
   Path("outputs").mkdir(parents=True, exist_ok=True)
 
-  np.savez(
+  if output_format == "lean":
+    save_output(
+        "outputs/%s_droid" % scene_name,
+        disps,
+        K,
+        cam_c2w,
+        recon_writer.images_path,
+        disparity=True,
+    )
+    return
+  save_npz(
       "outputs/%s_droid.npz" % scene_name,
-      images=np.uint8(images[:max_frames, ::-1, ...].transpose(0, 2, 3, 1)),
-      depths=np.float32(1.0 / disps[:max_frames, ...]),
-      intrinsic=K,
-      cam_c2w=cam_c2w[:max_frames],
+      {
+          "images": (
+              images,
+              lambda x: np.uint8(x[:, ::-1].transpose(0, 2, 3, 1)),
+          ),
+          "depths": (disps, lambda x: np.float32(1.0 / x)),
+          "intrinsic": K,
+          "cam_c2w": cam_c2w,
+      },
   )
 
 
@@ -188,6 +215,44 @@ if __name__ == "__main__":
       "--mono_depth_path", default="Depth-Anything/video_visualization"
   )
   parser.add_argument("--metric_depth_path", default="UniDepth/outputs ")
+  parser.add_argument(
+      "--output_format",
+      default="npz",
+      choices=["lean", "npz"],
+      help="lean (opt-in, read through lean_output.load_output) references"
+      " reconstructions/<scene>/images.npy instead of copying the frames",
+  )
+  parser.add_argument(
+      "--frame_cache_dir",
+      default="",
+      help="store of preprocessed frames replayed by droid.terminate (opt-in,"
+      " e.g. cache_frames); only the latest store of each scene is kept",
+  )
+  parser.add_argument(
+      "--prefetch_workers",
+      type=int,
+      default=8,
+      help="threads loading the mono and metric depth files",
+  )
+  parser.add_argument(
+      "--prior_cache_dir",
+      default="",
+      help="if set, keep the depth priors of each scene in one consolidated"
+      " <scene>.npz there",
+  )
+  parser.add_argument(
+      "--stride",
+      type=int,
+      default=1,
+      help="track every stride-th frame, the poses of the other frames are"
+      " interpolated",
+  )
+  parser.add_argument(
+      "--keep_skipped",
+      action="store_true",
+      help="with --stride, also store the skipped frames, with interpolated"
+      " poses, for flow and CVD",
+  )
   args = parser.parse_args()
 
   print("Running evaluation on {}".format(args.datapath))
@@ -196,8 +261,6 @@ if __name__ == "__main__":
   scene_name = args.scene_name.split("/")[-1]
 
   tstamps = []
-  rgb_list = []
-  senor_depth_list = []
 
   image_list = sorted(glob.glob(os.path.join("%s" % (args.datapath), "*.jpg")))
   image_list += sorted(glob.glob(os.path.join("%s" % (args.datapath), "*.png")))
@@ -215,57 +278,19 @@ if __name__ == "__main__":
   )
 
   img_0 = cv2.imread(image_list[0])
-  scales = []
-  shifts = []
-  mono_disp_list = []
-  fovs = []
-  for t, (mono_disp_file, metric_depth_file) in enumerate(
-      zip(mono_disp_paths, metric_depth_paths)
-  ):
-    da_disp = np.float32(np.load(mono_disp_file))  # / 300.0
-    uni_data = np.load(metric_depth_file)
-    metric_depth = uni_data["depth"]
-
-    fovs.append(uni_data["fov"])
-
-    da_disp = cv2.resize(
-        da_disp,
-        (metric_depth.shape[1], metric_depth.shape[0]),
-        interpolation=cv2.INTER_NEAREST_EXACT,
-    )
-    mono_disp_list.append(da_disp)
-    gt_disp = 1.0 / (metric_depth + 1e-8)
-
-    # avoid some bug from UniDepth
-    valid_mask = (metric_depth < 2.0) & (da_disp < 0.02)
-    gt_disp[valid_mask] = 1e-2
-
-    # avoid cases sky dominate entire video
-    sky_ratio = np.sum(da_disp < 0.01) / (da_disp.shape[0] * da_disp.shape[1])
-    if sky_ratio > 0.5:
-      non_sky_mask = da_disp > 0.01
-      gt_disp_ms = (
-          gt_disp[non_sky_mask] - np.median(gt_disp[non_sky_mask]) + 1e-8
-      )
-      da_disp_ms = (
-          da_disp[non_sky_mask] - np.median(da_disp[non_sky_mask]) + 1e-8
-      )
-      scale = np.median(gt_disp_ms / da_disp_ms)
-      shift = np.median(gt_disp[non_sky_mask] - scale * da_disp[non_sky_mask])
-    else:
-      gt_disp_ms = gt_disp - np.median(gt_disp) + 1e-8
-      da_disp_ms = da_disp - np.median(da_disp) + 1e-8
-      scale = np.median(gt_disp_ms / da_disp_ms)
-      shift = np.median(gt_disp - scale * da_disp)
-
-    gt_disp_ms = gt_disp - np.median(gt_disp) + 1e-8
-    da_disp_ms = da_disp - np.median(da_disp) + 1e-8
-
-    scale = np.median(gt_disp_ms / da_disp_ms)
-    shift = np.median(gt_disp - scale * da_disp)
-
-    scales.append(scale)
-    shifts.append(shift)
+  mono_disps, metric_depths, fovs = load_depth_priors(
+      mono_disp_paths,
+      metric_depth_paths,
+      num_workers=args.prefetch_workers,
+      cache_path=(
+          os.path.join(args.prior_cache_dir, scene_name + ".npz")
+          if args.prior_cache_dir
+          else None
+      ),
+  )
+  aligns, mono_disp_list = align_clip(
+      mono_disps, metric_depths, device="cuda"
+  )
 
   print("************** UNIDEPTH FOV ", np.median(fovs))
   ff = img_0.shape[1] / (2 * np.tan(np.radians(np.median(fovs) / 2.0)))
@@ -283,33 +308,51 @@ if __name__ == "__main__":
       img_0.shape[0] / 2.0
   )  # (pp_intrinsic[2]) * (img_0.shape[0] / (pp_intrinsic[2] * 2))
 
-  ss_product = np.array(scales) * np.array(shifts)
-  med_idx = np.argmin(np.abs(ss_product - np.median(ss_product)))
+  stride = args.stride
+  keep_skipped = args.keep_skipped and stride > 1
+  num_frames = len(image_list)
+  tracked = tracked_frames(num_frames, stride)
+  recon_writer = None
+  if args.scene_name is not None:
+    # frames and disparities are streamed to reconstructions/<scene>/
+    recon_writer = ReconstructionWriter(
+        "reconstructions/{}".format(args.scene_name),
+        num_frames if keep_skipped else len(tracked),
+        eps=1e-6,
+    )
 
-  align_scale = scales[med_idx]  # np.median(np.array(scales))
-  align_shift = shifts[med_idx]  # np.median(np.array(shifts))
-  normalize_scale = (
-      np.percentile((align_scale * np.array(mono_disp_list) + align_shift), 98)
-      / 2.0
+  make_stream = functools.partial(
+      image_stream,
+      image_list,
+      mono_disp_list,
+      scene_name,
+      use_depth=True,
+      aligns=aligns,
+      K=K,
+      stride=stride,
   )
+  if args.frame_cache_dir:
+    # the second pass in droid.terminate replays the preprocessed frames
+    frame_store = FrameStore(
+        args.frame_cache_dir,
+        scene_name,
+        image_list,
+        aligns,
+        K,
+        sources=mono_disp_paths + metric_depth_paths,
+        mono_depth_path=args.mono_depth_path,
+        use_depth=True,
+        stride=stride,
+    )
+    make_stream = functools.partial(frame_store.stream, make_stream)
 
-  aligns = (align_scale, align_shift, normalize_scale)
-
-  for t, image, depth, intrinsics, mask in tqdm(
-      image_stream(
-          image_list,
-          mono_disp_list,
-          scene_name,
-          use_depth=True,
-          aligns=aligns,
-          K=K,
-      )
-  ):
+  tracking_start = time.perf_counter()
+  for t, image, depth, intrinsics, mask in tqdm(make_stream()):
     if not args.disable_vis:
       show_image(image[0])
 
-    rgb_list.append(image[0])
-    senor_depth_list.append(depth)
+    if recon_writer is not None and not keep_skipped:
+      recon_writer.append(image[0], depth)
     # breakpoint()
     if t == 0:
       args.image_size = [image.shape[2], image.shape[3]]
@@ -321,25 +364,49 @@ if __name__ == "__main__":
   droid.track_final(t, image, depth, intrinsics=intrinsics, mask=mask)
 
   traj_est, depth_est, motion_prob = droid.terminate(
-      image_stream(
-          image_list,
-          mono_disp_list,
-          scene_name,
-          use_depth=True,
-          aligns=aligns,
-          K=K,
-      ),
+      make_stream(),
       _opt_intr=True,
       full_ba=True,
       scene_name=scene_name,
   )
 
+  tracking_seconds = time.perf_counter() - tracking_start
+  full_traj = interpolate_poses(traj_est, tracked, num_frames)
+  print(
+      "stride %d: tracked %d of %d frames in %.1f s"
+      % (stride, len(tracked), num_frames, tracking_seconds)
+  )
+
   if args.scene_name is not None:
+    frame_indices = tracked
+    if keep_skipped:
+      # the skipped frames go to flow and CVD with interpolated poses
+      for _, image, depth, _, _ in image_stream(
+          image_list,
+          mono_disp_list,
+          scene_name,
+          use_depth=True,
+          aligns=aligns,
+          K=K,
+      ):
+        recon_writer.append(image[0], depth)
+      traj_est = full_traj
+      motion_prob = np.asarray(motion_prob)[
+          nearest_tracked(tracked, num_frames)
+      ]
+      frame_indices = np.arange(num_frames)
     save_full_reconstruction(
         droid,
         traj_est,
-        rgb_list,
-        senor_depth_list,
+        recon_writer,
         motion_prob,
         args.scene_name,
+        args.output_format,
+    )
+    save_stride_info(
+        "reconstructions/{}".format(args.scene_name),
+        stride,
+        frame_indices,
+        full_traj,
+        tracking_seconds,
     )
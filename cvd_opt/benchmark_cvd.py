@@ -0,0 +1,345 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Throughput benchmark for CVD optimization on a synthetic scene.
+
+Examples:
+  python cvd_opt/benchmark_cvd.py --device cpu --num_threads 8 --compile
+  python cvd_opt/benchmark_cvd.py --device cuda --fused_loss --check_grads
+  python cvd_opt/benchmark_cvd.py --device cuda --precision bf16 --check_parity
+  python cvd_opt/benchmark_cvd.py --sample_rate 0.1 --prior_stride 2 \\
+      --check_parity
+"""
+
+# pylint: disable=invalid-name
+# pylint: disable=g-importing-member
+
+import argparse
+import functools
+import time
+
+from cvd_opt import ALPHA_MOTION
+from cvd_opt import consistency_loss
+from cvd_opt import maybe_compile
+from cvd_opt import MixedPrecision
+from cvd_opt import setup_device
+from cvd_opt import sobel_fg_alpha
+from geometry_utils import NormalGenerator
+from loss_kernels import get_reprojection_fn
+from loss_kernels import reprojection_terms
+from loss_kernels import reprojection_terms_fused
+from loss_kernels import sample_pixels
+import torch
+
+
+PAIR_STEPS = (1, 2, 4, 8, 15)
+
+
+def make_synthetic_scene(
+    num_frames, height, width, device, baseline=0.02, seed=0
+):
+  """Builds a laterally translating camera over a smooth disparity field.
+
+  Flows are generated from the true geometry with the same pair schedule as
+  preprocess_flow.py, so the loss sees realistic shapes and magnitudes.
+
+  Args:
+    num_frames: number of frames.
+    height: optimization height.
+    width: optimization width.
+    device: torch device.
+    baseline: camera translation along x between consecutive frames.
+    seed: random seed for the disparity field.
+
+  Returns:
+    Dict with the tensors consumed by consistency_loss.
+  """
+  gen = torch.Generator().manual_seed(seed)
+  fx = fy = 0.8 * width
+  K = torch.tensor(
+      [[fx, 0.0, width / 2.0], [0.0, fy, height / 2.0], [0.0, 0.0, 1.0]]
+  )
+
+  yy, xx = torch.meshgrid(
+      torch.linspace(0, 1, height), torch.linspace(0, 1, width), indexing="ij"
+  )
+  phase = torch.rand(num_frames, 1, 1, generator=gen) * 6.28
+  disp = 0.3 + 0.1 * torch.sin(6.0 * xx + phase) * torch.cos(4.0 * yy)
+
+  cam_c2w = torch.eye(4).repeat(num_frames, 1, 1)
+  cam_c2w[:, 0, 3] = baseline * torch.arange(num_frames).float()
+
+  ii, jj = [], []
+  for step in PAIR_STEPS:
+    for i in range(max(0, num_frames - step)):
+      ii.append(i)
+      jj.append(i + step)
+  ii = torch.tensor(ii)
+  jj = torch.tensor(jj)
+
+  # pure x-translation: flow_x = fx * (t_i - t_j) * disp_i
+  flows = torch.zeros(len(ii), 2, height, width)
+  flows[:, 0] = fx * baseline * (ii - jj).float()[:, None, None] * disp[ii]
+  flow_masks = torch.ones(len(ii), 1, height, width)
+  noise = 0.05 * torch.randn(disp.shape, generator=gen)
+
+  return {
+      "cam_c2w": cam_c2w.to(device),
+      "K": K.to(device),
+      "K_inv": torch.linalg.inv(K).to(device),
+      "disp": torch.clamp(disp + noise * disp, 1e-3, 1e3).to(device),
+      "init_disp": disp.to(device),
+      "uncertainty": torch.full((num_frames, 1, height, width), 0.5).to(
+          device
+      ),
+      "flows": flows.to(device),
+      "flow_masks": flow_masks.to(device),
+      "ii": ii.to(device),
+      "jj": jj.to(device),
+  }
+
+
+def check_gradients(scene):
+  """Compares fused and reference reprojection terms and their gradients."""
+  results = []
+  for fn in (reprojection_terms, reprojection_terms_fused):
+    disp = scene["disp"].clone().requires_grad_(True)
+    uncertainty = scene["uncertainty"].clone().requires_grad_(True)
+    loss_d_ratio, loss_flow = fn(
+        scene["cam_c2w"],
+        scene["K"],
+        scene["K_inv"],
+        disp,
+        uncertainty,
+        scene["flows"],
+        scene["flow_masks"],
+        scene["ii"],
+        scene["jj"],
+        ALPHA_MOTION,
+    )
+    (loss_d_ratio + 0.2 * loss_flow).backward()
+    results.append((loss_d_ratio, loss_flow, disp.grad, uncertainty.grad))
+
+  names = ("loss_d_ratio", "loss_flow", "grad disp", "grad uncertainty")
+  ok = True
+  for name, ref, fused in zip(names, *results):
+    err = torch.max(torch.abs(ref - fused)).item()
+    scale = torch.max(torch.abs(ref)).item() + 1e-12
+    ok = ok and err / scale < 1e-4
+    print("%-18s max abs err %.3e  rel %.3e" % (name, err, err / scale))
+  print("gradient parity:", "OK" if ok else "FAILED")
+  return ok
+
+
+def run_steps(
+    scene,
+    loss_fn,
+    num_steps,
+    device,
+    precision="fp32",
+    sample_rate=1.0,
+    sample_mode="stratified",
+    prior_stride=1,
+):
+  """Runs depth/uncertainty Adam steps.
+
+  Args:
+    scene: synthetic scene from make_synthetic_scene.
+    loss_fn: consistency loss callable.
+    num_steps: number of timed steps, after three warm-up steps.
+    device: torch device.
+    precision: key of cvd_opt.PRECISIONS.
+    sample_rate: fixed fraction of pixels for the reprojection terms.
+    sample_mode: pixel sampling mode of loss_kernels.sample_pixels.
+    prior_stride: pooling stride of the prior terms.
+
+  Returns:
+    (seconds per step, optimized disparity).
+  """
+  amp = MixedPrecision(precision, device)
+  disp = scene["disp"].clone().requires_grad_(True)
+  uncertainty = scene["uncertainty"].clone().requires_grad_(True)
+  optim = torch.optim.Adam([
+      {"params": disp, "lr": 5e-3},
+      {"params": uncertainty, "lr": 5e-3},
+  ])
+  amp.watch([disp, uncertainty])
+  flows = amp.cast_flows(scene["flows"])
+  flow_masks = amp.cast(scene["flow_masks"])
+  init_disp_prior = torch.nn.functional.avg_pool2d(
+      scene["init_disp"][:, None], prior_stride
+  )
+  compute_normals = [
+      NormalGenerator(
+          init_disp_prior.shape[-2], init_disp_prior.shape[-1]
+      ).to(device)
+  ]
+  fg_alpha = sobel_fg_alpha(init_disp_prior) > 0.2
+  fg_alpha = fg_alpha.squeeze(1).float() + 0.2
+
+  def step():
+    optim.zero_grad()
+    samples = None
+    if sample_rate < 1.0:
+      samples = sample_pixels(
+          flow_masks,
+          torch.clamp(uncertainty.detach(), 1e-4, 1e3),
+          scene["ii"],
+          sample_rate,
+          sample_mode,
+      )
+    with amp.autocast():
+      loss = loss_fn(
+          scene["cam_c2w"],
+          scene["K"],
+          scene["K_inv"],
+          torch.clamp(disp, 1e-3, 1e3),
+          scene["init_disp"],
+          torch.clamp(uncertainty, 1e-4, 1e3),
+          flows,
+          flow_masks,
+          scene["ii"],
+          scene["jj"],
+          compute_normals,
+          fg_alpha,
+          samples=samples,
+          prior_stride=prior_stride,
+      )
+    amp.step(loss, optim)
+    return loss
+
+  # warm up (and trigger compilation) outside the timed region
+  for _ in range(3):
+    step()
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats(device)
+
+  start = time.perf_counter()
+  for _ in range(num_steps):
+    loss = step()
+  loss.item()
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+  return (time.perf_counter() - start) / num_steps, disp.detach()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--device", type=str, default="cpu")
+  parser.add_argument("--num_threads", type=int, default=0)
+  parser.add_argument("--num_frames", type=int, default=32)
+  parser.add_argument("--height", type=int, default=192)
+  parser.add_argument("--width", type=int, default=256)
+  parser.add_argument("--num_steps", type=int, default=20)
+  parser.add_argument("--compile", action="store_true")
+  parser.add_argument("--fused_loss", action="store_true")
+  parser.add_argument(
+      "--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"]
+  )
+  parser.add_argument("--sample_rate", type=float, default=1.0)
+  parser.add_argument(
+      "--sample_mode",
+      type=str,
+      default="stratified",
+      choices=["stratified", "uncertainty"],
+  )
+  parser.add_argument("--prior_stride", type=int, default=1)
+  parser.add_argument(
+      "--check_parity",
+      action="store_true",
+      help="also run dense fp32 and report the disparity difference",
+  )
+  parser.add_argument(
+      "--check_grads",
+      action="store_true",
+      help="check fused vs reference reprojection terms before timing",
+  )
+  parser.add_argument(
+      "--no_channels_last",
+      action="store_true",
+      help="keep flows/masks NCHW on CPU, where cvd_opt.py stores them"
+      " channels-last",
+  )
+  args = parser.parse_args()
+
+  device = setup_device(args.device, args.num_threads)
+  scene = make_synthetic_scene(
+      args.num_frames, args.height, args.width, device
+  )
+  if device.type == "cpu" and not args.no_channels_last:
+    for key in ("flows", "flow_masks"):
+      scene[key] = scene[key].contiguous(memory_format=torch.channels_last)
+
+  if args.check_grads and not check_gradients(scene):
+    raise SystemExit(1)
+
+  loss_fn = maybe_compile(
+      functools.partial(
+          consistency_loss,
+          reprojection_fn=get_reprojection_fn(
+              args.fused_loss, compile_kernel=not args.compile
+          ),
+      ),
+      args.compile,
+  )
+  sec_per_step, disp = run_steps(
+      scene,
+      loss_fn,
+      args.num_steps,
+      device,
+      args.precision,
+      args.sample_rate,
+      args.sample_mode,
+      args.prior_stride,
+  )
+  num_pairs = scene["ii"].shape[0]
+  print(
+      "device=%s threads=%d frames=%d pairs=%d res=%dx%d compile=%s fused=%s"
+      " precision=%s sample_rate=%g prior_stride=%d"
+      % (
+          device,
+          torch.get_num_threads(),
+          args.num_frames,
+          num_pairs,
+          args.height,
+          args.width,
+          args.compile,
+          args.fused_loss,
+          args.precision,
+          args.sample_rate,
+          args.prior_stride,
+      )
+  )
+  print(
+      "%.1f ms/step, %.2f steps/s, %.1f Mpix-pairs/s"
+      % (
+          sec_per_step * 1e3,
+          1.0 / sec_per_step,
+          num_pairs * args.height * args.width / sec_per_step / 1e6,
+      )
+  )
+  if device.type == "cuda":
+    print(
+        "peak memory %.1f MiB"
+        % (torch.cuda.max_memory_allocated(device) / 2**20)
+    )
+  if args.check_parity:
+    _, disp_fp32 = run_steps(scene, loss_fn, args.num_steps, device, "fp32")
+    rel_diff = torch.abs(disp.float() - disp_fp32) / disp_fp32
+    print(
+        "disparity vs dense fp32: mean rel diff %.3e, max rel diff %.3e"
+        % (rel_diff.mean().item(), rel_diff.max().item())
+    )
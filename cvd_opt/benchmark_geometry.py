@@ -0,0 +1,152 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Per-kernel micro-benchmark of the geometry kernels used by the CVD loss.
+
+Each kernel of geometry_utils is timed next to the kornia implementation it
+replaces, and the normals are checked against the kornia reference.
+
+Examples:
+  python cvd_opt/benchmark_geometry.py --device cuda
+  python cvd_opt/benchmark_geometry.py --device cpu --num_threads 8
+"""
+
+# pylint: disable=invalid-name
+
+import argparse
+import time
+
+from cvd_opt import setup_device
+from geometry_utils import BackprojectDepth
+from geometry_utils import NormalGenerator
+import kornia
+import torch
+import torch.nn.functional as F
+
+
+def reference_normals(normal_generator, depth_b1hw, invK_b44):
+  """NormalGenerator as implemented with kornia filters."""
+  depth_smooth_b1hw = kornia.filters.gaussian_blur2d(
+      depth_b1hw,
+      (normal_generator.kernel_size, normal_generator.kernel_size),
+      (normal_generator.std, normal_generator.std),
+  )
+  cam_points_b4N = normal_generator.backproject(depth_smooth_b1hw, invK_b44)
+  cam_points_b3hw = cam_points_b4N[:, :3].view(
+      -1, 3, normal_generator.height, normal_generator.width
+  )
+  gradients_b32hw = kornia.filters.spatial_gradient(cam_points_b3hw)
+  return F.normalize(
+      torch.cross(gradients_b32hw[:, :, 0], gradients_b32hw[:, :, 1], dim=1),
+      dim=1,
+  )
+
+
+def time_kernel(fn, device, num_iters):
+  """Returns the mean seconds per call of fn, after a short warm up."""
+  for _ in range(3):
+    fn()
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+  start = time.perf_counter()
+  for _ in range(num_iters):
+    fn()
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+  return (time.perf_counter() - start) / num_iters
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--device", type=str, default="cpu")
+  parser.add_argument("--num_threads", type=int, default=0)
+  parser.add_argument("--num_frames", type=int, default=32)
+  parser.add_argument("--height", type=int, default=192)
+  parser.add_argument("--width", type=int, default=256)
+  parser.add_argument("--num_iters", type=int, default=50)
+  args = parser.parse_args()
+
+  device = setup_device(args.device, args.num_threads)
+  torch.manual_seed(0)
+  h, w = args.height, args.width
+  K = torch.tensor(
+      [[0.8 * w, 0.0, w / 2.0], [0.0, 0.8 * w, h / 2.0], [0.0, 0.0, 1.0]]
+  )
+  invK = torch.eye(4)
+  invK[:3, :3] = torch.inverse(K)
+  invK = invK[None].to(device)
+  pred_depth = (
+      2.0 + torch.rand(args.num_frames, 1, h, w, device=device)
+  ).requires_grad_()
+  prior_depth = 2.0 + torch.rand(args.num_frames, 1, h, w, device=device)
+
+  backproject = BackprojectDepth(h, w).to(device)
+  normal_generator = NormalGenerator(h, w).to(device)
+  cam_points = backproject.cam_points(pred_depth, invK).view(-1, 3, h, w)
+  cam_points = cam_points.detach()
+
+  def normals_separate():
+    return (
+        normal_generator(pred_depth, invK),
+        normal_generator(prior_depth, invK),
+    )
+
+  def normals_batched():
+    return normal_generator(torch.cat([pred_depth, prior_depth]), invK)
+
+  def normals_cached():
+    return (
+        normal_generator(pred_depth, invK),
+        normal_generator.cached(
+            (prior_depth, invK), lambda: normal_generator(prior_depth, invK)
+        ),
+    )
+
+  kernels = [
+      ("backproject (homogeneous)", lambda: backproject(pred_depth, invK)),
+      ("backproject (cam_points)", lambda: backproject.cam_points(
+          pred_depth, invK
+      )),
+      ("blur (kornia)", lambda: kornia.filters.gaussian_blur2d(
+          pred_depth, (5, 5), (2.0, 2.0)
+      )),
+      ("blur (separable)", lambda: normal_generator.smooth(pred_depth)),
+      ("gradient (kornia)", lambda: kornia.filters.spatial_gradient(
+          cam_points
+      )),
+      ("gradient (grouped)", lambda: normal_generator.gradients(cam_points)),
+      ("normals (kornia)", lambda: reference_normals(
+          normal_generator, pred_depth, invK
+      )),
+      ("normals", lambda: normal_generator(pred_depth, invK)),
+      ("normals pred+prior (2 calls)", normals_separate),
+      ("normals pred+prior (batched)", normals_batched),
+      ("normals pred+prior (cached prior)", normals_cached),
+  ]
+
+  print(
+      "device=%s threads=%d frames=%d res=%dx%d"
+      % (device, torch.get_num_threads(), args.num_frames, h, w)
+  )
+  for name, fn in kernels:
+    sec = time_kernel(fn, device, args.num_iters)
+    print("%-36s %8.3f ms" % (name, sec * 1e3))
+
+  with torch.no_grad():
+    diff = torch.abs(
+        normal_generator(pred_depth, invK)
+        - reference_normals(normal_generator, pred_depth, invK)
+    )
+  print("normals vs kornia: max abs diff %.3e" % diff.max().item())
@@ -0,0 +1,77 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Periodic, atomic checkpoints of the CVD optimization state."""
+
+import os
+import time
+
+import torch
+
+
+class Checkpointer:
+  """Saves the optimization state every N steps and/or every T seconds.
+
+  Checkpoints are written to a temporary file and renamed over the previous
+  one, so a preempted run always leaves either the old or the new checkpoint
+  intact on disk.
+  """
+
+  def __init__(self, path, every_steps=0, every_secs=0.0, config=None):
+    self.path = path
+    self.every_steps = every_steps
+    self.every_secs = every_secs
+    self.config = config or {}
+    self._steps = 0
+    self._last = time.monotonic()
+
+  @property
+  def enabled(self):
+    return self.every_steps > 0 or self.every_secs > 0
+
+  def load(self, device):
+    """Returns the saved state, or None if there is no checkpoint."""
+    if not os.path.exists(self.path):
+      return None
+    state = torch.load(self.path, map_location=device)
+    if state["config"] != self.config:
+      raise ValueError(
+          "Checkpoint %s was written with %s, current run uses %s."
+          % (self.path, state["config"], self.config)
+      )
+    print("resuming from %s: %s" % (self.path, state["position"]))
+    return state
+
+  def save(self, state):
+    state = dict(state, config=self.config)
+    tmp_path = self.path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, self.path)
+    self._steps = 0
+    self._last = time.monotonic()
+
+  def step(self, make_state):
+    """Counts one optimization step and saves make_state() when due."""
+    if not self.enabled:
+      return
+    self._steps += 1
+    if (self.every_steps > 0 and self._steps >= self.every_steps) or (
+        self.every_secs > 0 and time.monotonic() - self._last >= self.every_secs
+    ):
+      self.save(make_state())
+
+  def remove(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
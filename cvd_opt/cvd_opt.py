@@ -20,17 +20,44 @@
 # pylint: disable=redefined-outer-name
 
 import argparse
+import contextlib
+import functools
+import math
 import os
 from pathlib import Path
 
+from checkpoint import Checkpointer
+from geometry_utils import is_compiling
 from geometry_utils import NormalGenerator
+from incremental import freeze_frames
+from incremental import load_previous_solution
+from incremental import plan_incremental
 import kornia
+from lean_output import save_output
 from lietorch import SE3
+from loss_kernels import get_reprojection_fn
+from loss_kernels import reprojection_terms
+from loss_kernels import reprojection_terms_sampled
+from loss_kernels import sample_pixels
+from loss_kernels import segment_sum
 import numpy as np
 import torch
 
 
-def gradient_loss(gt, pred, u):
+def frame_mean(values, segments=None):
+  """Mean of [N, ...] per-frame values, per packed scene with segments.
+
+  Frames of a pack have equal resolution, so the mean of a scene is the mean
+  of the per-frame means of its frames.
+  """
+  if segments is None:
+    return torch.mean(values)
+  per_frame = values.reshape(values.shape[0], -1).mean(-1)
+  counts = segments.frame_counts
+  return segment_sum(per_frame, segments.frame_ids, counts.shape[0]) / counts
+
+
+def gradient_loss(gt, pred, u, segments=None):
   """Gradient loss."""
   del u
   diff = pred - gt
@@ -54,11 +81,13 @@ def gradient_loss(gt, pred, u):
   weight = 1.0 - torch.exp(-(grad_diff * 5.0)).detach()
   weight *= nearby_mask
 
-  g_loss = torch.mean(h_gradient * weight) + torch.mean(v_gradient * weight)
+  g_loss = frame_mean(h_gradient * weight, segments) + frame_mean(
+      v_gradient * weight, segments
+  )
   return g_loss
 
 
-def si_loss(gt, pred):
+def si_loss(gt, pred, segments=None):
   log_gt = torch.log(torch.clamp(gt, 1e-3, 1e3)).view(gt.shape[0], -1)
   log_pred = torch.log(torch.clamp(pred, 1e-3, 1e3)).view(pred.shape[0], -1)
   log_diff = log_gt - log_pred
@@ -66,7 +95,7 @@ def si_loss(gt, pred):
   data_loss = torch.sum(log_diff**2, dim=-1) / num_pixels - torch.sum(
       log_diff, dim=-1
   ) ** 2 / (num_pixels**2)
-  return torch.mean(data_loss)
+  return frame_mean(data_loss, segments)
 
 
 def sobel_fg_alpha(disp, mode="sobel", beta=10.0):
@@ -82,7 +111,109 @@ def sobel_fg_alpha(disp, mode="sobel", beta=10.0):
 
 
 ALPHA_MOTION = 0.25
+# resolution of the cached flows relative to the reconstruction
 RESIZE_FACTOR = 0.5
+# steps of the per-frame scale/shift alignment stage
+NUM_ALIGN_STEPS = 100
+
+
+def load_scene_inputs(rootdir, cache_dir, scene_name):
+  """Loads the tracking reconstruction and cached flows of a scene.
+
+  Args:
+    rootdir: directory with the per-scene reconstructions.
+    cache_dir: directory with the per-scene flows from preprocess_flow.py.
+    scene_name: scene to load.
+
+  Returns:
+    Dict of numpy arrays: images [N, 3, H, W] (BGR to RGB flipped), disps
+    [N, H, W], poses [N, 7], motion_prob [N, h, w], flows [P, 2, h, w],
+    flow_masks [P, 1, h, w], ii and jj [P] and the 3x3 intrinsics K.
+  """
+  img_data = np.load(os.path.join(rootdir, scene_name, "images.npy"))[
+      :, ::-1, ...
+  ]
+  disp_data = (
+      np.load(
+          os.path.join(rootdir, scene_name.replace("_opt", ""), "disps.npy")
+      )
+      + 1e-6
+  )
+  intrinsics = np.load(os.path.join(rootdir, scene_name, "intrinsics.npy"))
+  poses = np.load(os.path.join(rootdir, scene_name, "poses.npy"))
+  mot_prob = np.load(os.path.join(rootdir, scene_name, "motion_prob.npy"))
+
+  flows = np.load(
+      "%s/%s/flows.npy" % (cache_dir, scene_name), allow_pickle=True
+  )
+  flow_masks = np.load(
+      "%s/%s/flows_masks.npy" % (cache_dir, scene_name), allow_pickle=True
+  )
+  flow_masks = np.float32(flow_masks)
+  iijj = np.load("%s/%s/ii-jj.npy" % (cache_dir, scene_name), allow_pickle=True)
+
+  intrinsics = intrinsics[0]
+  K = np.eye(3)
+  K[0, 0] = intrinsics[0]
+  K[1, 1] = intrinsics[1]
+  K[0, 2] = intrinsics[2]
+  K[1, 2] = intrinsics[3]
+
+  return {
+      "images": img_data,
+      "disps": disp_data,
+      "poses": poses,
+      "motion_prob": mot_prob,
+      "flows": flows,
+      "flow_masks": flow_masks,
+      "ii": np.int64(iijj[0, ...]),
+      "jj": np.int64(iijj[1, ...]),
+      "K": K,
+  }
+
+
+def save_cvd_output(
+    path,
+    img_data,
+    depths,
+    K,
+    cam_c2w,
+    uncertainty,
+    frames_path,
+    output_format="npz",
+):
+  """Writes the `_sgd_cvd_hr` output read by the evaluation and visualization.
+
+  Args:
+    path: output path without extension.
+    img_data: [N, 3, H, W] RGB frames, only stored by the npz format.
+    depths: [N, H, W] float16 depths.
+    K: [3, 3] intrinsics.
+    cam_c2w: [N, 4, 4] camera-to-world matrices.
+    uncertainty: [N, 1, h, w] optimized uncertainty, kept so that a longer
+      clip can be warm-started with --init_from.
+    frames_path: images.npy the frames were loaded from, referenced by the
+      lean format.
+    output_format: "lean" (see lean_output.py) or "npz".
+  """
+  if output_format == "lean":
+    save_output(
+        path,
+        depths,
+        K.detach().cpu().numpy(),
+        cam_c2w.detach().cpu().numpy(),
+        frames_path,
+        uncertainty=uncertainty.cpu().numpy(),
+    )
+    return
+  np.savez(
+      path + ".npz",
+      images=np.uint8(img_data.transpose(0, 2, 3, 1)),
+      depths=depths,
+      intrinsic=K.detach().cpu().numpy(),
+      cam_c2w=cam_c2w.detach().cpu().numpy(),
+      uncertainty=np.float16(uncertainty.cpu().numpy()),
+  )
 
 
 def consistency_loss(
@@ -103,90 +234,74 @@ def consistency_loss(
     w_si=1.0,
     w_grad=2.0,
     w_normal=4.0,
+    reprojection_fn=reprojection_terms,
+    samples=None,
+    prior_stride=1,
+    segments=None,
 ):
-  """Consistency loss."""
-  _, H, W = disp_data.shape
-  # mesh grid
-  xx = torch.arange(0, W).view(1, -1).repeat(H, 1)
-  yy = torch.arange(0, H).view(-1, 1).repeat(1, W)
-  xx = xx.view(1, 1, H, W)  # .repeat(B ,1 ,1 ,1)
-  yy = yy.view(1, 1, H, W)  # .repeat(B ,1 ,1 ,1)
-  grid = (
-      torch.cat((xx, yy), 1).float().cuda().permute(0, 2, 3, 1)
-  )  # [None, ...]
-
-  loss_flow = 0.0  # flow reprojection loss
-  loss_d_ratio = 0.0  # depth consistency loss
-
-  flows_step = flows.permute(0, 2, 3, 1)
-  flow_masks_step = flow_masks.permute(0, 2, 3, 1).squeeze(-1)
-
-  cam_1to2 = torch.bmm(
-      torch.linalg.inv(torch.index_select(cam_c2w, dim=0, index=jj)),
-      torch.index_select(cam_c2w, dim=0, index=ii),
-  )
-
-  # warp disp from target time
-  pixel_locations = grid + flows_step
-  resize_factor = torch.tensor([W - 1.0, H - 1.0]).cuda()[None, None, None, ...]
-  normalized_pixel_locations = 2 * (pixel_locations / resize_factor) - 1.0
-
-  disp_sampled = torch.nn.functional.grid_sample(
-      torch.index_select(disp_data, dim=0, index=jj)[:, None, ...],
-      normalized_pixel_locations,
-      align_corners=True,
-  )
-
-  uu = torch.index_select(uncertainty, dim=0, index=ii).squeeze(1)
-
-  grid_h = torch.cat([grid, torch.ones_like(grid[..., 0:1])], dim=-1).unsqueeze(
-      -1
-  )
-  # depth of reference view
-  ref_depth = 1.0 / torch.clamp(
-      torch.index_select(disp_data, dim=0, index=ii), 1e-3, 1e3
-  )
-
-  pts_3d_ref = ref_depth[..., None, None] * (K_inv[None, None, None] @ grid_h)
-  rot = cam_1to2[:, None, None, :3, :3]
-  trans = cam_1to2[:, None, None, :3, 3:4]
-
-  pts_3d_tgt = (rot @ pts_3d_ref) + trans  # [:, None, None, :, None]
-  depth_tgt = pts_3d_tgt[:, :, :, 2:3, 0]
-  disp_tgt = 1.0 / torch.clamp(depth_tgt, 0.1, 1e3)
-
-  # flow consistency loss
-  pts_2D_tgt = K[None, None, None] @ pts_3d_tgt
-
-  flow_masks_step_ = flow_masks_step * (pts_2D_tgt[:, :, :, 2, 0] > 0.1)
-  pts_2D_tgt = pts_2D_tgt[:, :, :, :2, 0] / torch.clamp(
-      pts_2D_tgt[:, :, :, 2:, 0], 1e-3, 1e3
-  )
-
-  disp_sampled = torch.clamp(disp_sampled, 1e-3, 1e2)
-  disp_tgt = torch.clamp(disp_tgt, 1e-3, 1e2)
-
-  ratio = torch.maximum(
-      disp_sampled.squeeze() / disp_tgt.squeeze(),
-      disp_tgt.squeeze() / disp_sampled.squeeze(),
-  )
-  ratio_error = torch.abs(ratio - 1.0)  #
-
-  loss_d_ratio += torch.sum(
-      (ratio_error * uu + ALPHA_MOTION * torch.log(1.0 / uu)) * flow_masks_step_
-  ) / (torch.sum(flow_masks_step_) + 1e-8)
+  """Consistency loss.
+
+  With `samples` from loss_kernels.sample_pixels, the reprojection terms are
+  evaluated on those pixels only. With prior_stride > 1, the mono-depth prior
+  terms are evaluated on disparity average-pooled by that stride, and
+  compute_normals and fg_alpha must be at the pooled resolution.
+
+  For scenes packed along the frame and pair axes, K and K_inv are given per
+  frame ([N, 3, 3]) and `segments` is their loss_kernels.PackSegments; the
+  loss is then the [S] vector of the losses of the individual scenes.
+
+  The prior normals only depend on init_disp and K_inv, so they are cached
+  by compute_normals while the caller passes the same tensors. Under
+  torch.compile, predicted and prior normals go through one batched call.
+  """
+  prior_key = (init_disp, K_inv)
+  K_pair, K_inv_pair = K, K_inv
+  if K.dim() == 3:
+    K_pair, K_inv_pair = K[ii], K_inv[ii]
+  if samples is None:
+    loss_d_ratio, loss_flow = reprojection_fn(
+        cam_c2w,
+        K_pair,
+        K_inv_pair,
+        disp_data,
+        uncertainty,
+        flows,
+        flow_masks,
+        ii,
+        jj,
+        ALPHA_MOTION,
+        segments=segments,
+    )
+  else:
+    loss_d_ratio, loss_flow = reprojection_terms_sampled(
+        cam_c2w,
+        K_pair,
+        K_inv_pair,
+        disp_data,
+        uncertainty,
+        flows,
+        flow_masks,
+        ii,
+        jj,
+        ALPHA_MOTION,
+        *samples,
+        segments=segments,
+    )
 
-  flow_error = torch.abs(pts_2D_tgt - pixel_locations)
-  loss_flow += torch.sum(
-      (
-          flow_error * uu[..., None]
-          + ALPHA_MOTION * torch.log(1.0 / uu[..., None])
-      )
-      * flow_masks_step_[..., None]
-  ) / (torch.sum(flow_masks_step_) * 2.0 + 1e-8)
+  if prior_stride > 1:
+    disp_data = torch.nn.functional.avg_pool2d(
+        disp_data[:, None], prior_stride
+    )[:, 0]
+    init_disp = torch.nn.functional.avg_pool2d(
+        init_disp[:, None], prior_stride
+    )[:, 0]
+    uncertainty = torch.nn.functional.avg_pool2d(uncertainty, prior_stride)
+    K_pooled = torch.inverse(K_inv).clone()
+    K_pooled[..., 0:2, :] /= prior_stride
+    K_inv = torch.inverse(K_pooled)
 
   # prior mono-depth reg loss
-  loss_prior = si_loss(init_disp, disp_data)
+  loss_prior = si_loss(init_disp, disp_data, segments)
   KK = torch.inverse(K_inv)
 
   # multi gradient consistency
@@ -194,15 +309,26 @@ def consistency_loss(
   init_disp_ds = init_disp[:, None, ...]
   K_rescale = KK.clone()
   K_inv_rescale = torch.inverse(K_rescale)
-  pred_normal = compute_normals[0](
-      1.0 / torch.clamp(disp_data_ds, 1e-3, 1e3), K_inv_rescale[None]
-  )
-  init_normal = compute_normals[0](
-      1.0 / torch.clamp(init_disp_ds, 1e-3, 1e3), K_inv_rescale[None]
-  )
+  if K_inv_rescale.dim() == 2:
+    K_inv_rescale = K_inv_rescale[None]
+  normal_generator = compute_normals[0]
+  pred_depth = 1.0 / torch.clamp(disp_data_ds, 1e-3, 1e3)
+  init_depth_fn = lambda: 1.0 / torch.clamp(init_disp_ds, 1e-3, 1e3)
+  if is_compiling():
+    pred_normal, init_normal = normal_generator(
+        torch.cat([pred_depth, init_depth_fn()]),
+        K_inv_rescale.repeat(2 if K_inv_rescale.shape[0] > 1 else 1, 1, 1),
+    ).chunk(2)
+  else:
+    pred_normal = normal_generator(pred_depth, K_inv_rescale)
+    init_normal = normal_generator.cached(
+        prior_key,
+        lambda: normal_generator(init_depth_fn(), K_inv_rescale),
+    )
 
-  loss_normal = torch.mean(
-      fg_alpha * (1.0 - torch.sum(pred_normal * init_normal, dim=1))
+  loss_normal = frame_mean(
+      fg_alpha * (1.0 - torch.sum(pred_normal * init_normal, dim=1)),
+      segments,
   )  # / (1e-8 + torch.sum(fg_alpha))
 
   loss_grad = 0.0
@@ -224,7 +350,10 @@ def consistency_loss(
         mode="nearest-exact",
     )
     loss_grad += gradient_loss(
-        torch.log(disp_data_ds), torch.log(init_disp_ds), uncertainty_rs
+        torch.log(disp_data_ds),
+        torch.log(init_disp_ds),
+        uncertainty_rs,
+        segments,
     )
 
   return (
@@ -235,6 +364,272 @@ def consistency_loss(
       + loss_grad * w_grad
   )
 
+
+def parse_schedule(schedule):
+  """Parses a "scale:steps,scale:steps" string into [(scale, steps), ...]."""
+  levels = []
+  for level in schedule.split(","):
+    scale, steps = level.split(":")
+    levels.append((float(scale), int(steps)))
+  if not levels or any(s <= 0 or s > 1 for s, _ in levels):
+    raise ValueError("Invalid CVD schedule: %s" % schedule)
+  return levels
+
+
+def annealed_sample_rate(step, num_steps, rate, anneal_start=0.5):
+  """Pixel sampling rate for `step` of a `num_steps` optimization.
+
+  The rate stays at `rate` for the first anneal_start of the steps, then
+  doubles at equal intervals so that the last interval is dense. Doubling
+  keeps the number of distinct sample counts, and thus of torch.compile
+  shapes, logarithmic in 1 / rate.
+
+  Args:
+    step: current step.
+    num_steps: number of steps of the stage.
+    rate: initial fraction of sampled pixels.
+    anneal_start: fraction of the steps after which the rate increases.
+
+  Returns:
+    Sampling rate; 1.0 means dense.
+  """
+  if rate >= 1.0:
+    return 1.0
+  progress = (step / num_steps - anneal_start) / (1.0 - anneal_start)
+  if progress < 0:
+    return rate
+  num_doublings = math.ceil(math.log2(1.0 / rate))
+  return min(1.0, rate * 2 ** math.floor(progress * (num_doublings + 1)))
+
+
+def resize_maps(maps, size):
+  """Bilinearly resizes [N, H, W] or [N, C, H, W] maps to size=(h, w)."""
+  if tuple(maps.shape[-2:]) == tuple(size):
+    return maps
+  squeeze = maps.dim() == 3
+  if squeeze:
+    maps = maps.unsqueeze(1)
+  maps = torch.nn.functional.interpolate(maps, size=size, mode="bilinear")
+  return maps.squeeze(1) if squeeze else maps
+
+
+def resize_flows(flows, flow_masks, scale):
+  """Resamples pair flows and masks by `scale`, rescaling flow vectors.
+
+  Masks are downsampled conservatively: a coarse pixel is valid only if all
+  the fine pixels it covers are valid.
+
+  Args:
+    flows: [P, 2, H, W] flows in pixels.
+    flow_masks: [P, 1, H, W] flow validity masks.
+    scale: resampling factor.
+
+  Returns:
+    Resampled flows and masks.
+  """
+  if scale == 1.0:
+    return flows, flow_masks
+  size = (
+      int(round(flows.shape[-2] * scale)),
+      int(round(flows.shape[-1] * scale)),
+  )
+  # resampled in fp32, float16 bilinear is not available on every device
+  flows = (
+      torch.nn.functional.interpolate(
+          flows.float(), size=size, mode="bilinear"
+      )
+      * torch.tensor(
+          [size[1] / flows.shape[-1], size[0] / flows.shape[-2]],
+          device=flows.device,
+      ).view(1, 2, 1, 1)
+  ).to(flows.dtype)
+  if scale < 1.0:
+    flow_masks = (
+        torch.nn.functional.interpolate(flow_masks, size=size, mode="area")
+        > 0.999
+    ).float()
+  else:
+    flow_masks = torch.nn.functional.interpolate(
+        flow_masks, size=size, mode="nearest-exact"
+    )
+  return flows, flow_masks
+
+
+def motion_uncertainty(mot_prob, size, device):
+  """Initial uncertainty [N, 1, h, w] from the tracker's motion probability."""
+  cvd_prob = torch.nn.functional.interpolate(
+      torch.from_numpy(mot_prob).unsqueeze(1).to(device),
+      size=size,
+      mode="bilinear",
+  )
+  cvd_prob[cvd_prob > 0.5] = 0.5
+  return torch.clamp(cvd_prob, 1e-3, 1.0)
+
+
+def flows_to_device(flows, flow_masks, device, amp):
+  """Uploads cached flows and masks in the optimization precision."""
+  flows = amp.cast_flows(
+      torch.from_numpy(np.ascontiguousarray(flows)).to(device)
+  )
+  flow_masks = amp.cast(
+      torch.from_numpy(np.ascontiguousarray(flow_masks)).to(device)
+  )
+  if device.type == "cpu":
+    # consistency_loss reads flows and masks as NHWC; storing them
+    # channels-last makes those permutes free on CPU.
+    flows = flows.contiguous(memory_format=torch.channels_last)
+    flow_masks = flow_masks.contiguous(memory_format=torch.channels_last)
+  return flows, flow_masks
+
+
+def level_inputs(
+    init_disp_hr, flows, flow_masks, K_o, scale, prior_stride, device
+):
+  """Resamples the inputs of a scene for optimization at `scale`.
+
+  Args:
+    init_disp_hr: [N, H0, W0] mono-depth disparity at input resolution.
+    flows: [P, 2, h, w] cached flows at RESIZE_FACTOR of the input.
+    flow_masks: [P, 1, h, w] cached flow masks.
+    K_o: [3, 3] intrinsics at input resolution.
+    scale: level resolution relative to the input.
+    prior_stride: pooling stride of the prior terms, see consistency_loss.
+    device: torch device.
+
+  Returns:
+    Dict with the level size, init_disp, fg_alpha, flows, flow_masks, K,
+    K_inv and compute_normals.
+  """
+  size = (
+      int(round(init_disp_hr.shape[-2] * scale)),
+      int(round(init_disp_hr.shape[-1] * scale)),
+  )
+  init_disp = resize_maps(init_disp_hr, size)
+  # the prior terms (and so fg_alpha and normals) run at prior_size
+  init_disp_prior = torch.nn.functional.avg_pool2d(
+      init_disp[:, None, ...], prior_stride
+  )
+  prior_size = init_disp_prior.shape[-2:]
+  fg_alpha = sobel_fg_alpha(init_disp_prior) > 0.2
+  fg_alpha = fg_alpha.squeeze(1).float() + 0.2
+  flows_l, flow_masks_l = resize_flows(
+      flows, flow_masks, scale / RESIZE_FACTOR
+  )
+  # rescale intrinsic matrix to the level resolution
+  K = K_o.clone()
+  K[0:2, ...] *= scale
+  K_inv = torch.linalg.inv(K)
+  return {
+      "size": size,
+      "init_disp": init_disp,
+      "fg_alpha": fg_alpha,
+      "flows": flows_l,
+      "flow_masks": flow_masks_l,
+      "K": K,
+      "K_inv": K_inv,
+      "compute_normals": [
+          NormalGenerator(prior_size[0], prior_size[1]).to(device)
+      ],
+  }
+
+
+def setup_device(device, num_threads=0):
+  """Resolves the optimization device and applies CPU-specific tuning."""
+  device = torch.device(device)
+  if device.type == "cuda" and not torch.cuda.is_available():
+    raise ValueError("CUDA device requested but CUDA is not available.")
+  if device.type == "cpu" and num_threads > 0:
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(max(1, num_threads // 4))
+  return device
+
+
+PRECISIONS = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def _zero_nan_grad(grad):
+  return torch.nan_to_num(grad, nan=0.0)
+
+
+class MixedPrecision:
+  """Autocast, loss scaling and NaN-gradient policy for CVD optimization.
+
+  Masks are stored in the reduced dtype and the normal/gradient terms run
+  under autocast. Flows keep float16 storage (as in flows.npy) but are never
+  rounded to bf16, whose 8-bit mantissa would quantize large flows to
+  fractions of a pixel. The reprojection geometry stays in fp32 (see
+  loss_kernels.py). fp16 uses dynamic loss scaling: gradients are left
+  untouched, so that the scaler sees every inf and NaN of an overflow, skips
+  the step and lowers the scale. In fp32 and bf16, NaN gradients are zeroed
+  by hooks as they are produced, replacing the per-step nan_to_num calls.
+  """
+
+  def __init__(self, precision, device):
+    self.dtype = PRECISIONS[precision]
+    self.device_type = device.type
+    self.enabled = self.dtype != torch.float32
+    if self.dtype == torch.float16 and device.type != "cuda":
+      raise ValueError("fp16 CVD optimization requires a CUDA device.")
+    self.scaler = torch.amp.GradScaler(
+        "cuda", enabled=self.dtype == torch.float16
+    )
+
+  def autocast(self):
+    if not self.enabled:
+      return contextlib.nullcontext()
+    return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+  def cast(self, tensor):
+    """Casts stored inputs (flow masks) to the reduced dtype."""
+    return tensor.to(self.dtype) if self.enabled else tensor
+
+  def cast_flows(self, tensor):
+    """float16 flows as stored in reduced precision, otherwise fp32."""
+    if self.enabled and tensor.dtype == torch.float16:
+      return tensor
+    return tensor.float()
+
+  def watch(self, params):
+    """Registers NaN-zeroing gradient hooks on params, unless loss scaling.
+
+    With loss scaling, NaN gradients must reach GradScaler.unscale_ so that
+    the overflowing step is skipped.
+    """
+    if self.scaler.is_enabled():
+      return
+    for param in params:
+      param.register_hook(_zero_nan_grad)
+
+  def step(self, loss, optim):
+    """Backpropagates loss and steps optim, with loss scaling if enabled."""
+    self.scaler.scale(loss).backward()
+    self.scaler.step(optim)
+    self.scaler.update()
+
+
+def restore_state(state, params, optim, amp):
+  """Loads checkpointed parameters, optimizer and grad-scaler state."""
+  with torch.no_grad():
+    for name, param in params.items():
+      param.copy_(state["params"][name])
+  optim.load_state_dict(state["optim"])
+  amp.scaler.load_state_dict(state["scaler"])
+
+
+def maybe_compile(loss_fn, enabled):
+  """Wraps loss_fn with torch.compile when requested and supported."""
+  if not enabled:
+    return loss_fn
+  if not hasattr(torch, "compile"):
+    print("torch.compile is not available, running the eager loss")
+    return loss_fn
+  return torch.compile(loss_fn, dynamic=False)
+
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("--w_grad", type=float, default=2.0, help="w_grad")
@@ -243,8 +638,118 @@ if __name__ == "__main__":
       "--output_dir", type=str, default="outputs_cvd", help="outputs direcotry"
   )
   parser.add_argument("--scene_name", type=str, help="scene name")
+  parser.add_argument(
+      "--output_format",
+      type=str,
+      default="npz",
+      choices=["lean", "npz"],
+      help=(
+          "lean references the frames instead of copying them; opt-in, only"
+          " readers using lean_output.load_output understand it"
+      ),
+  )
+  parser.add_argument(
+      "--device", type=str, default="cuda", help="optimization device"
+  )
+  parser.add_argument(
+      "--num_threads",
+      type=int,
+      default=0,
+      help="intra-op threads for CPU runs (0 keeps the torch default)",
+  )
+  parser.add_argument(
+      "--compile", action="store_true", help="torch.compile the CVD loss"
+  )
+  parser.add_argument(
+      "--fused_loss",
+      action="store_true",
+      help="use the fused closed-form reprojection terms",
+  )
+  parser.add_argument(
+      "--precision",
+      type=str,
+      default="fp32",
+      choices=sorted(PRECISIONS),
+      help="reduced-precision mode for flow masks and the normal/gradient terms",
+  )
+  parser.add_argument(
+      "--schedule",
+      type=str,
+      default="0.5:400",
+      help=(
+          "depth optimization levels as scale:steps relative to the input"
+          " resolution, e.g. 0.25:300,0.5:60 or 0.25:300,0.5:60,1.0:40 for"
+          " full-resolution output"
+      ),
+  )
+  parser.add_argument(
+      "--init_from",
+      type=str,
+      default="",
+      help=(
+          "previous _sgd_cvd_hr output (lean directory or npz) of a shorter"
+          " clip; only the appended frames and their flow-pair"
+          " neighbourhood are re-optimized"
+      ),
+  )
+  parser.add_argument(
+      "--boundary_band",
+      type=int,
+      default=0,
+      help="extra previous frames to re-optimize with --init_from",
+  )
+  parser.add_argument(
+      "--checkpoint_steps",
+      type=int,
+      default=0,
+      help="checkpoint the optimization state every N steps (0 disables)",
+  )
+  parser.add_argument(
+      "--checkpoint_secs",
+      type=float,
+      default=0.0,
+      help="checkpoint the optimization state every T seconds (0 disables)",
+  )
+  parser.add_argument(
+      "--resume",
+      action="store_true",
+      help="continue from the scene's checkpoint in output_dir if present",
+  )
+  parser.add_argument(
+      "--sample_rate",
+      type=float,
+      default=1.0,
+      help=(
+          "fraction of pixels per pair for the reprojection terms, annealed"
+          " to dense over the second half of each stage (1.0 is dense)"
+      ),
+  )
+  parser.add_argument(
+      "--sample_mode",
+      type=str,
+      default="stratified",
+      choices=["stratified", "uncertainty"],
+  )
+  parser.add_argument(
+      "--prior_stride",
+      type=int,
+      default=1,
+      help="average-pool the mono-depth prior terms by this stride",
+  )
 
   args = parser.parse_args()
+  device = setup_device(args.device, args.num_threads)
+  amp = MixedPrecision(args.precision, device)
+  # when the whole loss is compiled the fused terms are traced inline
+  loss_fn = maybe_compile(
+      functools.partial(
+          consistency_loss,
+          reprojection_fn=get_reprojection_fn(
+              args.fused_loss, compile_kernel=not args.compile
+          ),
+      ),
+      args.compile,
+  )
 
   cache_dir = "./cache_flow"
   rootdir = os.getcwd() + "/reconstructions"
@@ -252,83 +757,127 @@ if __name__ == "__main__":
   output_dir = args.output_dir
   scene_name = args.scene_name
   print("***************************** ", scene_name)
-  img_data = np.load(os.path.join(rootdir, scene_name, "images.npy"))[
-      :, ::-1, ...
-  ]
-  disp_data = (
-      np.load(
-          os.path.join(rootdir, scene_name.replace("_opt", ""), "disps.npy")
-      )
-      + 1e-6
-  )
-  intrinsics = np.load(os.path.join(rootdir, scene_name, "intrinsics.npy"))
-  poses = np.load(os.path.join(rootdir, scene_name, "poses.npy"))
-  mot_prob = np.load(os.path.join(rootdir, scene_name, "motion_prob.npy"))
-
-  flows = np.load(
-      "%s/%s/flows.npy" % (cache_dir, scene_name), allow_pickle=True
-  )
-  flow_masks = np.load(
-      "%s/%s/flows_masks.npy" % (cache_dir, scene_name), allow_pickle=True
-  )
-  flow_masks = np.float32(flow_masks)
-  iijj = np.load("%s/%s/ii-jj.npy" % (cache_dir, scene_name), allow_pickle=True)
-
-  intrinsics = intrinsics[0]
-  poses_th = torch.as_tensor(poses, device="cpu").float().cuda()
-
-  K = np.eye(3)
-  K[0, 0] = intrinsics[0]
-  K[1, 1] = intrinsics[1]
-  K[0, 2] = intrinsics[2]
-  K[1, 2] = intrinsics[3]
-
-  img_data_pt = (
-      torch.from_numpy(np.ascontiguousarray(img_data)).float().cuda() / 255.0
+  Path(output_dir).mkdir(parents=True, exist_ok=True)
+  # a checkpoint only resumes a run with the same optimization problem
+  ckpt = Checkpointer(
+      "%s/%s_cvd_ckpt.pt" % (output_dir, scene_name),
+      args.checkpoint_steps,
+      args.checkpoint_secs,
+      config={
+          key: getattr(args, key)
+          for key in (
+              "w_grad",
+              "w_normal",
+              "precision",
+              "schedule",
+              "init_from",
+              "boundary_band",
+              "prior_stride",
+              "sample_rate",
+              "sample_mode",
+              "fused_loss",
+              "compile",
+          )
+      },
   )
-  flows = torch.from_numpy(np.ascontiguousarray(flows)).float().cuda()
-  flow_masks = (
-      torch.from_numpy(np.ascontiguousarray(flow_masks)).float().cuda()
-  )  # .unsqueeze(1)
-  iijj = torch.from_numpy(np.ascontiguousarray(iijj)).float().cuda()
-  ii = iijj[0, ...].long()
-  jj = iijj[1, ...].long()
-  K = torch.from_numpy(K).float().cuda()
+  state = ckpt.load(device) if args.resume else None
+  resume_stage = state["position"]["stage"] if state else None
+  inputs = load_scene_inputs(rootdir, cache_dir, scene_name)
+  img_data = inputs["images"]
+  disp_data = inputs["disps"]
+  poses = inputs["poses"]
+  mot_prob = inputs["motion_prob"]
+  flows = inputs["flows"]
+  flow_masks = inputs["flow_masks"]
+  K = inputs["K"]
+  poses_th = torch.as_tensor(poses, device="cpu").float().to(device)
+
+  ii = torch.from_numpy(inputs["ii"])
+  jj = torch.from_numpy(inputs["jj"])
+  num_frames = disp_data.shape[0]
+  mot_prob_all = mot_prob
+
+  if args.init_from:
+    prev_depths, prev_uncertainty = load_previous_solution(args.init_from)
+    num_prev = prev_depths.shape[0]
+    if prev_depths.shape[1:] != disp_data.shape[1:]:
+      raise ValueError(
+          "%s has depths of shape %s, expected %s."
+          % (args.init_from, prev_depths.shape[1:], disp_data.shape[1:])
+      )
+    plan = plan_incremental(num_prev, num_frames, ii, jj, args.boundary_band)
+    # the previous solution is both the warm start and the prior of old frames
+    disp_data[:num_prev] = 1.0 / prev_depths
+    frames = plan.frames.numpy()
+    disp_data = disp_data[frames]
+    poses_th = poses_th[plan.frames.to(device)]
+    mot_prob = mot_prob[frames]
+    flows = flows[plan.pairs.numpy()]
+    flow_masks = flow_masks[plan.pairs.numpy()]
+    ii, jj = plan.ii, plan.jj
+    active = plan.active.to(device)
+    is_new = plan.is_new.to(device)
+    print(
+        "incremental: %d new frames, optimizing %d, %d frozen, %d pairs"
+        % (
+            num_frames - num_prev,
+            active.sum().item(),
+            (~active).sum().item(),
+            ii.shape[0],
+        )
+    )
 
-  init_disp = torch.from_numpy(disp_data).float().cuda()
-  disp_data = torch.from_numpy(disp_data).float().cuda()
+  flows, flow_masks = flows_to_device(flows, flow_masks, device, amp)
+  ii = ii.to(device)
+  jj = jj.to(device)
+  K = torch.from_numpy(K).float().to(device)
 
-  assert init_disp.shape == disp_data.shape
+  init_disp_hr = torch.from_numpy(disp_data).float().to(device)
+  H0, W0 = init_disp_hr.shape[-2:]
+  K_o = K.clone()
 
-  init_disp = torch.nn.functional.interpolate(
-      init_disp.unsqueeze(1),
-      scale_factor=(RESIZE_FACTOR, RESIZE_FACTOR),
-      mode="bilinear",
-  ).squeeze(1)
-  disp_data = torch.nn.functional.interpolate(
-      disp_data.unsqueeze(1),
-      scale_factor=(RESIZE_FACTOR, RESIZE_FACTOR),
-      mode="bilinear",
-  ).squeeze(1)
+  levels = parse_schedule(args.schedule)
+  poses_th.requires_grad = False
 
-  fg_alpha = sobel_fg_alpha(init_disp[:, None, ...]) > 0.2
-  fg_alpha = fg_alpha.squeeze(1).float() + 0.2
+  # poses are fixed during CVD, so the camera matrices are constant
+  cam_c2w = SE3(poses_th).inv().matrix()
+
+  def draw_samples(step, num_steps, uncertainty):
+    """Draws the reprojection pixels for `step`, or None when dense."""
+    rate = annealed_sample_rate(step, num_steps, args.sample_rate)
+    if rate >= 1.0:
+      return None
+    return sample_pixels(
+        lv["flow_masks"],
+        torch.clamp(uncertainty.detach(), 1e-4, 1e3),
+        ii,
+        rate,
+        args.sample_mode,
+    )
 
-  cvd_prob = torch.nn.functional.interpolate(
-      torch.from_numpy(mot_prob).unsqueeze(1).cuda(),
-      scale_factor=(4, 4),
-      mode="bilinear",
+  lv = level_inputs(
+      init_disp_hr,
+      flows,
+      flow_masks,
+      K_o,
+      levels[0][0],
+      args.prior_stride,
+      device,
   )
-  cvd_prob[cvd_prob > 0.5] = 0.5
-  cvd_prob = torch.clamp(cvd_prob, 1e-3, 1.0)
-
-  # rescale intrinsic matrix to small resolution
-  K_o = K.clone()
-  K[0:2, ...] *= RESIZE_FACTOR
-  K_inv = torch.linalg.inv(K)
+  init_disp = lv["init_disp"]
+  disp_data = init_disp.clone()
+
+  cvd_prob = motion_uncertainty(mot_prob, lv["size"], device)
+  if args.init_from and prev_uncertainty is not None:
+    old = ~plan.is_new
+    cvd_prob[old.to(device)] = resize_maps(
+        torch.from_numpy(prev_uncertainty[plan.frames[old].numpy()]).to(
+            device
+        ),
+        lv["size"],
+    )
 
   disp_data.requires_grad = False
-  poses_th.requires_grad = False
 
   uncertainty = cvd_prob
 
@@ -344,114 +893,200 @@ if __name__ == "__main__":
       {"params": shift_, "lr": 1e-2},
       {"params": uncertainty, "lr": 1e-2},
   ])
+  amp.watch([log_scale_, shift_, uncertainty])
+  if args.init_from:
+    # previous frames are already aligned; frozen ones keep their uncertainty
+    freeze_frames(log_scale_, is_new)
+    freeze_frames(shift_, is_new)
+    freeze_frames(uncertainty, active)
 
-  compute_normals = []
-  compute_normals.append(
-      NormalGenerator(disp_data.shape[-2], disp_data.shape[-1])
-  )
   init_disp = torch.clamp(init_disp, 1e-3, 1e3)
 
-  for i in range(100):
-    optim.zero_grad()
-    cam_c2w = SE3(poses_th).inv().matrix()
-    scale_ = torch.exp(log_scale_)
-
-    loss = consistency_loss(
-        cam_c2w,
-        K,
-        K_inv,
-        torch.clamp(
-            disp_data * scale_[..., None, None] + shift_[..., None, None],
-            1e-3,
-            1e3,
-        ),
-        init_disp,
-        torch.clamp(uncertainty, 1e-4, 1e3),
-        flows,
-        flow_masks,
-        ii,
-        jj,
-        compute_normals,
-        fg_alpha,
+  def align_state(step):
+    return {
+        "position": {"stage": "align", "level": 0, "step": step},
+        "params": {
+            "log_scale": log_scale_.detach(),
+            "shift": shift_.detach(),
+            "uncertainty": uncertainty.detach(),
+        },
+        "optim": optim.state_dict(),
+        "scaler": amp.scaler.state_dict(),
+    }
+
+  first_step = 0
+  num_align_steps = 0 if resume_stage == "depth" else NUM_ALIGN_STEPS
+  if resume_stage == "align":
+    restore_state(
+        state,
+        {"log_scale": log_scale_, "shift": shift_, "uncertainty": uncertainty},
+        optim,
+        amp,
     )
+    first_step = state["position"]["step"]
 
-    loss.backward()
-    uncertainty.grad = torch.nan_to_num(uncertainty.grad, nan=0.0)
-    log_scale_.grad = torch.nan_to_num(log_scale_.grad, nan=0.0)
-    shift_.grad = torch.nan_to_num(shift_.grad, nan=0.0)
-
-    optim.step()
-    print("step ", i, loss.item())
-
-  # Then optimize depth and uncertainty
-  disp_data = (
-      disp_data * torch.exp(log_scale_)[..., None, None].detach()
-      + shift_[..., None, None].detach()
-  )
-  init_disp = (
-      init_disp * torch.exp(log_scale_)[..., None, None].detach()
-      + shift_[..., None, None].detach()
-  )
-  init_disp = torch.clamp(init_disp, 1e-3, 1e3)
-
-  disp_data.requires_grad = True
-  uncertainty.requires_grad = True
-  poses_th.requires_grad = False  # True
-
-  optim = torch.optim.Adam([
-      {"params": disp_data, "lr": 5e-3},
-      {"params": uncertainty, "lr": 5e-3},
-  ])
-
-  losses = []
-  for i in range(400):
+  for i in range(first_step, num_align_steps):
     optim.zero_grad()
-    cam_c2w = SE3(poses_th).inv().matrix()
-    loss = consistency_loss(
-        cam_c2w,
-        K,
-        K_inv,
-        torch.clamp(disp_data, 1e-3, 1e3),
-        init_disp,
-        torch.clamp(uncertainty, 1e-4, 1e3),
-        flows,
-        flow_masks,
-        ii,
-        jj,
-        compute_normals,
-        fg_alpha,
-        w_ratio=1.0,
-        w_flow=0.2,
-        w_si=1,
-        w_grad=args.w_grad,
-        w_normal=args.w_normal,
-    )
+    scale_ = torch.exp(log_scale_)
 
-    loss.backward()
-    disp_data.grad = torch.nan_to_num(disp_data.grad, nan=0.0)
-    uncertainty.grad = torch.nan_to_num(uncertainty.grad, nan=0.0)
+    with amp.autocast():
+      loss = loss_fn(
+          cam_c2w,
+          lv["K"],
+          lv["K_inv"],
+          torch.clamp(
+              disp_data * scale_[..., None, None] + shift_[..., None, None],
+              1e-3,
+              1e3,
+          ),
+          init_disp,
+          torch.clamp(uncertainty, 1e-4, 1e3),
+          lv["flows"],
+          lv["flow_masks"],
+          ii,
+          jj,
+          lv["compute_normals"],
+          lv["fg_alpha"],
+          samples=draw_samples(i, num_align_steps, uncertainty),
+          prior_stride=args.prior_stride,
+      )
 
-    optim.step()
+    amp.step(loss, optim)
     print("step ", i, loss.item())
-    losses.append(loss)
-
-  disp_data_opt = (
-      torch.nn.functional.interpolate(
-          disp_data.unsqueeze(1), scale_factor=(2, 2), mode="bilinear"
+    ckpt.step(lambda: align_state(i + 1))
+
+  # Then optimize depth and uncertainty, coarse to fine
+  if resume_stage == "depth":
+    align_scale = state["align_scale"]
+    align_shift = state["align_shift"]
+    first_level = state["position"]["level"]
+  else:
+    align_scale = torch.exp(log_scale_)[..., None, None].detach()
+    align_shift = shift_[..., None, None].detach()
+    first_level = 0
+  disp_data = disp_data * align_scale + align_shift
+  uncertainty = uncertainty.detach()
+
+  def depth_state(level, step):
+    return {
+        "position": {"stage": "depth", "level": level, "step": step},
+        "params": {
+            "disp": disp_data.detach(),
+            "uncertainty": uncertainty.detach(),
+        },
+        "optim": optim.state_dict(),
+        "scaler": amp.scaler.state_dict(),
+        "align_scale": align_scale,
+        "align_shift": align_shift,
+    }
+
+  for level, (scale, num_steps) in enumerate(levels):
+    if level < first_level:
+      continue
+    if level > 0:
+      lv = level_inputs(
+          init_disp_hr,
+          flows,
+          flow_masks,
+          K_o,
+          scale,
+          args.prior_stride,
+          device,
       )
-      .squeeze(1)
-      .detach()
-      .cpu()
-      .numpy()
-  )
+      init_disp = torch.clamp(lv["init_disp"], 1e-3, 1e3)
+      disp_data = resize_maps(disp_data.detach(), lv["size"])
+      uncertainty = resize_maps(uncertainty.detach(), lv["size"])
+    print("level ", level, " scale ", scale, " size ", lv["size"])
+
+    init_disp = init_disp * align_scale + align_shift
+    init_disp = torch.clamp(init_disp, 1e-3, 1e3)
+
+    disp_data.requires_grad = True
+    uncertainty.requires_grad = True
+
+    optim = torch.optim.Adam([
+        {"params": disp_data, "lr": 5e-3},
+        {"params": uncertainty, "lr": 5e-3},
+    ])
+    amp.watch([disp_data, uncertainty])
+    if args.init_from:
+      freeze_frames(disp_data, active)
+      freeze_frames(uncertainty, active)
+
+    first_step = 0
+    if resume_stage == "depth" and level == first_level:
+      restore_state(
+          state, {"disp": disp_data, "uncertainty": uncertainty}, optim, amp
+      )
+      first_step = state["position"]["step"]
+
+    for i in range(first_step, num_steps):
+      optim.zero_grad()
+      with amp.autocast():
+        loss = loss_fn(
+            cam_c2w,
+            lv["K"],
+            lv["K_inv"],
+            torch.clamp(disp_data, 1e-3, 1e3),
+            init_disp,
+            torch.clamp(uncertainty, 1e-4, 1e3),
+            lv["flows"],
+            lv["flow_masks"],
+            ii,
+            jj,
+            lv["compute_normals"],
+            lv["fg_alpha"],
+            w_ratio=1.0,
+            w_flow=0.2,
+            w_si=1,
+            w_grad=args.w_grad,
+            w_normal=args.w_normal,
+            samples=draw_samples(i, num_steps, uncertainty),
+            prior_stride=args.prior_stride,
+        )
+
+      amp.step(loss, optim)
+      print("step ", i, loss.item())
+      ckpt.step(lambda: depth_state(level, i + 1))
+
+  disp_data_opt = resize_maps(disp_data.detach(), (H0, W0)).cpu().numpy()
+  depths = np.clip(np.float16(1.0 / disp_data_opt), 1e-3, 1e2)
+  uncertainty = uncertainty.detach()
 
   # poses_ = poses_th.detach().cpu().numpy()
 
-  Path(output_dir).mkdir(parents=True, exist_ok=True)
-  np.savez(
-      "%s/%s_sgd_cvd_hr.npz" % (output_dir, scene_name),
-      images=np.uint8(img_data_pt.cpu().numpy().transpose(0, 2, 3, 1) * 255.0),
-      depths=np.clip(np.float16(1.0 / disp_data_opt), 1e-3, 1e2),
-      intrinsic=K_o.detach().cpu().numpy(),
-      cam_c2w=cam_c2w.detach().cpu().numpy(),
+  if args.init_from:
+    # frames outside the optimized band keep their previous solution
+    optimized = plan.frames[plan.active].numpy()
+    depths_all = np.empty((num_frames, H0, W0), dtype=np.float16)
+    depths_all[:num_prev] = prev_depths
+    depths_all[optimized] = depths[plan.active.numpy()]
+    depths = depths_all
+
+    uncertainty_all = motion_uncertainty(
+        mot_prob_all, uncertainty.shape[-2:], device
+    )
+    if prev_uncertainty is not None:
+      uncertainty_all[:num_prev] = resize_maps(
+          torch.from_numpy(prev_uncertainty).to(device),
+          uncertainty.shape[-2:],
+      )
+    uncertainty_all[torch.from_numpy(optimized).to(device)] = uncertainty[
+        active
+    ]
+    uncertainty = uncertainty_all
+    cam_c2w = SE3(
+        torch.as_tensor(poses, device="cpu").float().to(device)
+    ).inv().matrix()
+
+  save_cvd_output(
+      "%s/%s_sgd_cvd_hr" % (output_dir, scene_name),
+      img_data,
+      depths,
+      K_o,
+      cam_c2w,
+      uncertainty,
+      os.path.join(rootdir, scene_name, "images.npy"),
+      args.output_format,
   )
+  ckpt.remove()
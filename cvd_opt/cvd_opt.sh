@@ -19,6 +19,8 @@
 #   bash cvd_opt.sh sintel
 #   bash cvd_opt.sh dycheck
 #   bash cvd_opt.sh demo
+#   BATCH=1 bash cvd_opt.sh sintel   # 多场景打包优化
+#   STRIDE=2 bash cvd_opt.sh sintel  # 跟踪时使用了 --stride 2 (未加 --keep_skipped)
 
 # 获取脚本所在目录
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
@@ -84,7 +86,8 @@ for seq in ${evalset[@]}; do
   CUDA_VISIBLE_DEVICES=0 python "$PROJECT_ROOT/cvd_opt/preprocess_flow.py" \
     --datapath="$IMG_PATH" \
     --model="$PROJECT_ROOT/cvd_opt/raft-things.pth" \
-    --scene_name $seq --mixed_precision
+    --scene_name $seq --mixed_precision \
+    --stride ${STRIDE:-1}
 done
 
 echo ""
@@ -93,14 +96,29 @@ echo "2. CVD 深度优化..."
 echo "----------------------------------------"
 
 # Run CVD optimization
-for seq in ${evalset[@]}; do
-  echo "优化场景: $seq"
-  CUDA_VISIBLE_DEVICES=0 python "$PROJECT_ROOT/cvd_opt/cvd_opt.py" \
-    --scene_name $seq \
+# BATCH=1 时在同一进程中打包优化所有场景 (cvd_opt_batch.py)
+CVD_START=$SECONDS
+if [ "${BATCH:-0}" = "1" ]; then
+  CUDA_VISIBLE_DEVICES=0 python "$PROJECT_ROOT/cvd_opt/cvd_opt_batch.py" \
+    --scene_names "$(IFS=,; echo "${evalset[*]}")" \
     --output_dir $OUTPUT_DIR \
     --w_grad 2.0 \
     --w_normal 5.0
-done
+else
+  for seq in ${evalset[@]}; do
+    echo "优化场景: $seq"
+    CUDA_VISIBLE_DEVICES=0 python "$PROJECT_ROOT/cvd_opt/cvd_opt.py" \
+      --scene_name $seq \
+      --output_dir $OUTPUT_DIR \
+      --w_grad 2.0 \
+      --w_normal 5.0
+  done
+fi
+CVD_SECONDS=$((SECONDS - CVD_START))
+if [ $CVD_SECONDS -gt 0 ]; then
+  echo "CVD 吞吐: ${#evalset[@]} 个场景 / ${CVD_SECONDS} 秒" \
+    "= $((${#evalset[@]} * 3600 / CVD_SECONDS)) scenes/hour"
+fi
 
 echo ""
 echo "========================================"
@@ -0,0 +1,476 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Consistent video depth optimization of several scenes in one process.
+
+Scenes of equal resolution are packed into one problem: their frames, pairs,
+flows and priors are concatenated along the frame and pair axes, with the
+intrinsics given per frame and the pair indices offset into the packed frames,
+so every step runs each loss kernel once over the whole pack at a larger
+size. The masked means are taken per scene (loss_kernels.PackSegments), and
+the sum of the per-scene losses goes through one backward pass and one Adam
+step whose parameter groups belong to the individual scenes. Each scene thus
+gets the gradients of a cvd_opt.py run, and the host syncs once per
+--check_every steps instead of every step. A scene whose loss stops improving
+(--tol) is removed from the pack for the rest of the current stage, and every
+scene is written to its own output.
+
+Example:
+  python cvd_opt/cvd_opt_batch.py --scene_names swing,breakdance-flare \\
+      --output_dir outputs_cvd_demo --w_grad 2.0 --w_normal 5.0
+"""
+
+# pylint: disable=invalid-name
+# pylint: disable=g-importing-member
+
+import argparse
+import functools
+import os
+from pathlib import Path
+import time
+
+from cvd_opt import annealed_sample_rate
+from cvd_opt import consistency_loss
+from cvd_opt import flows_to_device
+from cvd_opt import level_inputs
+from cvd_opt import load_scene_inputs
+from cvd_opt import maybe_compile
+from cvd_opt import MixedPrecision
+from cvd_opt import motion_uncertainty
+from cvd_opt import NUM_ALIGN_STEPS
+from cvd_opt import parse_schedule
+from cvd_opt import PRECISIONS
+from cvd_opt import resize_maps
+from cvd_opt import save_cvd_output
+from cvd_opt import setup_device
+from lietorch import SE3
+from loss_kernels import get_reprojection_fn
+from loss_kernels import PackSegments
+from loss_kernels import sample_pixels
+import numpy as np
+import torch
+
+
+def scene_resolution(rootdir, scene_name):
+  """(H, W) of the reconstruction of a scene, from the disps.npy header."""
+  disps = np.load(
+      os.path.join(rootdir, scene_name.replace("_opt", ""), "disps.npy"),
+      mmap_mode="r",
+  )
+  return disps.shape[1:]
+
+
+def make_packs(scene_names, pack_size, rootdir):
+  """Groups the scenes by resolution into packs of at most pack_size."""
+  groups = {}
+  for name in scene_names:
+    groups.setdefault(scene_resolution(rootdir, name), []).append(name)
+  return [
+      names[k : k + pack_size]
+      for names in groups.values()
+      for k in range(0, len(names), pack_size)
+  ]
+
+
+def load_scene(rootdir, cache_dir, scene_name, device, amp):
+  """Loads a scene onto the device."""
+  inputs = load_scene_inputs(rootdir, cache_dir, scene_name)
+  flows, flow_masks = flows_to_device(
+      inputs["flows"], inputs["flow_masks"], device, amp
+  )
+  poses_th = torch.as_tensor(inputs["poses"]).float().to(device)
+  return {
+      "name": scene_name,
+      "images": inputs["images"],
+      "frames_path": os.path.join(rootdir, scene_name, "images.npy"),
+      "init_disp_hr": torch.from_numpy(inputs["disps"]).float().to(device),
+      "motion_prob": inputs["motion_prob"],
+      "flows": flows,
+      "flow_masks": flow_masks,
+      "ii": torch.from_numpy(inputs["ii"]).to(device),
+      "jj": torch.from_numpy(inputs["jj"]).to(device),
+      "K_o": torch.from_numpy(inputs["K"]).float().to(device),
+      "cam_c2w": SE3(poses_th).inv().matrix(),
+  }
+
+
+def set_level(scene, scale, args, device):
+  """Moves a scene to the optimization level at `scale`."""
+  scene["lv"] = level_inputs(
+      scene["init_disp_hr"],
+      scene["flows"],
+      scene["flow_masks"],
+      scene["K_o"],
+      scale,
+      args.prior_stride,
+      device,
+  )
+
+
+def pack_level(scenes):
+  """Concatenates the level inputs of scenes along the frame and pair axes.
+
+  Args:
+    scenes: scenes at the same level, with equal resolution.
+
+  Returns:
+    Dict with the consistency_loss inputs of the pack: cam_c2w, per-frame K
+    and K_inv, init_disp, flows, flow_masks, fg_alpha, compute_normals, ii
+    and jj indexing the packed frames, and the PackSegments of the scenes.
+  """
+  if len({tuple(scene["lv"]["size"]) for scene in scenes}) > 1:
+    raise ValueError("Packed scenes must have equal resolution.")
+  device = scenes[0]["ii"].device
+  ii, jj, frame_ids, pair_ids, K, K_inv, counts = [], [], [], [], [], [], []
+  num_frames = 0
+  for k, scene in enumerate(scenes):
+    lv = scene["lv"]
+    n = lv["init_disp"].shape[0]
+    ii.append(scene["ii"] + num_frames)
+    jj.append(scene["jj"] + num_frames)
+    frame_ids.append(torch.full((n,), k, dtype=torch.long, device=device))
+    pair_ids.append(torch.full_like(scene["ii"], k))
+    K.append(lv["K"].expand(n, 3, 3))
+    K_inv.append(lv["K_inv"].expand(n, 3, 3))
+    counts.append(n)
+    num_frames += n
+
+  def cat(key):
+    return torch.cat([scene["lv"][key] for scene in scenes])
+
+  return {
+      "cam_c2w": torch.cat([scene["cam_c2w"] for scene in scenes]),
+      "K": torch.cat(K),
+      "K_inv": torch.cat(K_inv),
+      "init_disp": torch.cat([scene["init_disp"] for scene in scenes]),
+      "flows": cat("flows"),
+      "flow_masks": cat("flow_masks"),
+      "fg_alpha": cat("fg_alpha"),
+      "compute_normals": scenes[0]["lv"]["compute_normals"],
+      "ii": torch.cat(ii),
+      "jj": torch.cat(jj),
+      "segments": PackSegments(
+          torch.cat(frame_ids),
+          torch.cat(pair_ids),
+          torch.tensor(counts, dtype=torch.float32, device=device),
+      ),
+  }
+
+
+def run_stage(scenes, optim, num_steps, pack_loss, amp, args):
+  """Runs num_steps packed steps, dropping scenes whose loss has converged.
+
+  Args:
+    scenes: scenes of the pack.
+    optim: optimizer with the parameter groups of all scenes.
+    num_steps: steps of the stage.
+    pack_loss: callable (scenes, pack, step, num_steps) -> [S] losses of the
+      scenes packed by pack_level.
+    amp: MixedPrecision policy.
+    args: command line arguments.
+  """
+  active = list(scenes)
+  pack = pack_level(active)
+  last_loss = {}
+  for i in range(num_steps):
+    # parameters of stopped scenes keep grad None, so Adam skips them
+    optim.zero_grad(set_to_none=True)
+    with amp.autocast():
+      losses = pack_loss(active, pack, i, num_steps)
+    amp.step(losses.sum(), optim)
+
+    if (i + 1) % args.check_every and i + 1 < num_steps:
+      continue
+    converged = set()
+    for scene, value in zip(active, losses.tolist()):
+      print("%s step %d %f" % (scene["name"], i, value))
+      prev = last_loss.get(scene["name"])
+      last_loss[scene["name"]] = value
+      if args.tol > 0 and prev is not None and prev - value < args.tol * abs(
+          prev
+      ):
+        print("%s converged at step %d" % (scene["name"], i))
+        converged.add(scene["name"])
+    if converged:
+      active = [scene for scene in active if scene["name"] not in converged]
+      if not active:
+        break
+      pack = pack_level(active)
+
+
+def optimize_pack(scenes, levels, loss_fn, amp, args, device):
+  """Runs the alignment and coarse-to-fine depth stages of cvd_opt.py."""
+
+  def draw_samples(pack, step, num_steps, uncertainty):
+    rate = annealed_sample_rate(step, num_steps, args.sample_rate)
+    if rate >= 1.0:
+      return None
+    return sample_pixels(
+        pack["flow_masks"],
+        torch.clamp(uncertainty.detach(), 1e-4, 1e3),
+        pack["ii"],
+        rate,
+        args.sample_mode,
+    )
+
+  def packed_loss(active, pack, disp_fn, step, num_steps, **kwargs):
+    # the per-scene parameters are concatenated in pack order
+    disp = torch.cat([disp_fn(scene) for scene in active])
+    uncertainty = torch.cat([scene["uncertainty"] for scene in active])
+    return loss_fn(
+        pack["cam_c2w"],
+        pack["K"],
+        pack["K_inv"],
+        torch.clamp(disp, 1e-3, 1e3),
+        pack["init_disp"],
+        torch.clamp(uncertainty, 1e-4, 1e3),
+        pack["flows"],
+        pack["flow_masks"],
+        pack["ii"],
+        pack["jj"],
+        pack["compute_normals"],
+        pack["fg_alpha"],
+        samples=draw_samples(pack, step, num_steps, uncertainty),
+        prior_stride=args.prior_stride,
+        segments=pack["segments"],
+        **kwargs,
+    )
+
+  # First optimize scale and shift to align them
+  groups = []
+  for scene in scenes:
+    set_level(scene, levels[0][0], args, device)
+    lv = scene["lv"]
+    num_frames = lv["init_disp"].shape[0]
+    scene["disp"] = lv["init_disp"].clone()
+    scene["init_disp"] = torch.clamp(lv["init_disp"], 1e-3, 1e3)
+    scene["uncertainty"] = motion_uncertainty(
+        scene["motion_prob"], lv["size"], device
+    ).requires_grad_(True)
+    scene["log_scale"] = torch.zeros(num_frames, device=device)
+    scene["shift"] = torch.zeros(num_frames, device=device)
+    scene["log_scale"].requires_grad = True
+    scene["shift"].requires_grad = True
+    params = [scene["log_scale"], scene["shift"], scene["uncertainty"]]
+    groups += [{"params": param, "lr": 1e-2} for param in params]
+    amp.watch(params)
+  optim = torch.optim.Adam(groups)
+
+  def aligned_disp(scene):
+    scale_ = torch.exp(scene["log_scale"])[..., None, None]
+    return scene["disp"] * scale_ + scene["shift"][..., None, None]
+
+  def align_loss(active, pack, step, num_steps):
+    return packed_loss(active, pack, aligned_disp, step, num_steps)
+
+  run_stage(scenes, optim, NUM_ALIGN_STEPS, align_loss, amp, args)
+
+  def depth_loss(active, pack, step, num_steps):
+    return packed_loss(
+        active,
+        pack,
+        lambda scene: scene["disp"],
+        step,
+        num_steps,
+        w_ratio=1.0,
+        w_flow=0.2,
+        w_si=1,
+        w_grad=args.w_grad,
+        w_normal=args.w_normal,
+    )
+
+  # Then optimize depth and uncertainty, coarse to fine
+  for scene in scenes:
+    align_scale = torch.exp(scene["log_scale"].detach())
+    scene["align_scale"] = align_scale[..., None, None]
+    scene["align_shift"] = scene["shift"].detach()[..., None, None]
+    scene["disp"] = scene["disp"] * scene["align_scale"] + scene["align_shift"]
+    scene["uncertainty"] = scene["uncertainty"].detach()
+
+  for level, (scale, num_steps) in enumerate(levels):
+    groups = []
+    for scene in scenes:
+      if level > 0:
+        set_level(scene, scale, args, device)
+      lv = scene["lv"]
+      init_disp = torch.clamp(lv["init_disp"], 1e-3, 1e3)
+      init_disp = init_disp * scene["align_scale"] + scene["align_shift"]
+      scene["init_disp"] = torch.clamp(init_disp, 1e-3, 1e3)
+      scene["disp"] = resize_maps(scene["disp"].detach(), lv["size"])
+      scene["uncertainty"] = resize_maps(
+          scene["uncertainty"].detach(), lv["size"]
+      )
+      scene["disp"].requires_grad = True
+      scene["uncertainty"].requires_grad = True
+      groups += [
+          {"params": scene["disp"], "lr": 5e-3},
+          {"params": scene["uncertainty"], "lr": 5e-3},
+      ]
+      amp.watch([scene["disp"], scene["uncertainty"]])
+    print("level ", level, " scale ", scale)
+    optim = torch.optim.Adam(groups)
+
+    run_stage(scenes, optim, num_steps, depth_loss, amp, args)
+
+
+def save_scene(scene, output_dir, output_format):
+  """Writes the `_sgd_cvd_hr` output of a scene, as cvd_opt.py does."""
+  H0, W0 = scene["init_disp_hr"].shape[-2:]
+  disp_data_opt = resize_maps(scene["disp"].detach(), (H0, W0)).cpu().numpy()
+  save_cvd_output(
+      "%s/%s_sgd_cvd_hr" % (output_dir, scene["name"]),
+      scene["images"],
+      np.clip(np.float16(1.0 / disp_data_opt), 1e-3, 1e2),
+      scene["K_o"],
+      scene["cam_c2w"],
+      scene["uncertainty"].detach(),
+      scene["frames_path"],
+      output_format,
+  )
+
+
+def run(
+    scene_names, pack_size, levels, loss_fn, amp, args, device, output_dir
+):
+  """Optimizes scene_names in packs of pack_size; returns seconds taken.
+
+  Only scenes of equal resolution are packed together.
+  """
+  rootdir = os.getcwd() + "/reconstructions"
+  cache_dir = "./cache_flow"
+  start = time.perf_counter()
+  for pack in make_packs(scene_names, pack_size, rootdir):
+    print("***************************** ", ", ".join(pack))
+    scenes = [
+        load_scene(rootdir, cache_dir, name, device, amp) for name in pack
+    ]
+    optimize_pack(scenes, levels, loss_fn, amp, args, device)
+    for scene in scenes:
+      save_scene(scene, output_dir, args.output_format)
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+  return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--w_grad", type=float, default=2.0, help="w_grad")
+  parser.add_argument("--w_normal", type=float, default=6.0, help="w_normal")
+  parser.add_argument(
+      "--output_dir", type=str, default="outputs_cvd", help="outputs direcotry"
+  )
+  parser.add_argument(
+      "--scene_names", type=str, help="comma-separated scene names"
+  )
+  parser.add_argument(
+      "--output_format", type=str, default="npz", choices=["lean", "npz"]
+  )
+  parser.add_argument(
+      "--pack_size",
+      type=int,
+      default=0,
+      help=(
+          "scenes optimized together (0 packs all scenes); only scenes of"
+          " equal resolution share a pack"
+      ),
+  )
+  parser.add_argument(
+      "--tol",
+      type=float,
+      default=0.0,
+      help=(
+          "stop a scene for the rest of a stage once its loss improves by"
+          " less than this fraction over --check_every steps (0 disables)"
+      ),
+  )
+  parser.add_argument(
+      "--check_every",
+      type=int,
+      default=20,
+      help="steps between loss reports and convergence checks",
+  )
+  parser.add_argument(
+      "--compare_sequential",
+      action="store_true",
+      help=(
+          "also optimize the scenes one at a time, into"
+          " <output_dir>_sequential, and report both rates"
+      ),
+  )
+  parser.add_argument("--device", type=str, default="cuda")
+  parser.add_argument("--num_threads", type=int, default=0)
+  parser.add_argument("--compile", action="store_true")
+  parser.add_argument("--fused_loss", action="store_true")
+  parser.add_argument(
+      "--precision", type=str, default="fp32", choices=sorted(PRECISIONS)
+  )
+  parser.add_argument("--schedule", type=str, default="0.5:400")
+  parser.add_argument("--sample_rate", type=float, default=1.0)
+  parser.add_argument(
+      "--sample_mode",
+      type=str,
+      default="stratified",
+      choices=["stratified", "uncertainty"],
+  )
+  parser.add_argument("--prior_stride", type=int, default=1)
+
+  args = parser.parse_args()
+  device = setup_device(args.device, args.num_threads)
+  amp = MixedPrecision(args.precision, device)
+  loss_fn = maybe_compile(
+      functools.partial(
+          consistency_loss,
+          reprojection_fn=get_reprojection_fn(
+              args.fused_loss, compile_kernel=not args.compile
+          ),
+      ),
+      args.compile,
+  )
+  levels = parse_schedule(args.schedule)
+  scene_names = args.scene_names.split(",")
+  Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+  seconds = run(
+      scene_names,
+      args.pack_size or len(scene_names),
+      levels,
+      loss_fn,
+      amp,
+      args,
+      device,
+      args.output_dir,
+  )
+  print(
+      "packed: %d scenes in %.1f s, %.1f scenes/hour"
+      % (len(scene_names), seconds, len(scene_names) * 3600.0 / seconds)
+  )
+  if args.compare_sequential:
+    # in-process, so this excludes the per-scene interpreter and CUDA start-up
+    # that the cvd_opt.sh loop also pays
+    # written apart, so that the packed outputs are kept for comparison
+    sequential_dir = args.output_dir.rstrip("/") + "_sequential"
+    Path(sequential_dir).mkdir(parents=True, exist_ok=True)
+    seconds_seq = run(
+        scene_names, 1, levels, loss_fn, amp, args, device, sequential_dir
+    )
+    print(
+        "sequential: %d scenes in %.1f s, %.1f scenes/hour (%.2fx)"
+        % (
+            len(scene_names),
+            seconds_seq,
+            len(scene_names) * 3600.0 / seconds_seq,
+            seconds_seq / seconds,
+        )
+    )
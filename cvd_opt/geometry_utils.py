@@ -17,7 +17,6 @@
 
 # pylint: disable=invalid-name
 
-import kornia
 import numpy as np
 import torch
 from torch import jit
@@ -66,15 +65,17 @@ class BackprojectDepth(nn.Module):
     # automatically
     self.register_buffer("pix_coords_13N", pix_coords_13N)
 
+  def cam_points(self, depth_b1hw: Tensor, invK_b44: Tensor) -> Tensor:
+    """Backprojects depth_b1hw to non-homogeneous camera points, b3N."""
+    # pixel coordinates and intrinsics need fp32 even under autocast
+    with torch.autocast(device_type=depth_b1hw.device.type, enabled=False):
+      rays_b3N = torch.matmul(invK_b44[:, :3, :3].float(), self.pix_coords_13N)
+      return depth_b1hw.flatten(start_dim=2).float() * rays_b3N
+
   # @jit.script_method
   def forward(self, depth_b1hw: Tensor, invK_b44: Tensor) -> Tensor:
     """Backprojects spatial points in 2D image space to world space using invK_b44 at the depths defined in depth_b1hw."""
-    cam_points_b3N = torch.matmul(
-        invK_b44[:, :3, :3], self.pix_coords_13N.float().cuda()
-    )
-    cam_points_b3N = depth_b1hw.flatten(start_dim=2) * cam_points_b3N
-    cam_points_b4N = to_homogeneous(cam_points_b3N, dim=1)
-    return cam_points_b4N
+    return to_homogeneous(self.cam_points(depth_b1hw, invK_b44), dim=1)
 
 
 class Project3D(jit.ScriptModule):
@@ -107,8 +108,21 @@ class Project3D(jit.ScriptModule):
     return torch.cat([pix_coords_b2N, depth_b1N], dim=1)
 
 
+def is_compiling() -> bool:
+  """Whether torch.compile is tracing the current call."""
+  compiler = getattr(torch, "compiler", None)
+  return hasattr(compiler, "is_compiling") and compiler.is_compiling()
+
+
 class NormalGenerator(nn.Module):
-  """Estimates normals from depth maps."""
+  """Estimates normals from depth maps.
+
+  The gaussian and sobel filters are the ones of kornia's gaussian_blur2d
+  (reflect border) and spatial_gradient (normalized sobel, replicate border),
+  precomputed once as device-resident buffers. The blur runs as two separable
+  passes and the gradients of all three point coordinates as one grouped
+  convolution.
+  """
 
   def __init__(
       self,
@@ -127,6 +141,37 @@ class NormalGenerator(nn.Module):
     self.kernel_size = smoothing_kernel_size
     self.std = smoothing_kernel_std
 
+    x = torch.arange(smoothing_kernel_size).float() - smoothing_kernel_size // 2
+    gauss = torch.exp(-(x**2) / (2.0 * smoothing_kernel_std**2))
+    gauss = gauss / gauss.sum()
+    self.register_buffer("blur_x", gauss.view(1, 1, 1, -1))
+    self.register_buffer("blur_y", gauss.view(1, 1, -1, 1))
+
+    sobel_x = torch.tensor(
+        [[-1.0, 0.0, 1.0], [-2.0, 0.0, 2.0], [-1.0, 0.0, 1.0]]
+    ) / 8.0
+    # (x, y) gradients of each of the three point coordinates
+    sobel = torch.stack([sobel_x, sobel_x.t()])[:, None].repeat(3, 1, 1, 1)
+    self.register_buffer("sobel", sobel)
+
+    self._cached = None
+
+  def smooth(self, depth_b1hw: Tensor) -> Tensor:
+    """Separable gaussian blur, as kornia.filters.gaussian_blur2d."""
+    pad = self.kernel_size // 2
+    depth_b1hw = F.pad(depth_b1hw, (pad, pad, pad, pad), mode="reflect")
+    depth_b1hw = F.conv2d(depth_b1hw, self.blur_x.to(depth_b1hw.dtype))
+    return F.conv2d(depth_b1hw, self.blur_y.to(depth_b1hw.dtype))
+
+  def gradients(self, points_b3hw: Tensor) -> Tensor:
+    """Sobel gradients b32hw, as kornia.filters.spatial_gradient."""
+    b, c, h, w = points_b3hw.shape
+    points_b3hw = F.pad(points_b3hw, (1, 1, 1, 1), mode="replicate")
+    gradients = F.conv2d(
+        points_b3hw, self.sobel.to(points_b3hw.dtype), groups=c
+    )
+    return gradients.view(b, c, 2, h, w)
+
   # @jit.script_method
   def forward(self, depth_b1hw: Tensor, invK_b44: Tensor) -> Tensor:
     """Estimates a normal at each location in the depth map."""
@@ -135,15 +180,11 @@ class NormalGenerator(nn.Module):
     # those depth points into world space (see BackprojectDepth), estimates
     # the spatial gradient at those points, and finally uses normalized cross
     # correlation to estimate a normal vector at each location.
-    depth_smooth_b1hw = kornia.filters.gaussian_blur2d(
-        depth_b1hw,
-        (self.kernel_size, self.kernel_size),
-        (self.std, self.std),
-    )
-    cam_points_b4N = self.backproject(depth_smooth_b1hw, invK_b44)
-    cam_points_b3hw = cam_points_b4N[:, :3].view(-1, 3, self.height, self.width)
+    depth_smooth_b1hw = self.smooth(depth_b1hw)
+    cam_points_b3N = self.backproject.cam_points(depth_smooth_b1hw, invK_b44)
+    cam_points_b3hw = cam_points_b3N.view(-1, 3, self.height, self.width)
 
-    gradients_b32hw = kornia.filters.spatial_gradient(cam_points_b3hw)
+    gradients_b32hw = self.gradients(cam_points_b3hw)
 
     return F.normalize(
         torch.cross(
@@ -154,6 +195,36 @@ class NormalGenerator(nn.Module):
         dim=1,
     )
 
+  def cached(self, inputs, compute):
+    """Returns compute(), reused while `inputs` are the same tensors.
+
+    Meant for normals of constant inputs such as the prior depth. The input
+    tensors are held by the cache, so their memory cannot be recycled into a
+    different tensor that would alias a stale entry. In-place modifications
+    are detected through the tensor version counters. Caching is bypassed
+    under torch.compile.
+
+    Args:
+      inputs: tensors that the result depends on.
+      compute: callable producing the result.
+
+    Returns:
+      The (possibly cached) result of compute().
+    """
+    if is_compiling():
+      return compute()
+    inputs = tuple(inputs)
+    versions = [t._version for t in inputs]  # pylint: disable=protected-access
+    if self._cached is not None:
+      cached_inputs, cached_versions, value = self._cached
+      if cached_versions == versions and all(
+          a is b for a, b in zip(cached_inputs, inputs)
+      ):
+        return value
+    value = compute()
+    self._cached = (inputs, versions, value)
+    return value
+
 
 def get_camera_rays(
     world_T_cam_b44,
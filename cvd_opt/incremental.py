@@ -0,0 +1,118 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Warm-started CVD for clips that grew since the previous optimization.
+
+Only the new frames and the older frames that share a flow pair with them
+(plus an optional extra band) are optimized. The remaining frames that those
+pairs reference are loaded from the previous solution and kept frozen, and
+pairs between frozen frames are dropped entirely.
+"""
+
+# pylint: disable=invalid-name
+
+import collections
+
+from lean_output import load_output
+import numpy as np
+import torch
+
+
+IncrementalPlan = collections.namedtuple(
+    "IncrementalPlan", ["frames", "active", "is_new", "pairs", "ii", "jj"]
+)
+
+
+def load_previous_solution(path):
+  """Loads depths and, if stored, uncertainty from a `_sgd_cvd_hr` output.
+
+  Args:
+    path: previous CVD output, lean directory or npz.
+
+  Returns:
+    (depths [M, H, W], uncertainty [M, 1, h, w] or None) numpy arrays.
+  """
+  data = load_output(path)
+  depths = np.float32(data["depths"])
+  uncertainty = None
+  if "uncertainty" in data.files:
+    uncertainty = np.float32(data["uncertainty"])
+  return depths, uncertainty
+
+
+def plan_incremental(num_prev, num_frames, ii, jj, boundary_band=0):
+  """Selects the frames and flow pairs to re-optimize.
+
+  Args:
+    num_prev: number of frames in the previous solution.
+    num_frames: number of frames in the grown clip.
+    ii: [P] source frame index of each flow pair.
+    jj: [P] target frame index of each flow pair.
+    boundary_band: number of additional previous frames, counted back from
+      the first new frame, to optimize.
+
+  Returns:
+    IncrementalPlan with
+      frames: [S] indices of the frames in the sub-problem.
+      active: [S] bool, frames whose depth and uncertainty are optimized.
+      is_new: [S] bool, frames without a previous solution.
+      pairs: [Q] indices of the flow pairs kept.
+      ii, jj: [Q] pair endpoints re-indexed into `frames`.
+  """
+  if num_prev >= num_frames:
+    raise ValueError(
+        "Previous solution has %d frames, nothing to add to a %d-frame clip."
+        % (num_prev, num_frames)
+    )
+  device = ii.device
+  new = torch.arange(num_frames, device=device) >= num_prev
+
+  # the pair neighbourhood of the new frames forms the boundary band
+  active = new.clone()
+  touches_new = new[ii] | new[jj]
+  active[ii[touches_new]] = True
+  active[jj[touches_new]] = True
+  if boundary_band > 0:
+    active[max(0, num_prev - boundary_band) :] = True
+
+  keep = active[ii] | active[jj]
+  used = active.clone()
+  used[ii[keep]] = True
+  used[jj[keep]] = True
+
+  frames = torch.nonzero(used).squeeze(1)
+  remap = torch.full((num_frames,), -1, dtype=torch.long, device=device)
+  remap[frames] = torch.arange(frames.shape[0], device=device)
+  return IncrementalPlan(
+      frames=frames,
+      active=active[frames],
+      is_new=new[frames],
+      pairs=torch.nonzero(keep).squeeze(1),
+      ii=remap[ii[keep]],
+      jj=remap[jj[keep]],
+  )
+
+
+def freeze_frames(param, mask):
+  """Zeroes the gradient of param outside the frames selected by mask.
+
+  Adam leaves entries whose gradient is always zero exactly unchanged.
+
+  Args:
+    param: leaf tensor whose first dimension indexes frames.
+    mask: [S] bool mask of the frames to keep trainable.
+  """
+  frozen = ~mask.view(-1, *([1] * (param.dim() - 1)))
+  param.register_hook(lambda grad: grad.masked_fill(frozen, 0.0))
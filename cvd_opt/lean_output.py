@@ -0,0 +1,229 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Lean on-disk layout for depth and camera outputs.
+
+`<scene>_sgd_cvd_hr.npz` and `outputs/<scene>_droid.npz` embed a uint8 copy
+of every frame next to the depths. The lean layout is a directory holding
+
+  depths.npy       float16 [N, H, W], written in chunks of frames
+  cam_c2w.npy      [N, 4, 4] camera-to-world matrices
+  intrinsic.npy    [3, 3] intrinsics
+  uncertainty.npy  float16 [N, 1, h, w] CVD uncertainty (optional)
+  meta.json        format version, shapes and the frame source
+
+Every array is a plain .npy file that loads with mmap_mode="r". The frames are
+not copied: meta.json references the reconstruction's images.npy ([N, 3, H, W]
+BGR) by path and SHA-1. load_output returns the old npz-shaped view for
+either layout. npz stays the default output format; lean is opt-in with
+--output_format lean until every reader goes through load_output.
+"""
+
+import collections.abc
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+
+import numpy as np
+
+
+FORMAT = "megasam-lean"
+VERSION = 1
+# largest finite float16
+FLOAT16_MAX = 65504.0
+
+
+def file_sha1(path, block_size=1 << 20):
+  """Returns the SHA-1 hex digest of a file, read in blocks."""
+  sha1 = hashlib.sha1()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(block_size), b""):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+
+def save_output(
+    path,
+    depths,
+    intrinsic,
+    cam_c2w,
+    frames_path,
+    uncertainty=None,
+    chunk_frames=64,
+    disparity=False,
+):
+  """Writes depths and cameras in the lean layout.
+
+  Args:
+    path: output directory, e.g. outputs_cvd/<scene>_sgd_cvd_hr.
+    depths: [N, H, W] depths, stored as float16.
+    intrinsic: [3, 3] intrinsics.
+    cam_c2w: [N, 4, 4] camera-to-world matrices.
+    frames_path: images.npy with the [N', 3, H, W] BGR frames, N' >= N.
+    uncertainty: optional [N, 1, h, w] uncertainty, stored as float16.
+    chunk_frames: frames converted and written at a time.
+    disparity: depths holds disparities, inverted chunk by chunk.
+  """
+  # written next to path and swapped in complete, so that an interrupted
+  # rerun never leaves new arrays beside the meta.json of an old output
+  path = os.path.normpath(path)
+  tmp_dir = path + ".tmp"
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  os.makedirs(tmp_dir)
+  num_frames, height, width = depths.shape
+  depths_out = np.lib.format.open_memmap(
+      os.path.join(tmp_dir, "depths.npy"),
+      mode="w+",
+      dtype=np.float16,
+      shape=depths.shape,
+  )
+  for k in range(0, num_frames, chunk_frames):
+    chunk = depths[k : k + chunk_frames]
+    if disparity:
+      chunk = 1.0 / chunk
+    depths_out[k : k + chunk_frames] = np.clip(chunk, 0.0, FLOAT16_MAX)
+  depths_out.flush()
+  del depths_out
+
+  np.save(os.path.join(tmp_dir, "cam_c2w.npy"), cam_c2w)
+  np.save(os.path.join(tmp_dir, "intrinsic.npy"), intrinsic)
+  if uncertainty is not None:
+    np.save(os.path.join(tmp_dir, "uncertainty.npy"), np.float16(uncertainty))
+
+  meta = {
+      "format": FORMAT,
+      "version": VERSION,
+      "num_frames": num_frames,
+      "height": height,
+      "width": width,
+      "frames": {
+          # relative, so that outputs move together with the project tree
+          "path": os.path.relpath(frames_path, path),
+          "sha1": file_sha1(frames_path),
+          "layout": "NCHW_BGR",
+      },
+  }
+  # meta.json marks the directory complete, so it is written last
+  with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+    json.dump(meta, f, indent=2)
+
+  # a directory cannot replace a non-empty one, the old output is moved
+  # aside first and only deleted once the new one is in place
+  old_dir = path + ".old"
+  shutil.rmtree(old_dir, ignore_errors=True)
+  if os.path.exists(path):
+    os.replace(path, old_dir)
+  os.replace(tmp_dir, path)
+  shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def save_npz(path, arrays, chunk_frames=64):
+  """Writes an uncompressed npz like np.savez, streaming large arrays.
+
+  Args:
+    path: output .npz path.
+    arrays: name -> array, or name -> (source, fn). For the latter, the array
+      stored is fn applied to consecutive chunks of frames of source, so that
+      no full converted copy of source is ever held in memory.
+    chunk_frames: frames converted and written at a time.
+  """
+  with zipfile.ZipFile(path, "w", allowZip64=True) as zf:
+    for name, value in arrays.items():
+      with zf.open(name + ".npy", "w", force_zip64=True) as f:
+        if not isinstance(value, tuple):
+          np.lib.format.write_array(f, np.asanyarray(value))
+          continue
+        source, fn = value
+        first = fn(source[:1])
+        np.lib.format.write_array_header_1_0(
+            f,
+            {
+                "descr": np.lib.format.dtype_to_descr(first.dtype),
+                "fortran_order": False,
+                "shape": (len(source),) + first.shape[1:],
+            },
+        )
+        for k in range(0, len(source), chunk_frames):
+          chunk = fn(source[k : k + chunk_frames])
+          f.write(np.ascontiguousarray(chunk).tobytes())
+
+
+class LeanOutput(collections.abc.Mapping):
+  """Read-only, npz-shaped view of a lean output directory.
+
+  Arrays are memory-mapped on access. "images" is derived from the referenced
+  frames as [N, H, W, 3] RGB uint8, exactly as the npz outputs stored them.
+  """
+
+  def __init__(self, path, verify_frames=False, mmap_mode="r"):
+    self.path = path
+    self.mmap_mode = mmap_mode
+    with open(os.path.join(path, "meta.json")) as f:
+      self.meta = json.load(f)
+    if self.meta.get("format") != FORMAT:
+      raise ValueError("%s is not a %s output." % (path, FORMAT))
+    self.frames_path = os.path.normpath(
+        os.path.join(path, self.meta["frames"]["path"])
+    )
+    if verify_frames and file_sha1(self.frames_path) != (
+        self.meta["frames"]["sha1"]
+    ):
+      raise ValueError(
+          "Frames %s changed since %s was written."
+          % (self.frames_path, path)
+      )
+    self.files = ["images", "depths", "intrinsic", "cam_c2w"]
+    if os.path.exists(os.path.join(path, "uncertainty.npy")):
+      self.files.append("uncertainty")
+
+  def __getitem__(self, key):
+    if key not in self.files:
+      raise KeyError(key)
+    if key == "images":
+      frames = np.load(self.frames_path, mmap_mode=self.mmap_mode)
+      images = frames[: self.meta["num_frames"], ::-1].transpose(0, 2, 3, 1)
+      return images if images.dtype == np.uint8 else np.uint8(images)
+    return np.load(
+        os.path.join(self.path, key + ".npy"), mmap_mode=self.mmap_mode
+    )
+
+  def __iter__(self):
+    return iter(self.files)
+
+  def __len__(self):
+    return len(self.files)
+
+
+def load_output(path, verify_frames=False, mmap_mode="r"):
+  """Opens an output written as a lean directory or as a legacy npz.
+
+  Args:
+    path: output path with or without the .npz extension, e.g.
+      outputs_cvd/<scene>_sgd_cvd_hr.
+    verify_frames: check the SHA-1 of the referenced frames.
+    mmap_mode: numpy mmap mode of the lean arrays.
+
+  Returns:
+    A mapping with the keys of the npz outputs (images, depths, intrinsic,
+    cam_c2w and, if stored, uncertainty).
+  """
+  stem = path[: -len(".npz")] if path.endswith(".npz") else path
+  if os.path.isfile(os.path.join(stem, "meta.json")):
+    return LeanOutput(stem, verify_frames, mmap_mode)
+  if os.path.isfile(stem + ".npz"):
+    return np.load(stem + ".npz")
+  raise FileNotFoundError("No output at %s(.npz)" % stem)
@@ -0,0 +1,471 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Reprojection, depth-ratio and flow error terms of the CVD loss.
+
+`reprojection_terms` is the reference implementation. It lifts every pixel to
+a [P, H, W, 3, 1] point and runs 3x3 matmuls per pixel, which allocates many
+full-resolution intermediates over all pairs. `reprojection_terms_fused`
+computes the same quantities in closed form on [P, H, W] planes: the rotation,
+K^-1 and K are folded into per-pair 3x3 coefficients, so the rest of the loss
+is a single elementwise expression that torch.compile lowers to a few fused
+kernels (forward and backward). `reprojection_terms_sampled` evaluates the same
+closed form on a random subset of pixels per pair drawn by `sample_pixels`.
+
+Both implementations run in fp32 even under autocast: they are dominated by
+pose matrices, reciprocals of depth and logs, and pixel coordinates are not
+representable to sub-pixel accuracy in 16-bit floats. Reduced-precision flows
+and masks are upcast on read.
+
+Several scenes of equal resolution can be evaluated as one problem (see
+cvd_opt_batch.py): their frames and pairs are concatenated, K and K_inv are
+given per pair, and with `segments` the masked means are taken per scene, so
+every scene keeps the normalization of a standalone run.
+"""
+
+# pylint: disable=invalid-name
+
+import collections
+import functools
+
+import torch
+from torch import Tensor  # pylint: disable=g-importing-member
+
+
+# Scenes packed along the frame and pair axes: frame_ids [N] and pair_ids [P]
+# are the scene index of each frame and pair, frame_counts [S] the number of
+# frames of each scene.
+PackSegments = collections.namedtuple(
+    "PackSegments", ["frame_ids", "pair_ids", "frame_counts"]
+)
+
+
+def segment_sum(values: Tensor, ids: Tensor, num_segments: int) -> Tensor:
+  """Sums [B, ...] values into [num_segments] by the [B] segment ids."""
+  return torch.zeros(
+      num_segments, device=values.device, dtype=values.dtype
+  ).index_add_(0, ids, values.reshape(values.shape[0], -1).sum(-1))
+
+
+def _masked_mean(numerator, mask, segments, denom_scale=1.0):
+  """sum(numerator) / (sum(mask) * denom_scale), per scene with segments."""
+  if segments is None:
+    return torch.sum(numerator) / (torch.sum(mask) * denom_scale + 1e-8)
+  num_segments = segments.frame_counts.shape[0]
+  return segment_sum(numerator, segments.pair_ids, num_segments) / (
+      segment_sum(mask, segments.pair_ids, num_segments) * denom_scale + 1e-8
+  )
+
+
+def _pixel_matrix(matrix: Tensor) -> Tensor:
+  """[3, 3] or per-pair [P, 3, 3] matrix broadcast to [P, H, W, 3, 3]."""
+  if matrix.dim() == 2:
+    return matrix[None, None, None]
+  return matrix[:, None, None]
+
+
+def _apply(matrix: Tensor, vectors: Tensor) -> Tensor:
+  """[3, 3] or per-pair [P, 3, 3] matrix times [P, 3] vectors."""
+  return (matrix @ vectors[..., None])[..., 0]
+
+
+def relative_poses(cam_c2w: Tensor, ii: Tensor, jj: Tensor) -> Tensor:
+  """Returns the [P, 4, 4] transforms from camera ii to camera jj."""
+  return torch.bmm(
+      torch.linalg.inv(torch.index_select(cam_c2w, dim=0, index=jj)),
+      torch.index_select(cam_c2w, dim=0, index=ii),
+  )
+
+
+def sample_target_disp(
+    disp_data: Tensor, jj: Tensor, pixel_locations: Tensor
+) -> Tensor:
+  """Samples disp_data[jj] at [P, H, W, 2] pixel locations."""
+  _, H, W = disp_data.shape
+  resize_factor = torch.tensor(
+      [W - 1.0, H - 1.0], device=disp_data.device, dtype=disp_data.dtype
+  )
+  normalized_pixel_locations = 2 * (pixel_locations / resize_factor) - 1.0
+  return torch.nn.functional.grid_sample(
+      torch.index_select(disp_data, dim=0, index=jj)[:, None, ...],
+      normalized_pixel_locations,
+      align_corners=True,
+  )
+
+
+def _fp32(fn):
+  """Runs a reprojection implementation in fp32, with autocast disabled."""
+
+  @functools.wraps(fn)
+  def wrapper(
+      cam_c2w,
+      K,
+      K_inv,
+      disp_data,
+      uncertainty,
+      flows,
+      flow_masks,
+      ii,
+      jj,
+      alpha_motion,
+      *samples,
+      segments=None,
+  ):
+    with torch.autocast(device_type=disp_data.device.type, enabled=False):
+      return fn(
+          cam_c2w.float(),
+          K.float(),
+          K_inv.float(),
+          disp_data.float(),
+          uncertainty.float(),
+          flows.float(),
+          flow_masks.float(),
+          ii,
+          jj,
+          alpha_motion,
+          *samples,
+          segments=segments,
+      )
+
+  return wrapper
+
+
+@_fp32
+def reprojection_terms(
+    cam_c2w,
+    K,
+    K_inv,
+    disp_data,
+    uncertainty,
+    flows,
+    flow_masks,
+    ii,
+    jj,
+    alpha_motion,
+    segments=None,
+):
+  """Reference depth-ratio and flow reprojection losses.
+
+  Args:
+    cam_c2w: [N, 4, 4] camera-to-world matrices.
+    K: [3, 3] or per-pair [P, 3, 3] intrinsics at the optimization resolution.
+    K_inv: inverse of K.
+    disp_data: [N, H, W] disparity.
+    uncertainty: [N, 1, H, W] per-pixel uncertainty weights.
+    flows: [P, 2, H, W] optical flow from frame ii to frame jj.
+    flow_masks: [P, 1, H, W] flow validity masks.
+    ii: [P] source frame indices.
+    jj: [P] target frame indices.
+    alpha_motion: weight of the uncertainty regularizer.
+    segments: optional PackSegments of packed scenes.
+
+  Returns:
+    (loss_d_ratio, loss_flow) scalars, or [S] per-scene losses with segments.
+  """
+  _, H, W = disp_data.shape
+  device = disp_data.device
+  # mesh grid
+  xx = torch.arange(0, W, device=device).view(1, -1).repeat(H, 1)
+  yy = torch.arange(0, H, device=device).view(-1, 1).repeat(1, W)
+  xx = xx.view(1, 1, H, W)  # .repeat(B ,1 ,1 ,1)
+  yy = yy.view(1, 1, H, W)  # .repeat(B ,1 ,1 ,1)
+  grid = torch.cat((xx, yy), 1).float().permute(0, 2, 3, 1)  # [None, ...]
+
+  flows_step = flows.permute(0, 2, 3, 1)
+  flow_masks_step = flow_masks.permute(0, 2, 3, 1).squeeze(-1)
+
+  cam_1to2 = relative_poses(cam_c2w, ii, jj)
+
+  # warp disp from target time
+  pixel_locations = grid + flows_step
+  disp_sampled = sample_target_disp(disp_data, jj, pixel_locations)
+
+  uu = torch.index_select(uncertainty, dim=0, index=ii).squeeze(1)
+
+  grid_h = torch.cat([grid, torch.ones_like(grid[..., 0:1])], dim=-1).unsqueeze(
+      -1
+  )
+  # depth of reference view
+  ref_depth = 1.0 / torch.clamp(
+      torch.index_select(disp_data, dim=0, index=ii), 1e-3, 1e3
+  )
+
+  pts_3d_ref = ref_depth[..., None, None] * (_pixel_matrix(K_inv) @ grid_h)
+  rot = cam_1to2[:, None, None, :3, :3]
+  trans = cam_1to2[:, None, None, :3, 3:4]
+
+  pts_3d_tgt = (rot @ pts_3d_ref) + trans  # [:, None, None, :, None]
+  depth_tgt = pts_3d_tgt[:, :, :, 2:3, 0]
+  disp_tgt = 1.0 / torch.clamp(depth_tgt, 0.1, 1e3)
+
+  # flow consistency loss
+  pts_2D_tgt = _pixel_matrix(K) @ pts_3d_tgt
+
+  flow_masks_step_ = flow_masks_step * (pts_2D_tgt[:, :, :, 2, 0] > 0.1)
+  pts_2D_tgt = pts_2D_tgt[:, :, :, :2, 0] / torch.clamp(
+      pts_2D_tgt[:, :, :, 2:, 0], 1e-3, 1e3
+  )
+
+  disp_sampled = torch.clamp(disp_sampled, 1e-3, 1e2)
+  disp_tgt = torch.clamp(disp_tgt, 1e-3, 1e2)
+
+  ratio = torch.maximum(
+      disp_sampled.squeeze() / disp_tgt.squeeze(),
+      disp_tgt.squeeze() / disp_sampled.squeeze(),
+  )
+  ratio_error = torch.abs(ratio - 1.0)  #
+
+  loss_d_ratio = _masked_mean(
+      (ratio_error * uu + alpha_motion * torch.log(1.0 / uu))
+      * flow_masks_step_,
+      flow_masks_step_,
+      segments,
+  )
+
+  flow_error = torch.abs(pts_2D_tgt - pixel_locations)
+  loss_flow = _masked_mean(
+      (
+          flow_error * uu[..., None]
+          + alpha_motion * torch.log(1.0 / uu[..., None])
+      )
+      * flow_masks_step_[..., None],
+      flow_masks_step_,
+      segments,
+      2.0,
+  )
+
+  return loss_d_ratio, loss_flow
+
+
+def _per_pair(values: Tensor, like: Tensor) -> Tensor:
+  """Reshapes [P] per-pair values to broadcast against [P, ...] pixels."""
+  return values.view(-1, *([1] * (like.dim() - 1)))
+
+
+def _affine_plane(coeffs: Tensor, row: int, xs: Tensor, ys: Tensor) -> Tensor:
+  """Evaluates coeffs[:, row] . (x, y, 1) at pixels xs, ys, [P, ...]."""
+  return (
+      _per_pair(coeffs[:, row, 0], xs) * xs
+      + _per_pair(coeffs[:, row, 1], xs) * ys
+      + _per_pair(coeffs[:, row, 2], xs)
+  )
+
+
+@_fp32
+def reprojection_terms_fused(
+    cam_c2w,
+    K,
+    K_inv,
+    disp_data,
+    uncertainty,
+    flows,
+    flow_masks,
+    ii,
+    jj,
+    alpha_motion,
+    segments=None,
+):
+  """Closed-form version of reprojection_terms; same arguments and outputs."""
+  _, H, W = disp_data.shape
+  dtype = disp_data.dtype
+  xs = torch.arange(W, device=disp_data.device, dtype=dtype).view(1, 1, W)
+  ys = torch.arange(H, device=disp_data.device, dtype=dtype).view(1, H, 1)
+
+  cam_1to2 = relative_poses(cam_c2w, ii, jj)
+  # point in target camera: depth * (R K^-1 [x, y, 1]) + t, then K on top
+  M = cam_1to2[:, :3, :3] @ K_inv
+  t = cam_1to2[:, :3, 3]
+  KM = K @ M
+  Kt = _apply(K, t)
+
+  px = xs + flows[:, 0]
+  py = ys + flows[:, 1]
+  disp_sampled = sample_target_disp(
+      disp_data, jj, torch.stack((px, py), dim=-1)
+  )[:, 0]
+
+  ref_depth = 1.0 / torch.clamp(
+      torch.index_select(disp_data, dim=0, index=ii), 1e-3, 1e3
+  )
+  depth_tgt = ref_depth * _affine_plane(M, 2, xs, ys) + t[:, 2, None, None]
+  disp_tgt = torch.clamp(1.0 / torch.clamp(depth_tgt, 0.1, 1e3), 1e-3, 1e2)
+
+  u_h = ref_depth * _affine_plane(KM, 0, xs, ys) + Kt[:, 0, None, None]
+  v_h = ref_depth * _affine_plane(KM, 1, xs, ys) + Kt[:, 1, None, None]
+  w_h = ref_depth * _affine_plane(KM, 2, xs, ys) + Kt[:, 2, None, None]
+  mask = flow_masks[:, 0] * (w_h > 0.1)
+  w_h = torch.clamp(w_h, 1e-3, 1e3)
+
+  disp_sampled = torch.clamp(disp_sampled, 1e-3, 1e2)
+  ratio = torch.maximum(disp_sampled / disp_tgt, disp_tgt / disp_sampled)
+  flow_error = torch.abs(u_h / w_h - px) + torch.abs(v_h / w_h - py)
+
+  uu = torch.index_select(uncertainty, dim=0, index=ii)[:, 0]
+  log_prior = alpha_motion * torch.log(1.0 / uu)
+
+  loss_d_ratio = _masked_mean(
+      (torch.abs(ratio - 1.0) * uu + log_prior) * mask, mask, segments
+  )
+  loss_flow = _masked_mean(
+      (flow_error * uu + 2.0 * log_prior) * mask, mask, segments, 2.0
+  )
+  return loss_d_ratio, loss_flow
+
+
+def sample_pixels(flow_masks, uncertainty, ii, rate, mode="stratified"):
+  """Draws round(rate * H * W) pixels per pair for reprojection_terms_sampled.
+
+  Args:
+    flow_masks: [P, 1, H, W] flow validity masks.
+    uncertainty: [N, 1, H, W] per-pixel uncertainty weights.
+    ii: [P] source frame indices.
+    rate: fraction of pixels to sample.
+    mode: "stratified" draws one uniform pixel from each of the equal runs of
+      the raster order. "uncertainty" importance-samples valid pixels in
+      proportion to their uncertainty weight, i.e. their weight in the loss.
+
+  Returns:
+    (pixels, weights): [P, S] flat pixel indices and the importance weights
+    that keep the masked means of the dense loss unbiased.
+  """
+  P, _, H, W = flow_masks.shape
+  num_pixels = H * W
+  num_samples = max(1, int(round(rate * num_pixels)))
+  device = flow_masks.device
+  if mode == "stratified":
+    offsets = torch.rand(P, num_samples, device=device)
+    pixels = (
+        (torch.arange(num_samples, device=device) + offsets)
+        * (num_pixels / num_samples)
+    ).long()
+    pixels = torch.clamp(pixels, max=num_pixels - 1)
+    weights = torch.ones(P, num_samples, device=device)
+  elif mode == "uncertainty":
+    with torch.no_grad():
+      prob = torch.index_select(uncertainty, dim=0, index=ii).reshape(P, -1)
+      prob = prob.float() * flow_masks.reshape(P, -1).float() + 1e-6
+      prob = prob / torch.sum(prob, dim=-1, keepdim=True)
+      pixels = torch.multinomial(prob, num_samples, replacement=True)
+      weights = 1.0 / (torch.gather(prob, 1, pixels) * num_pixels)
+  else:
+    raise ValueError("Unknown pixel sampling mode: %s" % mode)
+  return pixels, weights
+
+
+@_fp32
+def reprojection_terms_sampled(
+    cam_c2w,
+    K,
+    K_inv,
+    disp_data,
+    uncertainty,
+    flows,
+    flow_masks,
+    ii,
+    jj,
+    alpha_motion,
+    pixels,
+    weights,
+    segments=None,
+):
+  """reprojection_terms evaluated at a subset of pixels of each pair.
+
+  Args:
+    cam_c2w: [N, 4, 4] camera-to-world matrices.
+    K: [3, 3] or per-pair [P, 3, 3] intrinsics at the optimization resolution.
+    K_inv: inverse of K.
+    disp_data: [N, H, W] disparity.
+    uncertainty: [N, 1, H, W] per-pixel uncertainty weights.
+    flows: [P, 2, H, W] optical flow from frame ii to frame jj.
+    flow_masks: [P, 1, H, W] flow validity masks.
+    ii: [P] source frame indices.
+    jj: [P] target frame indices.
+    alpha_motion: weight of the uncertainty regularizer.
+    pixels: [P, S] flat pixel indices from sample_pixels.
+    weights: [P, S] importance weights from sample_pixels.
+    segments: optional PackSegments of packed scenes.
+
+  Returns:
+    (loss_d_ratio, loss_flow) scalars, or [S] per-scene losses with segments.
+  """
+  _, H, W = disp_data.shape
+  P = ii.shape[0]
+  dtype = disp_data.dtype
+  rows = torch.div(pixels, W, rounding_mode="floor")
+  cols = pixels % W
+  xs = cols.to(dtype)
+  ys = rows.to(dtype)
+  # gather per-pair samples without materializing [P, H, W] copies; indexing
+  # works on any memory format, e.g. channels-last flows on CPU
+  pairs = torch.arange(P, device=pixels.device)[:, None]
+  frames = ii[:, None]
+  ref_disp = disp_data[frames, rows, cols]
+  uu = uncertainty[frames, 0, rows, cols]
+  flows_s = flows[pairs, :, rows, cols]
+  mask = flow_masks[pairs, 0, rows, cols] * weights
+
+  cam_1to2 = relative_poses(cam_c2w, ii, jj)
+  M = cam_1to2[:, :3, :3] @ K_inv
+  t = cam_1to2[:, :3, 3]
+  KM = K @ M
+  Kt = _apply(K, t)
+
+  px = xs + flows_s[..., 0]
+  py = ys + flows_s[..., 1]
+  disp_sampled = sample_target_disp(
+      disp_data, jj, torch.stack((px, py), dim=-1)[:, None]
+  )[:, 0, 0]
+
+  ref_depth = 1.0 / torch.clamp(ref_disp, 1e-3, 1e3)
+  depth_tgt = ref_depth * _affine_plane(M, 2, xs, ys) + t[:, 2, None]
+  disp_tgt = torch.clamp(1.0 / torch.clamp(depth_tgt, 0.1, 1e3), 1e-3, 1e2)
+
+  u_h = ref_depth * _affine_plane(KM, 0, xs, ys) + Kt[:, 0, None]
+  v_h = ref_depth * _affine_plane(KM, 1, xs, ys) + Kt[:, 1, None]
+  w_h = ref_depth * _affine_plane(KM, 2, xs, ys) + Kt[:, 2, None]
+  mask = mask * (w_h > 0.1)
+  w_h = torch.clamp(w_h, 1e-3, 1e3)
+
+  disp_sampled = torch.clamp(disp_sampled, 1e-3, 1e2)
+  ratio = torch.maximum(disp_sampled / disp_tgt, disp_tgt / disp_sampled)
+  flow_error = torch.abs(u_h / w_h - px) + torch.abs(v_h / w_h - py)
+
+  log_prior = alpha_motion * torch.log(1.0 / uu)
+
+  loss_d_ratio = _masked_mean(
+      (torch.abs(ratio - 1.0) * uu + log_prior) * mask, mask, segments
+  )
+  loss_flow = _masked_mean(
+      (flow_error * uu + 2.0 * log_prior) * mask, mask, segments, 2.0
+  )
+  return loss_d_ratio, loss_flow
+
+
+def get_reprojection_fn(fused=False, compile_kernel=False):
+  """Returns the reprojection implementation to plug into consistency_loss.
+
+  Args:
+    fused: use the closed-form implementation instead of the reference.
+    compile_kernel: torch.compile the fused implementation. Falls back to the
+      eager fused implementation when torch.compile is unavailable.
+
+  Returns:
+    A callable with the signature of reprojection_terms.
+  """
+  if not fused:
+    return reprojection_terms
+  if compile_kernel and hasattr(torch, "compile"):
+    return torch.compile(reprojection_terms_fused, dynamic=False)
+  return reprojection_terms_fused
@@ -0,0 +1,135 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Value and gradient parity of the reprojection implementations.
+
+Also checks that scenes packed with PackSegments get their standalone losses.
+
+  python -m pytest cvd_opt/loss_kernels_test.py
+"""
+
+# pylint: disable=g-importing-member
+# pylint: disable=g-import-not-at-top
+
+import pytest
+
+torch = pytest.importorskip("torch")
+benchmark_cvd = pytest.importorskip("benchmark_cvd")
+
+from loss_kernels import PackSegments
+from loss_kernels import reprojection_terms
+from loss_kernels import reprojection_terms_fused
+from loss_kernels import reprojection_terms_sampled
+
+RTOL = 1e-4
+
+
+def _all_pixels(scene):
+  """Samples of reprojection_terms_sampled covering every pixel once."""
+  num_pairs = scene["ii"].shape[0]
+  _, height, width = scene["disp"].shape
+  pixels = torch.arange(height * width).expand(num_pairs, -1)
+  return pixels, torch.ones(num_pairs, height * width)
+
+
+def _terms_and_grads(scene, fn, *samples):
+  disp = scene["disp"].clone().requires_grad_(True)
+  uncertainty = scene["uncertainty"].clone().requires_grad_(True)
+  loss_d_ratio, loss_flow = fn(
+      scene["cam_c2w"],
+      scene["K"],
+      scene["K_inv"],
+      disp,
+      uncertainty,
+      scene["flows"],
+      scene["flow_masks"],
+      scene["ii"],
+      scene["jj"],
+      benchmark_cvd.ALPHA_MOTION,
+      *samples,
+  )
+  (loss_d_ratio + 0.2 * loss_flow).backward()
+  return loss_d_ratio, loss_flow, disp.grad, uncertainty.grad
+
+
+def _assert_close(reference, other):
+  names = ("loss_d_ratio", "loss_flow", "grad disp", "grad uncertainty")
+  for name, ref, value in zip(names, reference, other):
+    err = torch.max(torch.abs(ref - value)).item()
+    scale = torch.max(torch.abs(ref)).item() + 1e-12
+    assert err / scale < RTOL, "%s: relative error %.3e" % (name, err / scale)
+
+
+@pytest.fixture(name="scene")
+def _scene():
+  return benchmark_cvd.make_synthetic_scene(8, 24, 32, "cpu")
+
+
+def test_fused_matches_reference(scene):
+  _assert_close(
+      _terms_and_grads(scene, reprojection_terms),
+      _terms_and_grads(scene, reprojection_terms_fused),
+  )
+
+
+def test_sampled_at_full_rate_matches_reference(scene):
+  _assert_close(
+      _terms_and_grads(scene, reprojection_terms),
+      _terms_and_grads(
+          scene, reprojection_terms_sampled, *_all_pixels(scene)
+      ),
+  )
+
+
+@pytest.mark.parametrize("fn", [reprojection_terms, reprojection_terms_fused])
+def test_packed_matches_per_scene(fn):
+  scenes = [
+      benchmark_cvd.make_synthetic_scene(n, 24, 32, "cpu", seed=n)
+      for n in (6, 9)
+  ]
+  scenes[1]["K"] = scenes[1]["K"] * 1.1
+  scenes[1]["K"][2, 2] = 1.0
+  scenes[1]["K_inv"] = torch.linalg.inv(scenes[1]["K"])
+  num_frames = torch.tensor([s["disp"].shape[0] for s in scenes])
+  num_pairs = torch.tensor([s["ii"].shape[0] for s in scenes])
+  offsets = [0, scenes[0]["disp"].shape[0]]
+
+  def cat(key):
+    return torch.cat([scene[key] for scene in scenes])
+
+  ii = torch.cat([s["ii"] + o for s, o in zip(scenes, offsets)])
+  jj = torch.cat([s["jj"] + o for s, o in zip(scenes, offsets)])
+  K = torch.cat([s["K"].expand(s["ii"].shape[0], 3, 3) for s in scenes])
+  segments = PackSegments(
+      torch.repeat_interleave(torch.arange(2), num_frames),
+      torch.repeat_interleave(torch.arange(2), num_pairs),
+      num_frames.float(),
+  )
+  packed = fn(
+      cat("cam_c2w"),
+      K,
+      torch.linalg.inv(K),
+      cat("disp"),
+      cat("uncertainty"),
+      cat("flows"),
+      cat("flow_masks"),
+      ii,
+      jj,
+      benchmark_cvd.ALPHA_MOTION,
+      segments=segments,
+  )
+  for k, scene in enumerate(scenes):
+    reference = _terms_and_grads(scene, fn)[:2]
+    _assert_close(reference, [term[k] for term in packed])
@@ -65,6 +65,9 @@ if __name__ == '__main__':
   parser.add_argument('--small', action='store_true', help='use small model')
   parser.add_argument('--scene_name', type=str, help='use small model')
   parser.add_argument('--datapath')
+  parser.add_argument(
+      '--stride', type=int, default=1, help='tracking stride of the scene'
+  )
 
   parser.add_argument('--path', help='dataset for evaluation')
   parser.add_argument(
@@ -98,12 +101,10 @@ if __name__ == '__main__':
   flow_model.eval()
 
   scene_name = args.scene_name
-  image_list = sorted(
-      glob.glob(os.path.join(args.datapath, '*.png'))
-  )  # [::stride]
-  image_list += sorted(
-      glob.glob(os.path.join(args.datapath, '*.jpg'))
-  )  # [::stride]
+  image_list = sorted(glob.glob(os.path.join(args.datapath, '*.png')))
+  image_list += sorted(glob.glob(os.path.join(args.datapath, '*.jpg')))
+  # the frames stored by strided tracking without --keep_skipped
+  image_list = image_list[:: args.stride]
   
   print(f"Scene: {scene_name}")
   print(f"Data path: {args.datapath}")
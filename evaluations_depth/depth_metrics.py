@@ -0,0 +1,113 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Streaming video depth metrics.
+
+The predictions (usually a float16 memory map of the CVD output) and the GT
+are read a few frames at a time, so no full-video temporary is built. The
+metrics and the exact streaming medians of the scale/shift fit come from the
+torch library shared with UniDepth (UniDepth/unidepth/utils/depth_metrics.py)
+and run on CPU or GPU. That file only depends on torch and is loaded by path,
+so the rest of the unidepth package and its dependencies are not imported.
+"""
+
+import importlib.util
+import os
+
+import numpy as np
+import torch
+
+
+def _load_shared_metrics():
+  path = os.path.join(
+      os.path.dirname(os.path.abspath(__file__)),
+      "..",
+      "UniDepth",
+      "unidepth",
+      "utils",
+      "depth_metrics.py",
+  )
+  spec = importlib.util.spec_from_file_location("unidepth_depth_metrics", path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+depth_metrics = _load_shared_metrics()
+
+# MegaSaM metric name -> shared library name
+METRIC_NAMES = {
+    "abs_rel": "arel",
+    "log_rmse": "rmselog",
+    "threshold_1": "d1",
+    "threshold_2": "d2",
+    "threshold_3": "d3",
+}
+
+
+def evaluate_depth(
+    pred_depths,
+    gt_depths,
+    eps,
+    valid_masks=None,
+    chunk_frames=16,
+    device="cpu",
+):
+  """Depth metrics after a median-based scale and shift alignment.
+
+  Pixels with 0.1 < GT < 100 are evaluated; both depths are clipped to
+  [0.1, 100] and the aligned prediction of the log metrics to LOG_CLAMP.
+
+  Args:
+    pred_depths: [N, H, W] predicted depths, e.g. a memory map.
+    gt_depths: [N, H, W] GT depths without NaN/inf.
+    eps: offset of the median-centered depths in the scale fit.
+    valid_masks: optional precomputed [N, H, W] masks of the valid pixels.
+    chunk_frames: frames processed at a time.
+    device: torch device the metrics are computed on.
+
+  Returns:
+    dict with abs_rel, log_rmse and threshold_1/2/3.
+  """
+  assert pred_depths.shape == gt_depths.shape
+  num_frames = gt_depths.shape[0]
+
+  def chunks():
+    for k in range(0, num_frames, chunk_frames):
+      gt = torch.from_numpy(np.float32(gt_depths[k : k + chunk_frames]))
+      pred = torch.from_numpy(np.float32(pred_depths[k : k + chunk_frames]))
+      gt, pred = gt.to(device), pred.to(device)
+      if valid_masks is None:
+        valid_mask = (gt < 100) & (gt > 0.1)
+      else:
+        valid_mask = torch.from_numpy(
+            np.asarray(valid_masks[k : k + chunk_frames])
+        ).to(device)
+      yield gt.clamp(0.1, 100.0), pred.clamp(0.1, 100.0), valid_mask
+
+  def valid():
+    for gt, pred, valid_mask in chunks():
+      yield gt[valid_mask], pred[valid_mask]
+
+  scale, shift = depth_metrics.streaming_median_scale_shift(valid, eps)
+  scale, shift = scale.to(device), shift.to(device)
+
+  metrics = depth_metrics.MetricAccumulator(
+      list(METRIC_NAMES.values()), log_clamp=depth_metrics.LOG_CLAMP
+  )
+  for gt, pred, valid_mask in chunks():
+    metrics.update(gt, pred * scale + shift, valid_mask)
+  result = metrics.compute()
+  return {name: result[lib_name] for name, lib_name in METRIC_NAMES.items()}
@@ -15,111 +15,155 @@
 
 """Evaluate depth for DyCheck dataset."""
 
+# pylint: disable=g-import-not-at-top
+
+import argparse
 import glob
 import os
+import sys
 import cv2
+from depth_metrics import evaluate_depth
+import gt_store
 import numpy as np
 
+sys.path.append("cvd_opt")
+from lean_output import load_output
 
-if __name__ == "__main__":
-  scene_names = ["apple", "block", "creeper", "handwavy"]
-  scene_names += ["haru-sit", "mochi-high-five", "paper-windmill"]
-  scene_names += ["pillow", "spin", "sriracha-tree", "teddy", "backpack"]
-  ate = []
-  rte = []
-  rre = []
+# offset of the median-centered depths in the scale fit
+EPS = 1e-8
 
-  gt_root_dir = "/home/zhengqili/dycheck"
-  pred_root_dir = "./outputs_cvd_dycheck"
+# GT depth is resized to about num_pixels and cropped to a multiple of 8
+GT_PARAMS = {"num_pixels": 384 * 512, "min_depth": 0.1, "max_depth": 100.0}
 
-  abs_rel_list = []
-  log_rmse_list = []
-  threshold_1_list = []
-  threshold_2_list = []
-  threshold_3_list = []
+SCENE_NAMES = ["apple", "block", "creeper", "handwavy"]
+SCENE_NAMES += ["haru-sit", "mochi-high-five", "paper-windmill"]
+SCENE_NAMES += ["pillow", "spin", "sriracha-tree", "teddy", "backpack"]
 
-  for scene_name in scene_names:
-    print(scene_name)
-    gt_list = sorted(
-        glob.glob(
-            os.path.join(gt_root_dir, scene_name, "depth", "2x", "0_*.npy")
-        )
-    )
 
-    gt_depths = []
-    for i, gt_path in enumerate(gt_list):
-      gt_depth = np.float32(np.load(gt_path))[..., -1]
-      h0, w0 = gt_depth.shape
-      h1 = int(h0 * np.sqrt((384 * 512) / (h0 * w0)))
-      w1 = int(w0 * np.sqrt((384 * 512) / (h0 * w0)))
-      gt_depth = cv2.resize(gt_depth, (w1, h1), interpolation=cv2.INTER_LINEAR)
-      gt_depth = gt_depth[: h1 - h1 % 8, : w1 - w1 % 8]
-      gt_depth = cv2.resize(
-          gt_depth,
-          (gt_depth.shape[-1], gt_depth.shape[-2]),
-          interpolation=cv2.INTER_LINEAR,
-      )
-      gt_depths.append(gt_depth)
+def gt_sources(gt_root_dir, scene_name):
+  """GT depth files the stored arrays of a scene are computed from."""
+  return sorted(
+      glob.glob(os.path.join(gt_root_dir, scene_name, "depth", "2x", "0_*.npy"))
+  )
 
-    gt_depths = np.array(gt_depths)
-    gt_depths = np.nan_to_num(
-        gt_depths, copy=True, nan=0.0, posinf=1e3, neginf=0.0
-    )
 
-    cvd_data = np.load(
-        os.path.join(pred_root_dir, "%s_sgd_cvd_hr.npz" % scene_name)
-    )
-    pred_depths = cvd_data["depths"]
+def load_gt(gt_root_dir, scene_name, gt_cache_dir="gt_cache"):
+  """GT depth and valid mask at the resolution of the CVD outputs.
 
-    assert pred_depths.shape == gt_depths.shape
-    valid_mask = (gt_depths < 100) & (gt_depths > 0.1)
+  The preprocessed GT is kept in a GTStore under gt_cache_dir.
 
-    pred_depths = np.clip(pred_depths, 0.1, 100.0)
-    gt_depths = np.clip(gt_depths, 0.1, 100.0)
+  Args:
+    gt_root_dir: dataset root.
+    scene_name: scene name.
+    gt_cache_dir: GT store directory.
 
-    gt_d_ms = gt_depths[valid_mask] - np.median(gt_depths[valid_mask]) + 1e-8
-    pred_d_ms = (
-        pred_depths[valid_mask] - np.median(pred_depths[valid_mask]) + 1e-8
-    )
+  Returns:
+    [N, H, W] float32 depth without NaN/inf and [N, H, W] bool valid mask,
+    as read-only memory maps.
+  """
+  gt_list = gt_sources(gt_root_dir, scene_name)
 
-    scale = np.median(gt_d_ms / pred_d_ms)
-    shift = np.median(gt_depths[valid_mask] - scale * pred_depths[valid_mask])
+  def build(store):
+    for i, gt_path in enumerate(gt_list):
+      gt_depth = np.float32(np.load(gt_path))[..., -1]
+      if i == 0:
+        h0, w0 = gt_depth.shape
+        scale = np.sqrt(GT_PARAMS["num_pixels"] / (h0 * w0))
+        h1, w1 = int(h0 * scale), int(w0 * scale)
+        shape = (len(gt_list), h1 - h1 % 8, w1 - w1 % 8)
+        depths = store.create("depth", shape, np.float32)
+        valid = store.create("valid", shape, bool)
+      gt_depth = cv2.resize(gt_depth, (w1, h1), interpolation=cv2.INTER_LINEAR)
+      depths[i] = np.nan_to_num(
+          gt_depth[: shape[1], : shape[2]],
+          copy=False,
+          nan=0.0,
+          posinf=1e3,
+          neginf=0.0,
+      )
+      valid[i] = (depths[i] < GT_PARAMS["max_depth"]) & (
+          depths[i] > GT_PARAMS["min_depth"]
+      )
+    depths.flush()
+    valid.flush()
+
+  store = gt_store.GTStore(
+      gt_cache_dir, "dycheck", scene_name, gt_list, **GT_PARAMS
+  )
+  gt = store.get(build)
+  return gt["depth"], gt["valid"]
+
+
+def prediction_paths(scene_name, pred_root_dir):
+  """Files the result of a scene depends on."""
+  stem = os.path.join(pred_root_dir, "%s_sgd_cvd_hr" % scene_name)
+  return [stem, stem + ".npz"]
+
+
+def evaluate_scene(
+    scene_name,
+    gt_root_dir,
+    pred_root_dir,
+    gt_cache_dir="gt_cache",
+    device="cpu",
+):
+  """Depth metrics of the CVD output of a scene.
+
+  Args:
+    scene_name: DyCheck scene.
+    gt_root_dir: DyCheck root with <scene>/depth/2x/0_*.npy.
+    pred_root_dir: CVD output directory.
+    gt_cache_dir: GT store directory.
+    device: torch device of the metric computation.
+
+  Returns:
+    dict with abs_rel, log_rmse and threshold_1/2/3 after a median-based
+    scale and shift alignment.
+  """
+  gt_depths, valid_masks = load_gt(gt_root_dir, scene_name, gt_cache_dir)
+  cvd_data = load_output(
+      os.path.join(pred_root_dir, "%s_sgd_cvd_hr" % scene_name)
+  )
+  return evaluate_depth(
+      cvd_data["depths"], gt_depths, EPS, valid_masks, device=device
+  )
 
-    pred_depths = pred_depths * scale + shift
 
-    abs_rel = np.mean(
-        np.abs(pred_depths[valid_mask] - gt_depths[valid_mask])
-        / gt_depths[valid_mask]
-    )
-    log_rmse = np.sqrt(
-        np.mean(
-            (
-                np.log(np.clip(pred_depths[valid_mask], 1e-3, 1e6))
-                - np.log(gt_depths[valid_mask])
-            )
-            ** 2
-        )
-    )
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--gt_root_dir", type=str, default="dycheck")
+  parser.add_argument(
+      "--pred_root_dir", type=str, default="outputs_cvd_dycheck"
+  )
+  parser.add_argument("--gt_cache_dir", type=str, default="gt_cache")
+  parser.add_argument("--device", type=str, default="cpu")
+  args = parser.parse_args()
+
+  abs_rel_list = []
+  log_rmse_list = []
+  threshold_1_list = []
+  threshold_2_list = []
+  threshold_3_list = []
 
-    # Calculate the accuracy thresholds
-    max_ratio = np.maximum(
-        pred_depths[valid_mask] / gt_depths[valid_mask],
-        gt_depths[valid_mask] / pred_depths[valid_mask],
+  for scene_name in SCENE_NAMES:
+    result = evaluate_scene(
+        scene_name,
+        args.gt_root_dir,
+        args.pred_root_dir,
+        args.gt_cache_dir,
+        args.device,
     )
-    threshold_1 = np.mean(max_ratio < 1.25)
-    threshold_2 = np.mean(max_ratio < 1.25**2)
-    threshold_3 = np.mean(max_ratio < 1.25**3)
 
     print(scene_name)
-    print("abs_rel ", abs_rel)
-    print("log_rmse ", log_rmse)
-    print("threshold_1 ", threshold_1)
-
-    abs_rel_list.append(abs_rel)
-    log_rmse_list.append(log_rmse)
-    threshold_1_list.append(threshold_1)
-    threshold_2_list.append(threshold_2)
-    threshold_3_list.append(threshold_3)
+    print("abs_rel ", result["abs_rel"])
+    print("log_rmse ", result["log_rmse"])
+    print("threshold_1 ", result["threshold_1"])
+
+    abs_rel_list.append(result["abs_rel"])
+    log_rmse_list.append(result["log_rmse"])
+    threshold_1_list.append(result["threshold_1"])
+    threshold_2_list.append(result["threshold_2"])
+    threshold_3_list.append(result["threshold_3"])
 
   print("abs_rel: ", np.mean(abs_rel_list))
   print("log_rmse: ", np.mean(log_rmse_list))
@@ -15,106 +15,157 @@
 
 """Evaluate depth for Sintel dataset."""
 
+# pylint: disable=g-import-not-at-top
+
+import argparse
 import glob
 import os
+import sys
 import cv2
+from depth_metrics import evaluate_depth
+import gt_store
 import numpy as np
 
+sys.path.append("cvd_opt")
+from lean_output import load_output
 
-if __name__ == "__main__":
-  scene_names = ["alley_1", "alley_2", "temple_2", "temple_3", "market_5"]
-  scene_names += ["mountain_1", "bamboo_2", "bamboo_1"]
-  scene_names += ["ambush_4", "ambush_5", "ambush_6"]
-  scene_names += ["market_2", "market_6", "cave_4"]
-  scene_names += ["cave_2", "shaman_3", "sleeping_1", "sleeping_2"]
-  ate = []
-  rte = []
-  rre = []
-
-  gt_root_dir = "/mnt/d/mega-sam/Sintel"
-  pred_root_dir = "./outputs_cvd_sintel"
+# offset of the median-centered depths in the scale fit
+EPS = 1e-6
 
-  abs_rel_list = []
-  log_rmse_list = []
-  threshold_1_list = []
-  threshold_2_list = []
-  threshold_3_list = []
+# GT depth is resized to about num_pixels and cropped to a multiple of 8
+GT_PARAMS = {"num_pixels": 384 * 512, "min_depth": 0.1, "max_depth": 100.0}
 
-  for scene_name in scene_names:
-    print(scene_name)
-    gt_list = sorted(
-        glob.glob(os.path.join(gt_root_dir, scene_name, "depth", "*.npy"))
-    )
+SCENE_NAMES = ["alley_1", "alley_2", "temple_2", "temple_3", "market_5"]
+SCENE_NAMES += ["mountain_1", "bamboo_2", "bamboo_1"]
+SCENE_NAMES += ["ambush_4", "ambush_5", "ambush_6"]
+SCENE_NAMES += ["market_2", "market_6", "cave_4"]
+SCENE_NAMES += ["cave_2", "shaman_3", "sleeping_1", "sleeping_2"]
 
-    gt_depth_list = []
-    for i, gt_path in enumerate(gt_list):
-      gt_depth = np.float32(np.load(gt_path))
-      h0, w0 = gt_depth.shape
-      h1 = int(h0 * np.sqrt((384 * 512) / (h0 * w0)))
-      w1 = int(w0 * np.sqrt((384 * 512) / (h0 * w0)))
-      gt_depth = cv2.resize(gt_depth, (w1, h1), interpolation=cv2.INTER_LINEAR)
-      gt_depth = gt_depth[: h1 - h1 % 8, : w1 - w1 % 8]
-      gt_depth_list.append(gt_depth)
 
-    gt_depths = np.array(gt_depth_list)
-    gt_depths = np.nan_to_num(
-        gt_depths, copy=True, nan=0.0, posinf=1e3, neginf=0.0
-    )
+def gt_sources(gt_root_dir, scene_name):
+  """GT depth files the stored arrays of a scene are computed from."""
+  return sorted(
+      glob.glob(os.path.join(gt_root_dir, scene_name, "depth", "*.npy"))
+  )
 
-    cvd_data = np.load(
-        os.path.join(pred_root_dir, "%s_sgd_cvd_hr.npz" % scene_name)
-    )
-    pred_depths = cvd_data["depths"]
 
-    assert pred_depths.shape == gt_depths.shape
-    valid_mask = (gt_depths < 100) & (gt_depths > 0.1)
+def load_gt(gt_root_dir, scene_name, gt_cache_dir="gt_cache"):
+  """GT depth and valid mask at the resolution of the CVD outputs.
 
-    pred_depths = np.clip(pred_depths, 0.1, 100.0)
-    gt_depths = np.clip(gt_depths, 0.1, 100.0)
+  The preprocessed GT is kept in a GTStore under gt_cache_dir.
 
-    gt_d_ms = gt_depths[valid_mask] - np.median(gt_depths[valid_mask]) + 1e-6
-    pred_d_ms = (
-        pred_depths[valid_mask] - np.median(pred_depths[valid_mask]) + 1e-6
-    )
+  Args:
+    gt_root_dir: dataset root.
+    scene_name: scene name.
+    gt_cache_dir: GT store directory.
 
-    scale = np.median(gt_d_ms / pred_d_ms)
-    shift = np.median(gt_depths[valid_mask] - scale * pred_depths[valid_mask])
+  Returns:
+    [N, H, W] float32 depth without NaN/inf and [N, H, W] bool valid mask,
+    as read-only memory maps.
+  """
+  gt_list = gt_sources(gt_root_dir, scene_name)
 
-    pred_depths = pred_depths * scale + shift
+  def build(store):
+    for i, gt_path in enumerate(gt_list):
+      gt_depth = np.float32(np.load(gt_path))
+      if i == 0:
+        h0, w0 = gt_depth.shape
+        scale = np.sqrt(GT_PARAMS["num_pixels"] / (h0 * w0))
+        h1, w1 = int(h0 * scale), int(w0 * scale)
+        shape = (len(gt_list), h1 - h1 % 8, w1 - w1 % 8)
+        depths = store.create("depth", shape, np.float32)
+        valid = store.create("valid", shape, bool)
+      gt_depth = cv2.resize(gt_depth, (w1, h1), interpolation=cv2.INTER_LINEAR)
+      depths[i] = np.nan_to_num(
+          gt_depth[: shape[1], : shape[2]],
+          copy=False,
+          nan=0.0,
+          posinf=1e3,
+          neginf=0.0,
+      )
+      valid[i] = (depths[i] < GT_PARAMS["max_depth"]) & (
+          depths[i] > GT_PARAMS["min_depth"]
+      )
+    depths.flush()
+    valid.flush()
+
+  store = gt_store.GTStore(
+      gt_cache_dir, "sintel", scene_name, gt_list, **GT_PARAMS
+  )
+  gt = store.get(build)
+  return gt["depth"], gt["valid"]
+
+
+def prediction_paths(scene_name, pred_root_dir):
+  """Files the result of a scene depends on."""
+  stem = os.path.join(pred_root_dir, "%s_sgd_cvd_hr" % scene_name)
+  return [stem, stem + ".npz"]
+
+
+def evaluate_scene(
+    scene_name,
+    gt_root_dir,
+    pred_root_dir,
+    gt_cache_dir="gt_cache",
+    device="cpu",
+):
+  """Depth metrics of the CVD output of a scene.
+
+  Args:
+    scene_name: Sintel scene.
+    gt_root_dir: Sintel root with <scene>/depth/*.npy.
+    pred_root_dir: CVD output directory.
+    gt_cache_dir: GT store directory.
+    device: torch device of the metric computation.
+
+  Returns:
+    dict with abs_rel, log_rmse and threshold_1/2/3 after a median-based
+    scale and shift alignment.
+  """
+  gt_depths, valid_masks = load_gt(gt_root_dir, scene_name, gt_cache_dir)
+  cvd_data = load_output(
+      os.path.join(pred_root_dir, "%s_sgd_cvd_hr" % scene_name)
+  )
+  return evaluate_depth(
+      cvd_data["depths"], gt_depths, EPS, valid_masks, device=device
+  )
 
-    abs_rel = np.mean(
-        np.abs(pred_depths[valid_mask] - gt_depths[valid_mask])
-        / gt_depths[valid_mask]
-    )
-    log_rmse = np.sqrt(
-        np.mean(
-            (
-                np.log(np.clip(pred_depths[valid_mask], 1e-3, 1e6))
-                - np.log(gt_depths[valid_mask])
-            )
-            ** 2
-        )
-    )
 
-    # Calculate the accuracy thresholds
-    max_ratio = np.maximum(
-        pred_depths[valid_mask] / gt_depths[valid_mask],
-        gt_depths[valid_mask] / pred_depths[valid_mask],
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--gt_root_dir", type=str, default="Sintel")
+  parser.add_argument(
+      "--pred_root_dir", type=str, default="outputs_cvd_sintel"
+  )
+  parser.add_argument("--gt_cache_dir", type=str, default="gt_cache")
+  parser.add_argument("--device", type=str, default="cpu")
+  args = parser.parse_args()
+
+  abs_rel_list = []
+  log_rmse_list = []
+  threshold_1_list = []
+  threshold_2_list = []
+  threshold_3_list = []
+
+  for scene_name in SCENE_NAMES:
+    result = evaluate_scene(
+        scene_name,
+        args.gt_root_dir,
+        args.pred_root_dir,
+        args.gt_cache_dir,
+        args.device,
     )
-    threshold_1 = np.mean(max_ratio < 1.25)
-    threshold_2 = np.mean(max_ratio < 1.25**2)
-    threshold_3 = np.mean(max_ratio < 1.25**3)
 
     print(scene_name)
-    print("abs_rel ", abs_rel)
-    print("log_rmse ", log_rmse)
-    print("threshold_1 ", threshold_1)
-
-    abs_rel_list.append(abs_rel)
-    log_rmse_list.append(log_rmse)
-    threshold_1_list.append(threshold_1)
-    threshold_2_list.append(threshold_2)
-    threshold_3_list.append(threshold_3)
+    print("abs_rel ", result["abs_rel"])
+    print("log_rmse ", result["log_rmse"])
+    print("threshold_1 ", result["threshold_1"])
+
+    abs_rel_list.append(result["abs_rel"])
+    log_rmse_list.append(result["log_rmse"])
+    threshold_1_list.append(result["threshold_1"])
+    threshold_2_list.append(result["threshold_2"])
+    threshold_3_list.append(result["threshold_3"])
 
   print("abs_rel: ", np.mean(abs_rel_list))
   print("log_rmse: ", np.mean(log_rmse_list))
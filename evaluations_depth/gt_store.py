@@ -0,0 +1,117 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Memory-mapped store of preprocessed ground truth.
+
+The evaluators resize and crop the DyCheck and Sintel GT depth of every frame
+to the CVD output resolution and rebuild the GT poses (from extrinsics.npy or
+the COLMAP binaries) on every run. GTStore keeps the result per scene in
+`<root>/<dataset>/<scene>_<key>/`, where key hashes the preprocessing
+parameters and the (path, size, mtime) of the GT source files. It holds one
+`<name>.npy` per array; `meta.json` is written last and marks the store
+complete. Later runs, and all workers of a parallel run, memory-map the
+arrays instead of redoing the preprocessing.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def store_key(sources, **params):
+  """Hashes the GT source files and the preprocessing parameters."""
+  sha1 = hashlib.sha1()
+  for path in sources:
+    stat = os.stat(path)
+    sha1.update(
+        ("%s:%d:%d\n" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        .encode()
+    )
+  sha1.update(json.dumps(params, sort_keys=True).encode())
+  return sha1.hexdigest()[:16]
+
+
+class GTStore:
+  """Preprocessed GT arrays of one scene."""
+
+  def __init__(self, root, dataset, scene_name, sources, **params):
+    """Opens the store of a scene.
+
+    Args:
+      root: cache directory, e.g. gt_cache.
+      dataset: dataset name, e.g. sintel.
+      scene_name: scene name.
+      sources: GT files the arrays are computed from.
+      **params: preprocessing parameters, e.g. the target resolution.
+    """
+    key = store_key(sources, **params)
+    self.path = os.path.join(root, dataset, "%s_%s" % (scene_name, key))
+    self.params = params
+    self.names = []
+
+  @property
+  def complete(self):
+    return os.path.isfile(os.path.join(self.path, "meta.json"))
+
+  def create(self, name, shape, dtype):
+    """Returns a writable memory map for the array name."""
+    os.makedirs(self.path, exist_ok=True)
+    self.names.append(name)
+    return np.lib.format.open_memmap(
+        os.path.join(self.path, name + ".npy"),
+        mode="w+",
+        dtype=dtype,
+        shape=shape,
+    )
+
+  def save(self, name, array):
+    """Stores an array computed in memory."""
+    os.makedirs(self.path, exist_ok=True)
+    self.names.append(name)
+    np.save(os.path.join(self.path, name + ".npy"), array)
+
+  def commit(self):
+    """Marks the store complete."""
+    meta = {"names": self.names, "params": self.params}
+    tmp_path = os.path.join(self.path, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+      json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+  def load(self):
+    """Returns the stored arrays as read-only memory maps."""
+    with open(os.path.join(self.path, "meta.json")) as f:
+      meta = json.load(f)
+    return {
+        name: np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+        for name in meta["names"]
+    }
+
+  def get(self, build):
+    """Loads the store, running build(self) first if it is incomplete.
+
+    Args:
+      build: writes the arrays with create() and save().
+
+    Returns:
+      dict of read-only memory maps.
+    """
+    if not self.complete:
+      self.names = []
+      build(self)
+      self.commit()
+    return self.load()
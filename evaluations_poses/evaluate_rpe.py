@@ -19,7 +19,6 @@ This script computes the relative pose error from the ground truth trajectory
 and the estimated trajectory.
 """
 
-import random
 import numpy as np
 
 
@@ -58,67 +57,117 @@ def distances_along_trajectory(traj):
   return distances
 
 
+def se3_inverse(transforms):
+  """Closed-form inverse of [..., 4, 4] rigid transforms."""
+  rot_t = np.swapaxes(transforms[..., :3, :3], -1, -2)
+  inverse = np.zeros_like(transforms)
+  inverse[..., :3, :3] = rot_t
+  inverse[..., :3, 3] = -np.einsum(
+      "...ij,...j->...i", rot_t, transforms[..., :3, 3]
+  )
+  inverse[..., 3, 3] = 1.0
+  return inverse
+
+
+def rotation_angles(transforms):
+  """Rotation angles of [..., 4, 4] transforms, as compute_angle."""
+  trace = np.trace(transforms[..., :3, :3], axis1=-2, axis2=-1)
+  return np.arccos(np.clip((trace - 1) / 2, -1, 1))
+
+
+def relative_pose_errors(traj_gt, traj_est, i, j):
+  """Relative pose errors of the pairs (i, j), batched.
+
+  Args:
+    traj_gt: [N, 4, 4] ground truth poses.
+    traj_est: [N, 4, 4] estimated poses.
+    i: [P] first frame of each pair.
+    j: [P] second frame of each pair.
+
+  Returns:
+    ([P] translational errors, [P] rotational errors in radians).
+  """
+  rel_est = np.einsum("pij,pjk->pik", se3_inverse(traj_est[j]), traj_est[i])
+  rel_gt = np.einsum("pij,pjk->pik", se3_inverse(traj_gt[j]), traj_gt[i])
+  error44 = np.einsum("pij,pjk->pik", se3_inverse(rel_est), rel_gt)
+  return np.linalg.norm(error44[:, :3, 3], axis=-1), rotation_angles(error44)
+
+
+def rpe_pairs(num_poses, max_pairs=10000, fixed_delta=False, delta=1, seed=0):
+  """Frame pairs evaluated by evaluate_trajectory.
+
+  Args:
+    num_poses: trajectory length.
+    max_pairs: maximum number of pairs, 0 for no limit.
+    fixed_delta: only pairs (i, i + delta), otherwise all pairs.
+    delta: pair distance with fixed_delta.
+    seed: seed of the pair sampling.
+
+  Returns:
+    ([P] i, [P] j) int arrays. Above max_pairs, pairs are sampled uniformly:
+    with replacement among all pairs, without among fixed-delta pairs.
+  """
+  rng = np.random.default_rng(seed)
+  if not fixed_delta:
+    if max_pairs == 0 or num_poses < np.sqrt(max_pairs):
+      i, j = np.divmod(np.arange(num_poses * num_poses), num_poses)
+    else:
+      i = rng.integers(0, num_poses, size=max_pairs)
+      j = rng.integers(0, num_poses, size=max_pairs)
+  else:
+    i = np.arange(max(num_poses - delta, 0))
+    if max_pairs != 0 and i.shape[0] > max_pairs:
+      i = np.sort(rng.choice(i, size=max_pairs, replace=False))
+    j = i + delta
+  return i, j
+
+
 def evaluate_trajectory(
     traj_gt,
     traj_est,
     param_max_pairs=10000,
     param_fixed_delta=False,
-    param_delta=1.00,
+    param_delta=1,
+    seed=0,
+    chunk_pairs=1 << 20,
 ):
   """Compute the relative pose error between two trajectories.
 
   Args:
-    traj_gt: the first trajectory (ground truth)
-    traj_est: the second trajectory (estimated trajectory)
+    traj_gt: the first trajectory (ground truth), [N, 4, 4] or a list of 4x4
+      poses
+    traj_est: the second trajectory (estimated trajectory), as traj_gt
     param_max_pairs: number of relative poses to be evaluated
     param_fixed_delta: false- evaluate over all possible pairs
                        true- only evaluate over pairs with a given
                          distance (delta)
     param_delta: distance between the evaluated pairs
+    seed: seed of the pair sampling
+    chunk_pairs: pairs evaluated per batch
 
   Returns:
-    list of compared poses and the resulting translation and rotation error
+    [P, 4] array of compared poses and the resulting translation and rotation
+    error, one (i, j, trans, rot) row per pair
 
   Raises:
     Exception: if no pairs can be found between the trajectories
   """
-
-  if not param_fixed_delta:
-    if param_max_pairs == 0 or len(traj_est) < np.sqrt(param_max_pairs):
-      pairs = [
-          (i, j) for i in range(len(traj_est)) for j in range(len(traj_est))  # pylint: disable=g-complex-comprehension
-      ]
-    else:
-      pairs = [
-          (
-              random.randint(0, len(traj_est) - 1),
-              random.randint(0, len(traj_est) - 1),
-          )
-          for _ in range(param_max_pairs)
-      ]
-  else:
-    pairs = []
-    for i in range(len(traj_est)):
-      j = i + param_delta
-      if j < len(traj_est):
-        pairs.append((i, j))
-    if param_max_pairs != 0 and len(pairs) > param_max_pairs:
-      pairs = random.sample(pairs, param_max_pairs)
-
-  result = []
-  for i, j in pairs:
-    # print(i, j)
-    error44 = ominus(
-        ominus(traj_est[j], traj_est[i]), ominus(traj_gt[j], traj_gt[i])
+  traj_gt = np.asarray(traj_gt, dtype=np.float64)
+  traj_est = np.asarray(traj_est, dtype=np.float64)
+  i, j = rpe_pairs(
+      len(traj_est), param_max_pairs, param_fixed_delta, int(param_delta), seed
+  )
+
+  result = np.empty((i.shape[0], 4))
+  result[:, 0] = i
+  result[:, 1] = j
+  for k in range(0, i.shape[0], chunk_pairs):
+    result[k : k + chunk_pairs, 2], result[k : k + chunk_pairs, 3] = (
+        relative_pose_errors(
+            traj_gt, traj_est, i[k : k + chunk_pairs], j[k : k + chunk_pairs]
+        )
     )
 
-    # breakpoint()
-
-    trans = compute_distance(error44)
-    rot = compute_angle(error44)
-
-    result.append([i, j, trans, rot])
-
   if len(result) < 2:
     raise Exception(   # pylint: disable=broad-exception-raised
         "Couldn't find pairs between groundtruth and estimated trajectory!"
@@ -15,13 +15,21 @@
 
 """Evaluate Sintel dataset."""
 
+# pylint: disable=g-import-not-at-top
 # pylint: disable=invalid-name
 
+import argparse
+import json
 import os
+import sys
 from evaluate_rpe import evaluate_trajectory
 from lietorch import SE3  # pylint: disable=g-importing-member
 import numpy as np
 import torch
+from trajectory_align import align_trajectories
+
+sys.path.append("evaluations_depth")
+import gt_store
 
 
 def rotmat2qvec(R):
@@ -43,131 +51,142 @@ def rotmat2qvec(R):
   return qvec
 
 
-def align_trajectories(model, data):
-  """Align two trajectories using the method of Horn (closed-form).
+# the GT translations are divided by the first-to-last camera distance
+GT_PARAMS = {"normalize": "first_to_last"}
 
-  Args:
-    model: first trajectory (3xn)
-    data: second trajectory (3xn)
+SCENE_NAMES = ["alley_1", "alley_2", "temple_2", "temple_3", "market_5"]
+SCENE_NAMES += [
+    "mountain_1",
+    "bamboo_2",
+    "bamboo_1",
+]
+SCENE_NAMES += ["ambush_4", "ambush_5", "ambush_6"]
+SCENE_NAMES += ["market_2", "market_6", "cave_4"]
+SCENE_NAMES += ["cave_2", "shaman_3", "sleeping_1", "sleeping_2"]
 
-  Returns:
-    rot: rotation matrix (3x3)
-    trans: translation vector (3x1)
-    trans_error: translational error per point (1xn)
-  """
-  np.set_printoptions(precision=3, suppress=True)
-  model_mean = [[model.mean(1)[0]], [model.mean(1)[1]], [model.mean(1)[2]]]
-  data_mean = [[data.mean(1)[0]], [data.mean(1)[1]], [data.mean(1)[2]]]
-  model_zerocentered = model - model_mean
-  data_zerocentered = data - data_mean
-
-  W = np.zeros((3, 3))
-  for column in range(model.shape[1]):
-    W += np.outer(model_zerocentered[:, column], data_zerocentered[:, column])
-  U, _, Vh = np.linalg.linalg.svd(W.transpose())
-  S = np.matrix(np.identity(3))
-  if np.linalg.det(U) * np.linalg.det(Vh) < 0:
-    S[2, 2] = -1
-  rot = U * S * Vh  # pylint: disable=redefined-outer-name
-
-  rotmodel = rot * model_zerocentered
-  dots = 0.0
-  norms = 0.0
-
-  for column in range(data_zerocentered.shape[1]):
-    dots += np.dot(
-        data_zerocentered[:, column].transpose(), rotmodel[:, column]
-    )
-    normi = np.linalg.norm(model_zerocentered[:, column])
-    norms += normi * normi
 
-  s = float(dots / norms)
+def gt_sources(gt_root_dir, scene_name):
+  """GT files the stored poses of a scene are computed from."""
+  return [os.path.join(gt_root_dir, scene_name, "extrinsics.npy")]
 
-  # print ("scale: %f " % s)
-  trans = data_mean - s * rot * model_mean  # pylint: disable=redefined-outer-name
 
-  model_aligned = s * rot * model + trans
-  alignment_error = model_aligned - data
+def load_gt(gt_root_dir, scene_name, gt_cache_dir="gt_cache"):
+  """[N, 4, 4] GT cam2world, normalized by the first-to-last translation.
 
-  trans_error = np.sqrt(  # pylint: disable=redefined-outer-name
-      np.sum(np.multiply(alignment_error, alignment_error), 0)
-  ).A[0]
+  Kept in a GTStore under gt_cache_dir, returned as a read-only memory map.
+  """
+  sources = gt_sources(gt_root_dir, scene_name)
+
+  def build(store):
+    gt_cam2w = np.load(sources[0])
+    full_t = np.dot(np.linalg.inv(gt_cam2w[-1]), gt_cam2w[0])
+    normalize_scale = np.linalg.norm(full_t[:3, 3]) + 1e-8
+    gt_cam2w[:, :3, 3] /= normalize_scale
+    store.save("cam2w", gt_cam2w)
 
-  return rot, trans, trans_error, s, model_aligned
+  store = gt_store.GTStore(
+      gt_cache_dir, "sintel", scene_name, sources, **GT_PARAMS
+  )
+  return store.get(build)["cam2w"]
 
 
-if __name__ == "__main__":
-  scene_names = []
-  scene_names += ["alley_1", "alley_2", "temple_2", "temple_3", "market_5"]
-  scene_names += [
-      "mountain_1",
-      "bamboo_2",
-      "bamboo_1",
+def prediction_paths(scene_name, rootdir):
+  """Files the result of a scene depends on."""
+  return [
+      os.path.join(rootdir, scene_name, name)
+      for name in ("poses.npy", "poses_full.npy", "tracking.json")
   ]
-  scene_names += ["ambush_4", "ambush_5", "ambush_6"]
-  scene_names += ["market_2", "market_6", "cave_4"]
-  scene_names += ["cave_2", "shaman_3", "sleeping_1", "sleeping_2"]
 
-  ate = []
-  rte = []
-  rre = []
 
-  gt_root_dir = "/mnt/d/mega-sam/Sintel"
-  rootdir = "%s/reconstructions" % os.getcwd()
+def evaluate_scene(scene_name, gt_root_dir, rootdir, gt_cache_dir="gt_cache"):
+  """ATE, RTE and RRE of the tracked poses of a scene.
 
-  for scene_name in scene_names:
-    gt_path = os.path.join(gt_root_dir, scene_name, "extrinsics.npy")
-    gt_cam2w = np.load(gt_path)
-    poses = np.load(os.path.join(rootdir, scene_name, "poses.npy"))
-    cam_c2w = SE3(
-        torch.as_tensor(poses, device="cpu")
-    ).inv()  # .matrix().numpy()
-    est_cam2w = cam_c2w.matrix().numpy()
-    num_cams = gt_cam2w.shape[0]
+  Args:
+    scene_name: Sintel scene.
+    gt_root_dir: Sintel root with <scene>/extrinsics.npy.
+    rootdir: reconstructions directory of the tracking run.
+    gt_cache_dir: GT store directory.
 
-    tstamps = [float(i / 30.0) for i in range(num_cams)]
-    assert gt_cam2w.shape[0] == est_cam2w.shape[0]
+  Returns:
+    dict with ate [m], rte [m] and rre [deg], plus the tracking stride and
+    time when the run recorded them.
+  """
+  gt_cam2w = load_gt(gt_root_dir, scene_name, gt_cache_dir)
+  # strided tracking (--stride) stores interpolated full-rate poses
+  poses_path = os.path.join(rootdir, scene_name, "poses_full.npy")
+  if not os.path.exists(poses_path):
+    poses_path = os.path.join(rootdir, scene_name, "poses.npy")
+  poses = np.load(poses_path)
+  cam_c2w = SE3(torch.as_tensor(poses, device="cpu")).inv()
+  est_cam2w = cam_c2w.matrix().numpy()
+  assert gt_cam2w.shape[0] == est_cam2w.shape[0]
+
+  rot, _, trans_error, _, align_tj = align_trajectories(
+      est_cam2w[:, :3, 3].transpose(1, 0), gt_cam2w[:, :3, 3].transpose(1, 0)
+  )
 
-    full_t = np.dot(np.linalg.inv(gt_cam2w[-1]), gt_cam2w[0])
-    normalize_scale = np.linalg.norm(full_t[:3, 3]) + 1e-8
-    gt_cam2w[:, :3, 3] /= normalize_scale
-    print(normalize_scale)
+  est_cam2w[:, :3, 3] = align_tj.transpose(1, 0)
+  est_cam2w[:, :3, :3] = rot @ est_cam2w[:, :3, :3]
 
-    rot, trans, trans_error, scale, align_tj = align_trajectories(
-        est_cam2w[:, :3, 3].transpose(1, 0), gt_cam2w[:, :3, 3].transpose(1, 0)
-    )
+  traj_est_dict = [est_cam2w[i, ...] for i in range(est_cam2w.shape[0])]
+  traj_gt_dict = [gt_cam2w[i, ...] for i in range(gt_cam2w.shape[0])]
+  rpe_result = evaluate_trajectory(
+      traj_gt_dict, traj_est_dict, param_fixed_delta=True, param_delta=1
+  )
 
-    est_cam2w[:, :3, 3] = (
-        scale * rot * est_cam2w[:, :3, 3].transpose(1, 0) + trans
-    ).transpose(1, 0)
+  rte_error = rpe_result[:, 2]
+  rre_error = rpe_result[:, 3]
 
-    for k in range(num_cams):
-      est_cam2w[k, :3, :3] = rot @ est_cam2w[k, :3, :3]
+  result = {
+      "ate": float(np.sqrt(np.mean(trans_error**2))),
+      "rte": float(np.sqrt(np.mean(rte_error**2))),
+      "rre": float(np.rad2deg(np.sqrt(np.mean(rre_error**2)))),
+  }
+  info_path = os.path.join(rootdir, scene_name, "tracking.json")
+  if os.path.exists(info_path):
+    with open(info_path) as f:
+      info = json.load(f)
+    result["stride"] = info["stride"]
+    result["tracking_seconds"] = info["seconds"]
+  return result
 
-    traj_est_dict = [est_cam2w[i, ...] for i in range(est_cam2w.shape[0])]
-    traj_gt_dict = [gt_cam2w[i, ...] for i in range(gt_cam2w.shape[0])]
-    rpe_result = evaluate_trajectory(
-        traj_gt_dict, traj_est_dict, param_fixed_delta=True, param_delta=1
-    )
 
-    rte_error = np.array(rpe_result)[:, 2]
-    rre_error = np.array(rpe_result)[:, 3]
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--gt_root_dir", type=str, default="Sintel")
+  parser.add_argument("--rootdir", type=str, default="reconstructions")
+  parser.add_argument("--gt_cache_dir", type=str, default="gt_cache")
+  args = parser.parse_args()
 
-    trans_error_mean = np.sqrt(np.mean(rte_error**2))
-    rot_error_mean = np.sqrt(np.mean(rre_error**2))
+  ate = []
+  rte = []
+  rre = []
+  tracking_info = []
 
-    print(scene_name)
-    print(
-        "absolute_translational_error.rmse %f m"
-        % np.sqrt(np.dot(trans_error, trans_error) / len(trans_error))
+  for scene_name in SCENE_NAMES:
+    result = evaluate_scene(
+        scene_name, args.gt_root_dir, args.rootdir, args.gt_cache_dir
     )
-    print("relative translational_error %f m" % trans_error_mean)
-    print("relative rotational_error %f deg" % np.rad2deg(rot_error_mean))
 
-    ate.append(np.sqrt(np.dot(trans_error, trans_error) / len(trans_error)))
-    rte.append(trans_error_mean)
-    rre.append(np.rad2deg(rot_error_mean))
+    print(scene_name)
+    print("absolute_translational_error.rmse %f m" % result["ate"])
+    print("relative translational_error %f m" % result["rte"])
+    print("relative rotational_error %f deg" % result["rre"])
+
+    ate.append(result["ate"])
+    rte.append(result["rte"])
+    rre.append(result["rre"])
+    if "stride" in result:
+      tracking_info.append(result)
 
   print("Average ATE: ", np.mean(ate))
   print("Average RTE: ", np.mean(rte))
   print("Average RRE: ", np.mean(rre))
+  if tracking_info:
+    print(
+        "Tracking stride(s) %s, average time %.1f s"
+        % (
+            sorted({info["stride"] for info in tracking_info}),
+            np.mean([info["tracking_seconds"] for info in tracking_info]),
+        )
+    )
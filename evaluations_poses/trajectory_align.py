@@ -0,0 +1,147 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Vectorized Sim(3)/SE(3) trajectory alignment (Horn / Umeyama).
+
+All routines take [..., 3, N] point arrays and broadcast over any leading
+batch dimensions, so many trajectories (e.g. all scenes of a benchmark, or
+RANSAC hypotheses) are aligned in one call.
+"""
+
+# pylint: disable=invalid-name
+
+import numpy as np
+
+
+def umeyama_alignment(model, data, with_scale=True, weights=None):
+  """Closed-form alignment of model onto data.
+
+  Args:
+    model: [..., 3, N] points to align.
+    data: [..., 3, N] target points.
+    with_scale: estimate a Sim(3) scale, otherwise SE(3) with scale 1.
+    weights: optional [..., N] non-negative point weights, e.g. a validity
+      mask for padded trajectories.
+
+  Returns:
+    rot [..., 3, 3], trans [..., 3, 1] and scale [...] such that
+    scale * rot @ model + trans approximates data.
+  """
+  model = np.asarray(model, dtype=np.float64)
+  data = np.asarray(data, dtype=np.float64)
+  if weights is None:
+    weights = np.ones(model.shape[:-2] + model.shape[-1:])
+  weights = np.asarray(weights, dtype=np.float64)[..., None, :]
+  weight_sum = np.sum(weights, axis=-1, keepdims=True)
+  if np.any(weight_sum <= 0):
+    raise ValueError("Alignment weights must not all be zero.")
+  weights = weights / weight_sum
+
+  model_mean = np.sum(weights * model, axis=-1, keepdims=True)
+  data_mean = np.sum(weights * data, axis=-1, keepdims=True)
+  model_zc = model - model_mean
+  data_zc = data - data_mean
+
+  # cross-covariance sum_k w_k model_k data_k^T
+  W = np.einsum("...in,...jn->...ij", weights * model_zc, data_zc)
+  U, _, Vh = np.linalg.svd(np.swapaxes(W, -1, -2))
+  S = np.broadcast_to(np.eye(3), W.shape).copy()
+  S[..., 2, 2] = np.where(np.linalg.det(U) * np.linalg.det(Vh) < 0, -1.0, 1.0)
+  rot = U @ S @ Vh
+
+  if with_scale:
+    rot_model = rot @ model_zc
+    dots = np.sum(weights * data_zc * rot_model, axis=(-2, -1))
+    norms = np.sum(weights * model_zc * model_zc, axis=(-2, -1))
+    scale = dots / norms
+  else:
+    scale = np.ones(W.shape[:-2])
+  trans = data_mean - scale[..., None, None] * rot @ model_mean
+  return rot, trans, scale
+
+
+def apply_alignment(rot, trans, scale, points):
+  """scale * rot @ points + trans for [..., 3, N] points."""
+  return scale[..., None, None] * rot @ points + trans
+
+
+def align_trajectories(
+    model,
+    data,
+    with_scale=True,
+    ransac_iters=0,
+    inlier_thresh=None,
+    seed=0,
+):
+  """Aligns trajectory positions, optionally robust to outliers.
+
+  Args:
+    model: [..., 3, N] first trajectory (estimate).
+    data: [..., 3, N] second trajectory (ground truth).
+    with_scale: Sim(3) alignment, otherwise SE(3).
+    ransac_iters: if > 0, number of minimal 3-point hypotheses; the final
+      alignment is refit on the inliers of the best one, or on all points
+      if it has fewer than 3.
+    inlier_thresh: inlier distance for RANSAC, in units of data.
+    seed: seed of the RANSAC sampling.
+
+  Returns:
+    rot: rotation matrix [..., 3, 3]
+    trans: translation vector [..., 3, 1]
+    trans_error: translational error per point [..., N]
+    s: scale [...]
+    model_aligned: aligned model [..., 3, N]
+  """
+  model = np.asarray(model, dtype=np.float64)
+  data = np.asarray(data, dtype=np.float64)
+  weights = None
+  if ransac_iters > 0:
+    if inlier_thresh is None:
+      raise ValueError("RANSAC alignment needs an inlier_thresh.")
+    weights = ransac_inliers(
+        model, data, with_scale, ransac_iters, inlier_thresh, seed
+    )
+  rot, trans, s = umeyama_alignment(model, data, with_scale, weights)
+  model_aligned = apply_alignment(rot, trans, s, model)
+  trans_error = np.linalg.norm(model_aligned - data, axis=-2)
+  return rot, trans, trans_error, s, model_aligned
+
+
+def ransac_inliers(model, data, with_scale, num_iters, inlier_thresh, seed=0):
+  """Inlier mask [..., N] of the best minimal-sample alignment.
+
+  All hypotheses of all trajectories are solved in one batched call. A
+  trajectory whose best hypothesis has fewer than 3 inliers, too few to refit
+  on, gets all of its points as inliers.
+  """
+  num_points = model.shape[-1]
+  rng = np.random.default_rng(seed)
+  # [H, 3] distinct point triplets
+  idx = np.argsort(rng.random((num_iters, num_points)), axis=-1)[:, :3]
+  model_h = np.moveaxis(model[..., idx], -2, -3)  # [..., H, 3, 3]
+  data_h = np.moveaxis(data[..., idx], -2, -3)
+  rot, trans, s = umeyama_alignment(model_h, data_h, with_scale)
+  residual = np.linalg.norm(
+      apply_alignment(rot, trans, s, model[..., None, :, :])
+      - data[..., None, :, :],
+      axis=-2,
+  )  # [..., H, N]
+  inliers = residual < inlier_thresh
+  best = np.argmax(np.sum(inliers, axis=-1), axis=-1)  # [...]
+  best_inliers = np.take_along_axis(
+      inliers, best[..., None, None], axis=-2
+  )[..., 0, :]
+  too_few = np.sum(best_inliers, axis=-1, keepdims=True) < 3
+  return best_inliers | too_few
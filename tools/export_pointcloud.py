@@ -0,0 +1,299 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Fused point cloud export of a MegaSaM reconstruction.
+
+Back-projects the depths of all frames of a CVD output (lean directory or
+_sgd_cvd_hr.npz, see cvd_opt/lean_output.py) with cam_c2w into world space,
+a few frames at a time, and writes one binary little-endian PLY with float
+xyz and uchar rgb vertices. With --voxel_size, points are merged in a hashed
+voxel grid: every chunk is reduced into the running per-voxel mean position
+and color, so memory is bounded by the number of occupied voxels and not by
+the number of pixels. Pixels that the tracker found dynamic can be dropped
+with the motion probability of the reconstruction. Run from the repository
+root:
+
+  python tools/export_pointcloud.py outputs_cvd/mountain_1_sgd_cvd_hr
+      mountain_1.ply --voxel_size 0.01
+      --motion_prob reconstructions/mountain_1/motion_prob.npy
+"""
+
+# pylint: disable=g-import-not-at-top
+
+import argparse
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.append("cvd_opt")
+from lean_output import load_output
+
+PLY_DTYPE = np.dtype([
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("z", "<f4"),
+    ("red", "u1"),
+    ("green", "u1"),
+    ("blue", "u1"),
+])
+# bits per voxel coordinate in the packed int64 voxel key
+KEY_BITS = 21
+# digits of the space-padded vertex count of a header patched after writing
+COUNT_WIDTH = 20
+
+
+def ply_header(num_vertices, padded=False):
+  """Header of a binary little-endian PLY with PLY_DTYPE vertices.
+
+  A padded header has the same length for any vertex count, so it can be
+  rewritten in place once the count is known.
+  """
+  lines = [
+      "ply",
+      "format binary_little_endian 1.0",
+      "element vertex %-*d" % (COUNT_WIDTH if padded else 0, num_vertices),
+      "property float x",
+      "property float y",
+      "property float z",
+      "property uchar red",
+      "property uchar green",
+      "property uchar blue",
+      "end_header",
+  ]
+  return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def to_vertices(xyz, rgb):
+  """[N] PLY_DTYPE records of [N, 3] positions and [N, 3] uint8 colors."""
+  vertices = np.empty(len(xyz), dtype=PLY_DTYPE)
+  vertices["x"], vertices["y"], vertices["z"] = np.asarray(xyz, np.float32).T
+  rgb = np.asarray(rgb)
+  vertices["red"], vertices["green"], vertices["blue"] = rgb.T
+  return vertices
+
+
+def write_ply(path, xyz, rgb):
+  """Writes a binary PLY in a single write.
+
+  Args:
+    path: output .ply path.
+    xyz: [N, 3] positions.
+    rgb: [N, 3] uint8 colors.
+  """
+  with open(path, "wb") as f:
+    f.write(ply_header(len(xyz)))
+    to_vertices(xyz, rgb).tofile(f)
+
+
+def pixel_rays(intrinsic, height, width, pixel_stride=1):
+  """[h * w, 3] camera rays K^-1 [u, v, 1] of the sampled pixels."""
+  v, u = np.mgrid[0:height:pixel_stride, 0:width:pixel_stride]
+  pixels = np.stack([u, v, np.ones_like(u)], axis=-1).reshape(-1, 3)
+  return (pixels @ np.linalg.inv(intrinsic).T).astype(np.float32)
+
+
+def voxel_keys(xyz, voxel_size):
+  """Packed int64 voxel keys of [N, 3] points, and the mask of those in range.
+
+  Each voxel coordinate takes KEY_BITS bits, so the grid spans
+  2^KEY_BITS voxels per axis centered on the origin.
+  """
+  offset = 1 << (KEY_BITS - 1)
+  ijk = np.floor(xyz / voxel_size).astype(np.int64) + offset
+  in_range = np.all((ijk >= 0) & (ijk < (1 << KEY_BITS)), axis=-1)
+  ijk = ijk[in_range]
+  keys = (ijk[:, 0] << (2 * KEY_BITS)) | (ijk[:, 1] << KEY_BITS) | ijk[:, 2]
+  return keys, in_range
+
+
+class VoxelGrid:
+  """Running per-voxel mean position and color of a stream of points."""
+
+  def __init__(self, voxel_size):
+    self.voxel_size = voxel_size
+    self.keys = np.empty(0, dtype=np.int64)
+    self.xyz_sum = np.empty((0, 3))
+    self.rgb_sum = np.empty((0, 3))
+    self.count = np.empty(0)
+    self.dropped = 0
+
+  def __len__(self):
+    return len(self.keys)
+
+  def add(self, xyz, rgb):
+    """Merges [N, 3] points and colors into the grid."""
+    keys, in_range = voxel_keys(xyz, self.voxel_size)
+    self.dropped += int(np.sum(~in_range))
+    keys = np.concatenate([self.keys, keys])
+    self.keys, inverse = np.unique(keys, return_inverse=True)
+    weights = np.concatenate([self.count, np.ones(len(keys) - len(self.count))])
+
+    def reduce(sums, values):
+      values = np.concatenate([sums, values[in_range]])
+      return np.stack(
+          [
+              np.bincount(inverse, values[:, k], minlength=len(self.keys))
+              for k in range(3)
+          ],
+          axis=-1,
+      )
+
+    self.xyz_sum = reduce(self.xyz_sum, xyz)
+    self.rgb_sum = reduce(self.rgb_sum, rgb)
+    self.count = np.bincount(inverse, weights, minlength=len(self.keys))
+
+  def points(self):
+    """[V, 3] mean positions and [V, 3] uint8 mean colors of the voxels."""
+    count = self.count[:, None]
+    rgb = np.clip(np.round(self.rgb_sum / count), 0, 255).astype(np.uint8)
+    return self.xyz_sum / count, rgb
+
+
+def frame_points(
+    output,
+    chunk_frames=8,
+    frame_stride=1,
+    pixel_stride=1,
+    min_depth=0.0,
+    max_depth=np.inf,
+    motion_prob=None,
+    motion_thresh=0.5,
+):
+  """Yields the world points and colors of chunks of frames.
+
+  Args:
+    output: load_output view with images, depths, intrinsic and cam_c2w.
+    chunk_frames: frames back-projected at a time.
+    frame_stride: use every frame_stride-th frame.
+    pixel_stride: use every pixel_stride-th pixel in each direction.
+    min_depth: pixels with depth <= min_depth are dropped.
+    max_depth: pixels with depth >= max_depth are dropped.
+    motion_prob: optional [N, h, w] motion probability of the tracker;
+      pixels above motion_thresh are dropped.
+    motion_thresh: motion probability above which a pixel is dynamic.
+
+  Yields:
+    [P, 3] float32 world points and [P, 3] uint8 RGB colors.
+  """
+  depths = output["depths"]
+  images = output["images"]
+  cam_c2w = np.asarray(output["cam_c2w"], dtype=np.float32)
+  num_frames, height, width = depths.shape
+  rays = pixel_rays(output["intrinsic"], height, width, pixel_stride)
+  frames = np.arange(0, num_frames, frame_stride)
+  if motion_prob is not None and len(motion_prob) != num_frames:
+    raise ValueError(
+        "motion_prob has %d frames, the output %d."
+        % (len(motion_prob), num_frames)
+    )
+
+  for k in range(0, len(frames), chunk_frames):
+    chunk = frames[k : k + chunk_frames]
+    s = slice(None, None, pixel_stride)
+    depth = np.float32(depths[chunk][:, s, s]).reshape(len(chunk), -1)
+    image = np.asarray(images[chunk])
+    if image.shape[1:3] != (height, width):
+      image = np.stack([cv2.resize(im, (width, height)) for im in image])
+    rgb = image[:, s, s].reshape(len(chunk), -1, 3)
+
+    valid = np.isfinite(depth) & (depth > min_depth) & (depth < max_depth)
+    if motion_prob is not None:
+      prob = np.stack([
+          cv2.resize(np.float32(motion_prob[i]), (width, height))[s, s]
+          for i in chunk
+      ])
+      valid &= prob.reshape(len(chunk), -1) <= motion_thresh
+
+    # [B, P, 3] camera points to world space
+    points = rays[None] * depth[..., None]
+    rot = cam_c2w[chunk, :3, :3]
+    trans = cam_c2w[chunk, None, :3, 3]
+    points = np.einsum("bij,bpj->bpi", rot, points) + trans
+    yield points[valid], rgb[valid]
+
+
+def export_pointcloud(output_path, ply_path, voxel_size=0.0, **kwargs):
+  """Writes the fused point cloud of a CVD output as binary PLY.
+
+  Args:
+    output_path: CVD output, e.g. outputs_cvd/<scene>_sgd_cvd_hr(.npz).
+    ply_path: output .ply path.
+    voxel_size: voxel edge in world units; 0 writes every valid pixel.
+    **kwargs: arguments of frame_points.
+
+  Returns:
+    number of points written.
+  """
+  output = load_output(output_path)
+  if voxel_size > 0:
+    grid = VoxelGrid(voxel_size)
+    for xyz, rgb in frame_points(output, **kwargs):
+      grid.add(xyz, rgb)
+    if grid.dropped:
+      print("%d points outside the voxel grid dropped" % grid.dropped)
+    write_ply(ply_path, *grid.points())
+    return len(grid)
+
+  # without merging, the points of all frames are never held at once: they
+  # are written chunk by chunk after a padded header, whose vertex count is
+  # patched in place at the end
+  num_points = 0
+  with open(ply_path, "wb") as f:
+    f.write(ply_header(0, padded=True))
+    for xyz, rgb in frame_points(output, **kwargs):
+      to_vertices(xyz, rgb).tofile(f)
+      num_points += len(xyz)
+    f.seek(0)
+    f.write(ply_header(num_points, padded=True))
+  return num_points
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("output_path", help="CVD output (lean dir or .npz)")
+  parser.add_argument("ply_path")
+  parser.add_argument("--voxel_size", type=float, default=0.0)
+  parser.add_argument("--chunk_frames", type=int, default=8)
+  parser.add_argument("--frame_stride", type=int, default=1)
+  parser.add_argument("--pixel_stride", type=int, default=1)
+  parser.add_argument("--min_depth", type=float, default=0.0)
+  parser.add_argument("--max_depth", type=float, default=np.inf)
+  parser.add_argument(
+      "--motion_prob",
+      type=str,
+      default="",
+      help="reconstructions/<scene>/motion_prob.npy",
+  )
+  parser.add_argument("--motion_thresh", type=float, default=0.5)
+  args = parser.parse_args()
+
+  count = export_pointcloud(
+      args.output_path,
+      args.ply_path,
+      args.voxel_size,
+      chunk_frames=args.chunk_frames,
+      frame_stride=args.frame_stride,
+      pixel_stride=args.pixel_stride,
+      min_depth=args.min_depth,
+      max_depth=args.max_depth,
+      motion_prob=(
+          np.load(args.motion_prob, mmap_mode="r")
+          if args.motion_prob
+          else None
+      ),
+      motion_thresh=args.motion_thresh,
+  )
+  print("%d points written to %s" % (count, args.ply_path))
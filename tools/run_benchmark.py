@@ -0,0 +1,254 @@
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Parallel benchmark evaluation with structured results.
+
+Runs the pose and depth evaluators of a dataset over all scenes in a process
+pool and writes per-scene and mean metrics to <out_dir>/<dataset>_<task>.json
+and .csv. Every scene result is cached together with a key of everything it
+was computed from: a fingerprint (path, size, mtime) of the outputs, the GT
+store key of the GT sources and the evaluator parameters and code, so a rerun
+only evaluates the scenes whose inputs changed. The workers read the
+preprocessed GT from the memory-mapped GT store (evaluations_depth/gt_store.py),
+which is built on first use. Run from the repository root:
+
+  python tools/run_benchmark.py sintel --workers 8
+"""
+
+# pylint: disable=g-import-not-at-top
+
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import importlib
+import json
+import os
+import sys
+
+sys.path.append("cvd_opt")
+sys.path.append("evaluations_poses")
+sys.path.append("evaluations_depth")
+import gt_store
+
+# task -> dataset -> (evaluator module, default GT root, default outputs)
+TASKS = {
+    "poses": {
+        "sintel": ("evaluate_sintel", "Sintel", "reconstructions"),
+        "dycheck": ("evaluate_dycheck", "dycheck", "reconstructions"),
+    },
+    "depth": {
+        "sintel": (
+            "evaluate_depth_ours_sintel",
+            "Sintel",
+            "outputs_cvd_sintel",
+        ),
+        "dycheck": (
+            "evaluate_depth_ours_dycheck",
+            "dycheck",
+            "outputs_cvd_dycheck",
+        ),
+    },
+}
+# code the evaluators depend on; a change invalidates the cached results
+EVALUATOR_CODE = [
+    "evaluations_poses",
+    "evaluations_depth",
+    "UniDepth/unidepth/utils/depth_metrics.py",
+    "camera_tracking_scripts/colmap_read_model.py",
+    "cvd_opt/lean_output.py",
+]
+
+
+def fingerprint(paths):
+  """(path, size, mtime) of the existing files under paths."""
+  entries = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, _, files in os.walk(path):
+        entries += [os.path.join(root, f) for f in files]
+    elif os.path.isfile(path):
+      entries.append(path)
+  result = []
+  for entry in sorted(entries):
+    stat = os.stat(entry)
+    result.append([os.path.abspath(entry), stat.st_size, stat.st_mtime_ns])
+  return result
+
+
+def code_hash(paths):
+  """SHA-1 of the contents of the .py files under paths."""
+  files = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, _, names in os.walk(path):
+        files += [os.path.join(root, n) for n in names if n.endswith(".py")]
+    elif os.path.isfile(path):
+      files.append(path)
+  sha1 = hashlib.sha1()
+  for path in sorted(files):
+    with open(path, "rb") as f:
+      sha1.update(path.encode() + b"\0" + f.read())
+  return sha1.hexdigest()
+
+
+def evaluator_params(module):
+  """Parameters and code hash of an evaluator module."""
+  params = {"gt": module.GT_PARAMS, "code": code_hash(EVALUATOR_CODE)}
+  if hasattr(module, "EPS"):
+    params["eps"] = module.EPS
+  return params
+
+
+def _evaluate(module_name, scene_name, gt_root_dir, pred_root_dir, gt_cache):
+  module = importlib.import_module(module_name)
+  return module.evaluate_scene(
+      scene_name, gt_root_dir, pred_root_dir, gt_cache
+  )
+
+
+def run_task(
+    task,
+    dataset,
+    gt_root_dir,
+    pred_root_dir,
+    out_dir,
+    pool,
+    gt_cache_dir="gt_cache",
+    force=False,
+):
+  """Evaluates all scenes of a task and writes its JSON and CSV results.
+
+  Args:
+    task: "poses" or "depth".
+    dataset: "sintel" or "dycheck".
+    gt_root_dir: dataset root with the ground truth.
+    pred_root_dir: reconstructions or CVD output directory.
+    out_dir: results directory.
+    pool: executor the scenes are evaluated in.
+    gt_cache_dir: store of the preprocessed GT, shared by the workers.
+    force: re-evaluate scenes whose cached result is up to date.
+
+  Returns:
+    dict with the per-scene metrics ("scenes"), their mean ("mean") and the
+    scenes that failed ("errors").
+  """
+  module_name = TASKS[task][dataset][0]
+  module = importlib.import_module(module_name)
+  name = "%s_%s" % (dataset, task)
+  cache_dir = os.path.join(out_dir, name)
+  os.makedirs(cache_dir, exist_ok=True)
+
+  params = evaluator_params(module)
+  scenes = {}
+  errors = {}
+  futures = {}
+  for scene_name in module.SCENE_NAMES:
+    try:
+      gt_key = gt_store.store_key(
+          module.gt_sources(gt_root_dir, scene_name), **module.GT_PARAMS
+      )
+    except OSError as e:
+      errors[scene_name] = repr(e)
+      print("%s %s failed: %r" % (name, scene_name, e))
+      continue
+    key = {
+        "gt": gt_key,
+        "params": params,
+        "outputs": fingerprint(
+            module.prediction_paths(scene_name, pred_root_dir)
+        ),
+    }
+    cache_path = os.path.join(cache_dir, scene_name + ".json")
+    if not force and os.path.isfile(cache_path):
+      with open(cache_path) as f:
+        cached = json.load(f)
+      if cached["key"] == key:
+        scenes[scene_name] = cached["metrics"]
+        continue
+    future = pool.submit(
+        _evaluate,
+        module_name,
+        scene_name,
+        gt_root_dir,
+        pred_root_dir,
+        gt_cache_dir,
+    )
+    futures[future] = (scene_name, key, cache_path)
+
+  print("%s: %d cached, %d to evaluate" % (name, len(scenes), len(futures)))
+  for future in concurrent.futures.as_completed(futures):
+    scene_name, key, cache_path = futures[future]
+    try:
+      metrics = future.result()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      errors[scene_name] = repr(e)
+      print("%s %s failed: %r" % (name, scene_name, e))
+      continue
+    scenes[scene_name] = metrics
+    with open(cache_path, "w") as f:
+      json.dump({"key": key, "metrics": metrics}, f, indent=2)
+    print("%s %s %s" % (name, scene_name, metrics))
+
+  scenes = {s: scenes[s] for s in module.SCENE_NAMES if s in scenes}
+  columns = sorted({k for metrics in scenes.values() for k in metrics})
+  mean = {}
+  for column in columns:
+    values = [m[column] for m in scenes.values() if column in m]
+    mean[column] = sum(values) / len(values)
+  summary = {"scenes": scenes, "mean": mean, "errors": errors}
+
+  with open(os.path.join(out_dir, name + ".json"), "w") as f:
+    json.dump(summary, f, indent=2)
+  with open(os.path.join(out_dir, name + ".csv"), "w", newline="") as f:
+    writer = csv.DictWriter(f, fieldnames=["scene"] + columns)
+    writer.writeheader()
+    for scene_name, metrics in scenes.items():
+      writer.writerow(dict(metrics, scene=scene_name))
+    writer.writerow(dict(mean, scene="mean"))
+  return summary
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("dataset", choices=["sintel", "dycheck"])
+  parser.add_argument(
+      "--tasks", nargs="+", choices=list(TASKS), default=list(TASKS)
+  )
+  parser.add_argument("--gt_root_dir", type=str, default="")
+  parser.add_argument("--recon_dir", type=str, default="")
+  parser.add_argument("--cvd_dir", type=str, default="")
+  parser.add_argument("--out_dir", type=str, default="benchmark_results")
+  parser.add_argument("--gt_cache_dir", type=str, default="gt_cache")
+  parser.add_argument("--workers", type=int, default=os.cpu_count())
+  parser.add_argument("--force", action="store_true")
+  args = parser.parse_args()
+
+  os.makedirs(args.out_dir, exist_ok=True)
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+    for task_name in args.tasks:
+      _, default_gt, default_pred = TASKS[task_name][args.dataset]
+      pred_dir = args.recon_dir if task_name == "poses" else args.cvd_dir
+      result = run_task(
+          task_name,
+          args.dataset,
+          args.gt_root_dir or default_gt,
+          pred_dir or default_pred,
+          args.out_dir,
+          executor,
+          args.gt_cache_dir,
+          args.force,
+      )
+      print("%s %s mean: %s" % (args.dataset, task_name, result["mean"]))
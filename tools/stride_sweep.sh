@@ -0,0 +1,57 @@
+#!/bin/bash
+# Copyright 2025 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+# 帧间隔 (stride) 扫描 - 对每个 k 跟踪并评估 ATE/RPE 与运行时间
+# 使用方法:
+#   bash stride_sweep.sh sintel
+#   STRIDES="1 2 3 4" bash stride_sweep.sh dycheck [--opt_focal]
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+PROJECT_ROOT="$(cd "$SCRIPT_DIR/.." && pwd)"
+
+DATASET=${1:-sintel}
+shift
+EXTRA_ARGS="$@"
+STRIDES=${STRIDES:-"1 2 4"}
+
+case "$DATASET" in
+  sintel|dycheck) ;;
+  *)
+    echo "错误: 只有 sintel 和 dycheck 有真值位姿: $DATASET"
+    echo "用法: $0 [sintel|dycheck] [--opt_focal]"
+    exit 1
+    ;;
+esac
+
+mkdir -p stride_sweep
+for k in $STRIDES; do
+  echo "========================================"
+  echo "stride = $k"
+  echo "========================================"
+  bash "$SCRIPT_DIR/evaluate.sh" "$DATASET" --stride $k $EXTRA_ARGS
+  python "$PROJECT_ROOT/evaluations_poses/evaluate_$DATASET.py" \
+    | tee "stride_sweep/${DATASET}_stride_$k.txt"
+done
+
+# 汇总: 每个 k 的平均 ATE/RTE/RRE 与跟踪时间
+echo ""
+echo "========================================"
+echo "汇总: $DATASET"
+echo "========================================"
+for k in $STRIDES; do
+  echo "stride = $k"
+  grep -E "^Average|^Tracking" "stride_sweep/${DATASET}_stride_$k.txt"
+done
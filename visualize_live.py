@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 实时可视化 MegaSaM 运行过程
-监控重建目录并实时显示最新结果
+跟随跟踪进程发布的帧 (reconstructions/<scene>/live.npy) 实时显示最新结果
 """
 
 import os
@@ -15,6 +15,9 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 from matplotlib import cm
 
+sys.path.append("camera_tracking_scripts")
+from recon_writer import LiveReader
+
 
 def colorize_depth(depth, vmin=None, vmax=None):
     """将深度图转换为彩色可视化图像"""
@@ -33,87 +36,93 @@ def colorize_depth(depth, vmin=None, vmax=None):
     return colored_8bit
 
 
-def watch_reconstruction(scene_name, recon_dir, refresh_interval=2):
-    """监控重建目录并实时显示"""
+def render_panel(image, disp):
+    """图像 (BGR) 与彩色深度并排拼接"""
+    if image.shape[0] == 3:  # CHW格式
+        img_bgr = image.transpose(1, 2, 0)
+    else:
+        img_bgr = image
+    img_bgr = np.ascontiguousarray(img_bgr, dtype=np.uint8)
+
+    # 深度
+    depth = 1.0 / (np.float32(disp) + 1e-8)
+    depth_bgr = cv2.cvtColor(colorize_depth(depth), cv2.COLOR_RGB2BGR)
+
+    # 调整大小使其一致
+    h, w = img_bgr.shape[:2]
+    depth_bgr = cv2.resize(depth_bgr, (w, h))
+    return np.hstack([img_bgr, depth_bgr])
+
+
+def watch_reconstruction(scene_name, recon_dir, refresh_interval=2, poll_ms=5):
+    """跟随跟踪阶段发布的帧实时显示
+
+    跟踪进程 (ReconstructionWriter) 每写完一帧就更新内存映射的 live.npy
+    帧计数; 这里每 poll_ms 毫秒读一次映射中的计数, 不产生文件 I/O,
+    新帧在一帧的延迟内显示。只有每 refresh_interval 秒才 stat 一次
+    live.npy, 以发现新开始的运行。
+    """
     print(f"\n{'='*60}")
     print(f"实时监控重建过程: {scene_name}")
     print(f"{'='*60}")
     print(f"监控目录: {recon_dir}/{scene_name}")
-    print(f"刷新间隔: {refresh_interval} 秒")
-    print(f"按 Ctrl+C 退出")
+    print(f"按 Ctrl+C 或 q 退出")
     print(f"{'='*60}\n")
-    
-    recon_path = Path(recon_dir) / scene_name
-    
+
+    reader = LiveReader(str(Path(recon_dir) / scene_name))
+    window = f'MegaSaM - {scene_name}'
     last_frame_count = 0
-    
+    last_reconnect = 0.0
+    waiting = False
+
     try:
         while True:
-            # 检查文件是否存在
-            images_file = recon_path / "images.npy"
-            disps_file = recon_path / "disps.npy"
-            
-            if images_file.exists() and disps_file.exists():
-                try:
-                    # 加载数据
-                    images = np.load(images_file, mmap_mode='r')
-                    disps = np.load(disps_file, mmap_mode='r')
-                    
-                    current_frame_count = len(images)
-                    
-                    if current_frame_count > last_frame_count:
-                        print(f"[{time.strftime('%H:%M:%S')}] 检测到新帧: {current_frame_count} 帧")
-                        last_frame_count = current_frame_count
-                        
-                        # 显示最新一帧
-                        idx = current_frame_count - 1
-                        
-                        # 图像
-                        if images[idx].shape[0] == 3:  # CHW格式
-                            img = images[idx].transpose(1, 2, 0)
-                        else:
-                            img = images[idx]
-                        
-                        # 深度
-                        depth = 1.0 / (disps[idx] + 1e-8)
-                        depth_colored = colorize_depth(depth)
-                        
-                        # 并排显示
-                        img_bgr = cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2BGR)
-                        depth_bgr = cv2.cvtColor(depth_colored, cv2.COLOR_RGB2BGR)
-                        
-                        # 调整大小使其一致
-                        h, w = img_bgr.shape[:2]
-                        depth_bgr = cv2.resize(depth_bgr, (w, h))
-                        
-                        # 拼接
-                        combined = np.hstack([img_bgr, depth_bgr])
-                        
-                        # 添加文本
-                        cv2.putText(combined, f"Frame {idx}/{current_frame_count}", 
-                                  (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                        cv2.putText(combined, "Image", (10, h-10), 
-                                  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
-                        cv2.putText(combined, "Depth", (w+10, h-10), 
-                                  cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
-                        
-                        # 显示
-                        cv2.imshow(f'MegaSaM - {scene_name}', combined)
-                        cv2.waitKey(1)
-                        
-                except Exception as e:
-                    print(f"[{time.strftime('%H:%M:%S')}] 读取错误: {e}")
-            else:
-                print(f"[{time.strftime('%H:%M:%S')}] 等待重建文件...")
-            
-            time.sleep(refresh_interval)
-            
+            now = time.monotonic()
+            if now - last_reconnect >= refresh_interval:
+                last_reconnect = now
+                if reader.reconnect():
+                    print(f"[{time.strftime('%H:%M:%S')}] 连接到运行: "
+                          f"{reader.capacity} 帧")
+                    last_frame_count = 0
+                    waiting = False
+                elif reader.header is None and not waiting:
+                    print(f"[{time.strftime('%H:%M:%S')}] 等待跟踪进程...")
+                    waiting = True
+
+            current_frame_count = reader.count
+            if current_frame_count > last_frame_count:
+                last_frame_count = current_frame_count
+
+                # 只显示最新一帧, 落后时跳过中间帧
+                idx = current_frame_count - 1
+                combined = render_panel(*reader.frame(idx))
+                h, w = combined.shape[0], combined.shape[1] // 2
+
+                # 添加文本
+                cv2.putText(combined, f"Frame {idx}/{reader.capacity}",
+                            (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.putText(combined, "Image", (10, h-10),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+                cv2.putText(combined, "Depth", (w+10, h-10),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+                cv2.imshow(window, combined)
+
+                if reader.closed:
+                    print(f"[{time.strftime('%H:%M:%S')}] 跟踪完成: "
+                          f"{current_frame_count} 帧")
+
+            key = cv2.waitKey(poll_ms) & 0xFF
+            if key == 27 or key == ord('q'):
+                break
+
     except KeyboardInterrupt:
-        print(f"\n\n{'='*60}")
-        print(f"监控停止")
-        print(f"总共处理: {last_frame_count} 帧")
-        print(f"{'='*60}\n")
-        cv2.destroyAllWindows()
+        pass
+
+    print(f"\n\n{'='*60}")
+    print(f"监控停止")
+    print(f"总共处理: {last_frame_count} 帧")
+    print(f"{'='*60}\n")
+    cv2.destroyAllWindows()
 
 
 def show_final_results(scene_name, recon_dir):
@@ -127,8 +136,8 @@ def show_final_results(scene_name, recon_dir):
         return
     
     try:
-        images = np.load(recon_path / "images.npy")
-        disps = np.load(recon_path / "disps.npy")
+        images = np.load(recon_path / "images.npy", mmap_mode='r')
+        disps = np.load(recon_path / "disps.npy", mmap_mode='r')
         poses = np.load(recon_path / "poses.npy")
         
         print(f"  Images: {images.shape}")
@@ -148,23 +157,8 @@ def show_final_results(scene_name, recon_dir):
         playing = False
         
         while True:
-            # 图像
-            if images[current_idx].shape[0] == 3:
-                img = images[current_idx].transpose(1, 2, 0)
-            else:
-                img = images[current_idx]
-            
-            # 深度
-            depth = 1.0 / (disps[current_idx] + 1e-8)
-            depth_colored = colorize_depth(depth)
-            
             # 显示
-            img_bgr = cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2BGR)
-            depth_bgr = cv2.cvtColor(depth_colored, cv2.COLOR_RGB2BGR)
-            
-            h, w = img_bgr.shape[:2]
-            depth_bgr = cv2.resize(depth_bgr, (w, h))
-            combined = np.hstack([img_bgr, depth_bgr])
+            combined = render_panel(images[current_idx], disps[current_idx])
             
             # 添加信息
             info_text = f"Frame {current_idx+1}/{total_frames}"
@@ -204,13 +198,16 @@ def main():
     parser.add_argument('--mode', type=str, default='watch',
                         choices=['watch', 'show'],
                         help='watch: 实时监控, show: 查看最终结果')
-    parser.add_argument('--interval', type=int, default=2,
-                        help='监控刷新间隔(秒)')
+    parser.add_argument('--interval', type=float, default=2,
+                        help='检查是否开始了新一次运行的间隔(秒)')
+    parser.add_argument('--poll_ms', type=int, default=5,
+                        help='读取帧计数的间隔(毫秒)')
     
     args = parser.parse_args()
     
     if args.mode == 'watch':
-        watch_reconstruction(args.scene_name, args.recon_dir, args.interval)
+        watch_reconstruction(args.scene_name, args.recon_dir, args.interval,
+                             args.poll_ms)
     else:
         show_final_results(args.scene_name, args.recon_dir)
 
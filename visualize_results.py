@@ -2,99 +2,241 @@
 # -*- coding: utf-8 -*-
 """
 可视化 MegaSaM 运行结果
+
+深度和光流用查找表 (LUT) 向量化上色, 面板用 numpy 拼接, 帧按批次分发到
+进程池渲染, 再按顺序直接编码为 mp4 视频; matplotlib 只用于相机轨迹图。
 """
 
 import os
 import sys
 import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import cv2
 from pathlib import Path
-import matplotlib.pyplot as plt
-from matplotlib import cm
+
+sys.path.append("cvd_opt")
+from lean_output import load_output
+from core.utils.flow_viz import make_colorwheel
+
+# colormap 名称 -> OpenCV colormap, 以 _r 结尾表示反转
+CV2_COLORMAPS = {
+    'magma': cv2.COLORMAP_MAGMA,
+    'hot': cv2.COLORMAP_HOT,
+    'viridis': cv2.COLORMAP_VIRIDIS,
+    'jet': cv2.COLORMAP_JET,
+}
+_LUTS = {}
+_COLORWHEEL = make_colorwheel() / 255.0
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+COLORBAR_WIDTH = 16
+COLORBAR_TEXT_WIDTH = 72
+
+
+def get_lut(cmap='magma_r'):
+    """colormap 的 256x3 BGR 查找表"""
+    if cmap not in _LUTS:
+        name = cmap[:-2] if cmap.endswith('_r') else cmap
+        ramp = np.arange(256, dtype=np.uint8)[:, None]
+        lut = cv2.applyColorMap(ramp, CV2_COLORMAPS[name])[:, 0]
+        _LUTS[cmap] = np.ascontiguousarray(lut[::-1] if cmap.endswith('_r') else lut)
+    return _LUTS[cmap]
+
+
+def colorize(values, vmin, vmax, cmap='magma_r'):
+    """用查找表将标量图映射为 BGR uint8 图像"""
+    scale = 255.0 / max(vmax - vmin, 1e-8)
+    idx = np.clip((np.float32(values) - vmin) * scale, 0, 255)
+    return get_lut(cmap)[np.nan_to_num(idx).astype(np.uint8)]
 
 
 def colorize_depth(depth, vmin=None, vmax=None, cmap='magma_r'):
-    """将深度图转换为彩色可视化图像"""
+    """将深度图转换为彩色可视化图像 (RGB)"""
     if vmin is None:
-        vmin = depth.min()
+        vmin = float(depth.min())
     if vmax is None:
-        vmax = depth.max()
-    
-    # 归一化
-    depth_normalized = (depth - vmin) / (vmax - vmin + 1e-8)
-    depth_normalized = np.clip(depth_normalized, 0, 1)
-    
-    # 应用colormap
-    cmap_func = cm.get_cmap(cmap)
-    colored = cmap_func(depth_normalized)
-    
-    # 转换为8bit RGB
-    colored_8bit = (colored[:, :, :3] * 255).astype(np.uint8)
-    
-    return colored_8bit
+        vmax = float(depth.max())
+    return colorize(depth, vmin, vmax, cmap)[..., ::-1]
+
+
+def colorize_flow(flow, max_rad=None):
+    """flow_viz 色轮上色的向量化版本, 返回 BGR uint8
+
+    flow: [H, W, 2]; 传入固定的 max_rad 可使整段视频颜色一致
+    (flow_viz.flow_to_image 按每帧最大值归一化)。
+    """
+    u = np.float32(flow[..., 0])
+    v = np.float32(flow[..., 1])
+    rad = np.sqrt(u ** 2 + v ** 2)
+    if max_rad is None:
+        max_rad = float(rad.max())
+    rad = rad / (max_rad + 1e-5)
+
+    ncols = _COLORWHEEL.shape[0]
+    fk = (np.arctan2(-v, -u) / np.pi + 1) / 2 * (ncols - 1)
+    k0 = np.floor(fk).astype(np.int32)
+    k1 = (k0 + 1) % ncols
+    f = (fk - k0)[..., None]
+    col = (1 - f) * _COLORWHEEL[k0] + f * _COLORWHEEL[k1]
+    rad = rad[..., None]
+    col = np.where(rad <= 1, 1 - rad * (1 - col), col * 0.75)
+    return np.floor(255 * col).astype(np.uint8)[..., ::-1]
+
+
+def put_title(panel, text):
+    """在面板左上角写标题 (黑色描边的白字)"""
+    cv2.putText(panel, text, (8, 22), FONT, 0.6, (0, 0, 0), 3, cv2.LINE_AA)
+    cv2.putText(panel, text, (8, 22), FONT, 0.6, (255, 255, 255), 1, cv2.LINE_AA)
+    return panel
+
+
+def colorbar(height, vmin, vmax, cmap='magma_r'):
+    """竖直色条, 右侧标注最大/最小值"""
+    idx = np.linspace(255, 0, height).astype(np.uint8)
+    strip = np.repeat(get_lut(cmap)[idx][:, None], COLORBAR_WIDTH, axis=1)
+    text = np.full((height, COLORBAR_TEXT_WIDTH, 3), 255, dtype=np.uint8)
+    cv2.putText(text, f'{vmax:.3g}', (4, 16), FONT, 0.45, (0, 0, 0), 1, cv2.LINE_AA)
+    cv2.putText(text, f'{vmin:.3g}', (4, height - 6), FONT, 0.45, (0, 0, 0), 1,
+                cv2.LINE_AA)
+    return np.concatenate([strip, text], axis=1)
+
+
+def compose(*panels):
+    """水平拼接等高的面板"""
+    return np.concatenate([np.ascontiguousarray(p) for p in panels], axis=1)
+
+
+def sample_range(values, low=1, high=99, num_samples=16):
+    """从均匀抽样的帧估计整段序列的显示范围"""
+    sample = np.float32(values[::max(1, len(values) // num_samples)])
+    sample = sample[np.isfinite(sample)]
+    return float(np.percentile(sample, low)), float(np.percentile(sample, high))
+
+
+def render_video(output_file, render_fn, num_frames, fps=10, workers=None,
+                 batch_size=16, frames_dir=None, frame_prefix='frame'):
+    """多进程分批渲染帧, 按顺序直接编码为视频
+
+    render_fn(indices) 返回这些帧的 BGR uint8 图像, 必须可以 pickle
+    (模块级函数或其 partial), 并自行按路径打开 (memmap) 数据。
+    同时在途的批次数有上限, 内存占用与序列长度无关。
+    frames_dir 不为空时额外保存每帧的 PNG。
+    """
+    workers = workers or os.cpu_count()
+    batches = [range(s, min(s + batch_size, num_frames))
+               for s in range(0, num_frames, batch_size)]
+    writer = None
+    with ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        next_batch = 0
+        while pending or next_batch < len(batches):
+            while next_batch < len(batches) and len(pending) < 2 * workers:
+                batch = batches[next_batch]
+                pending.append((batch, pool.submit(render_fn, batch)))
+                next_batch += 1
+            batch, future = pending.popleft()
+            for i, frame in zip(batch, future.result()):
+                if writer is None:
+                    h, w = frame.shape[:2]
+                    writer = cv2.VideoWriter(str(output_file),
+                                             cv2.VideoWriter_fourcc(*'mp4v'),
+                                             fps, (w, h))
+                writer.write(frame)
+                if frames_dir is not None:
+                    cv2.imwrite(str(Path(frames_dir) / f"{frame_prefix}_{i:05d}.png"), frame)
+            print(f"  处理进度: {batch[-1] + 1}/{num_frames}")
+    if writer is not None:
+        writer.release()
+    print(f"✓ 视频已保存到: {output_file}")
 
 
-def visualize_depth_sequence(scene_name, depth_dir, output_dir, fps=10):
+def render_depth_files(depth_files, indices):
+    """深度序列帧: 每帧按自身范围上色"""
+    frames = []
+    for i in indices:
+        depth = np.load(depth_files[i])
+        vmin, vmax = float(depth.min()), float(depth.max())
+        frames.append(compose(colorize(depth, vmin, vmax),
+                              colorbar(depth.shape[0], vmin, vmax)))
+    return frames
+
+
+def render_reconstruction_frames(recon_path, vmin, vmax, indices):
+    """重建帧: 图像 | 深度 | 色条 (images.npy 为 BGR)"""
+    images = np.load(os.path.join(recon_path, "images.npy"), mmap_mode='r')
+    disps = np.load(os.path.join(recon_path, "disps.npy"), mmap_mode='r')
+    frames = []
+    for i in indices:
+        if images[i].shape[0] == 3:  # CHW格式
+            img = images[i].transpose(1, 2, 0)
+        else:  # HWC格式
+            img = images[i]
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        depth = colorize(1.0 / (np.float32(disps[i]) + 1e-8), vmin, vmax)
+        frames.append(compose(put_title(img, f'Frame {i}'),
+                              put_title(depth, f'Depth {i}'),
+                              colorbar(img.shape[0], vmin, vmax)))
+    return frames
+
+
+def render_cvd_frames(cvd_path, vmin, vmax, indices):
+    """CVD 帧: 图像 | 深度 | 色条 (load_output 的 images 为 RGB)"""
+    cvd_data = load_output(cvd_path)
+    images, depths = cvd_data["images"], cvd_data["depths"]
+    frames = []
+    for i in indices:
+        img = np.ascontiguousarray(images[i][..., ::-1])
+        frames.append(compose(put_title(img, f'Frame {i}'),
+                              colorize(depths[i], vmin, vmax),
+                              colorbar(img.shape[0], vmin, vmax)))
+    return frames
+
+
+def visualize_depth_sequence(scene_name, depth_dir, output_dir, fps=10,
+                             workers=None, save_frames=False):
     """可视化深度序列"""
     print(f"\n=== 可视化深度序列: {scene_name} ===")
-    
+
     # 查找深度文件
-    depth_files = sorted(list(Path(depth_dir).glob('*.npy')))
-    
+    depth_files = [str(f) for f in sorted(Path(depth_dir).glob('*.npy'))]
+
     if len(depth_files) == 0:
         print(f"错误: 在 {depth_dir} 中没有找到 .npy 文件")
         return
-    
+
     print(f"找到 {len(depth_files)} 个深度图")
-    
+
     # 创建输出目录
     output_path = Path(output_dir) / scene_name
     output_path.mkdir(parents=True, exist_ok=True)
-    
-    # 可视化每一帧
-    for i, depth_file in enumerate(depth_files):
-        depth = np.load(depth_file)
-        
-        # 彩色化
-        colored = colorize_depth(depth)
-        
-        # 保存
-        output_file = output_path / f"depth_{i:05d}.png"
-        cv2.imwrite(str(output_file), cv2.cvtColor(colored, cv2.COLOR_RGB2BGR))
-        
-        if i % 10 == 0:
-            print(f"  处理进度: {i+1}/{len(depth_files)}")
-    
-    print(f"✓ 深度图已保存到: {output_path}")
-    
-    # 创建视频（如果有ffmpeg）
-    try:
-        video_file = output_path / f"{scene_name}_depth.mp4"
-        cmd = f'ffmpeg -y -framerate {fps} -i "{output_path}/depth_%05d.png" -c:v libx264 -pix_fmt yuv420p "{video_file}"'
-        os.system(cmd)
-        print(f"✓ 视频已保存到: {video_file}")
-    except:
-        print("  (未安装ffmpeg，跳过视频生成)")
+
+    render_video(output_path / f"{scene_name}_depth.mp4",
+                 partial(render_depth_files, depth_files), len(depth_files),
+                 fps, workers, frames_dir=output_path if save_frames else None,
+                 frame_prefix='depth')
 
 
-def visualize_reconstruction(scene_name, recon_dir, output_dir):
+def visualize_reconstruction(scene_name, recon_dir, output_dir, fps=10,
+                             workers=None, save_frames=False):
     """可视化重建结果"""
     print(f"\n=== 可视化重建结果: {scene_name} ===")
-    
+
     recon_path = Path(recon_dir) / scene_name
-    
+
     if not recon_path.exists():
         print(f"错误: 重建目录不存在: {recon_path}")
         return
-    
-    # 加载数据
+
+    # 加载数据 (图像和视差只做 memmap, 由渲染进程按帧读取)
     try:
-        images = np.load(recon_path / "images.npy")
-        disps = np.load(recon_path / "disps.npy")
+        images = np.load(recon_path / "images.npy", mmap_mode='r')
+        disps = np.load(recon_path / "disps.npy", mmap_mode='r')
         poses = np.load(recon_path / "poses.npy")
         intrinsics = np.load(recon_path / "intrinsics.npy")
-        
+
         print(f"  Images shape: {images.shape}")
         print(f"  Disps shape: {disps.shape}")
         print(f"  Poses shape: {poses.shape}")
@@ -102,49 +244,55 @@ def visualize_reconstruction(scene_name, recon_dir, output_dir):
     except Exception as e:
         print(f"错误: 无法加载重建数据: {e}")
         return
-    
+
     # 创建输出目录
     output_path = Path(output_dir) / scene_name
     output_path.mkdir(parents=True, exist_ok=True)
-    
-    # 可视化图像和深度
+
+    # 整个序列使用统一的深度范围
     num_frames = min(len(images), len(disps))
-    
-    for i in range(num_frames):
-        fig, axes = plt.subplots(1, 2, figsize=(12, 4))
-        
-        # 原始图像
-        if images[i].shape[0] == 3:  # CHW格式
-            img = images[i].transpose(1, 2, 0)
-        else:  # HWC格式
-            img = images[i]
-        
-        axes[0].imshow(img)
-        axes[0].set_title(f'Frame {i}')
-        axes[0].axis('off')
-        
-        # 深度图
-        depth = 1.0 / (disps[i] + 1e-8)
-        im = axes[1].imshow(depth, cmap='magma_r')
-        axes[1].set_title(f'Depth {i}')
-        axes[1].axis('off')
-        plt.colorbar(im, ax=axes[1])
-        
-        plt.tight_layout()
-        plt.savefig(output_path / f"frame_{i:05d}.png", dpi=100, bbox_inches='tight')
-        plt.close()
-        
-        if i % 10 == 0:
-            print(f"  处理进度: {i+1}/{num_frames}")
-    
-    print(f"✓ 重建可视化已保存到: {output_path}")
-    
+    vmin, vmax = sample_range(1.0 / (np.float32(disps[:num_frames]) + 1e-8))
+    render_video(output_path / f"{scene_name}_reconstruction.mp4",
+                 partial(render_reconstruction_frames, str(recon_path), vmin, vmax),
+                 num_frames, fps, workers,
+                 frames_dir=output_path if save_frames else None)
+
     # 可视化相机轨迹
     visualize_trajectory(poses, output_path / "trajectory.png")
 
 
+def visualize_cvd_output(scene_name, cvd_dir, output_dir, fps=10,
+                         workers=None, save_frames=False):
+    """可视化 CVD 优化结果 (lean 目录或 npz 均可)"""
+    print(f"\n=== 可视化 CVD 结果: {scene_name} ===")
+
+    cvd_path = os.path.join(cvd_dir, f"{scene_name}_sgd_cvd_hr")
+    try:
+        cvd_data = load_output(cvd_path)
+    except FileNotFoundError as e:
+        print(f"错误: {e}")
+        return
+
+    images = cvd_data["images"]
+    depths = cvd_data["depths"]
+    print(f"  Images shape: {images.shape}")
+    print(f"  Depths shape: {depths.shape}")
+
+    output_path = Path(output_dir) / scene_name / "cvd"
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # 整个序列使用统一的深度范围
+    vmin, vmax = sample_range(depths)
+    render_video(output_path / f"{scene_name}_cvd.mp4",
+                 partial(render_cvd_frames, cvd_path, vmin, vmax), len(depths),
+                 fps, workers, frames_dir=output_path if save_frames else None,
+                 frame_prefix='cvd')
+
+
 def visualize_trajectory(poses, output_file):
-    """可视化相机轨迹"""
+    """可视化相机轨迹 (唯一使用 matplotlib 的图)"""
+    import matplotlib.pyplot as plt
+
     print(f"\n  生成相机轨迹图...")
     
     # 提取位置
@@ -210,65 +358,64 @@ def visualize_trajectory(poses, output_file):
     print(f"  ✓ 轨迹图已保存到: {output_file}")
 
 
-def visualize_flow(scene_name, cache_flow_dir, output_dir):
+def render_flow_frames(flow_path, max_rad, indices):
+    """光流帧: 色轮光流 | 幅度 + mask 轮廓 | 色条"""
+    flows = np.load(os.path.join(flow_path, "flows.npy"), mmap_mode='r')
+    flow_masks = np.load(os.path.join(flow_path, "flows_masks.npy"), mmap_mode='r')
+    iijj = np.load(os.path.join(flow_path, "ii-jj.npy"), mmap_mode='r')
+    frames = []
+    for i in indices:
+        flow = np.float32(flows[i]).transpose(1, 2, 0)  # C,H,W -> H,W,C
+        mask = np.uint8(flow_masks[i, 0] > 0.5)
+
+        # 计算光流幅度
+        flow_mag = np.sqrt(flow[:, :, 0]**2 + flow[:, :, 1]**2)
+        mag = colorize(flow_mag, 0.0, max_rad, 'hot')
+        contours, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        cv2.drawContours(mag, contours, -1, (255, 255, 0), 2)
+
+        frames.append(compose(
+            put_title(colorize_flow(flow, max_rad),
+                      f'Flow (frame {iijj[0, i]} -> {iijj[1, i]})'),
+            put_title(mag, 'Flow Magnitude + Mask'),
+            colorbar(flow.shape[0], 0.0, max_rad, 'hot')))
+    return frames
+
+
+def visualize_flow(scene_name, cache_flow_dir, output_dir, fps=10,
+                   workers=None, save_frames=False):
     """可视化光流"""
     print(f"\n=== 可视化光流: {scene_name} ===")
-    
+
     flow_path = Path(cache_flow_dir) / scene_name
-    
+
     if not flow_path.exists():
         print(f"错误: 光流目录不存在: {flow_path}")
         return
-    
+
     try:
-        flows = np.load(flow_path / "flows.npy")
-        flow_masks = np.load(flow_path / "flows_masks.npy")
+        flows = np.load(flow_path / "flows.npy", mmap_mode='r')
+        flow_masks = np.load(flow_path / "flows_masks.npy", mmap_mode='r')
         iijj = np.load(flow_path / "ii-jj.npy")
-        
+
         print(f"  Flows shape: {flows.shape}")
         print(f"  Flow masks shape: {flow_masks.shape}")
         print(f"  ii-jj shape: {iijj.shape}")
-        
+
         # 创建输出目录
         output_path = Path(output_dir) / scene_name / "flows"
         output_path.mkdir(parents=True, exist_ok=True)
-        
-        # 可视化部分光流
-        num_vis = min(20, flows.shape[0])
-        for i in range(num_vis):
-            flow = flows[i].transpose(1, 2, 0)  # C,H,W -> H,W,C
-            mask = flow_masks[i, 0]
-            
-            # 计算光流幅度
-            flow_mag = np.sqrt(flow[:, :, 0]**2 + flow[:, :, 1]**2)
-            
-            fig, axes = plt.subplots(1, 3, figsize=(15, 4))
-            
-            # 光流X分量
-            im0 = axes[0].imshow(flow[:, :, 0], cmap='RdBu')
-            axes[0].set_title(f'Flow X (frame {iijj[0, i]} -> {iijj[1, i]})')
-            axes[0].axis('off')
-            plt.colorbar(im0, ax=axes[0])
-            
-            # 光流Y分量
-            im1 = axes[1].imshow(flow[:, :, 1], cmap='RdBu')
-            axes[1].set_title(f'Flow Y')
-            axes[1].axis('off')
-            plt.colorbar(im1, ax=axes[1])
-            
-            # 光流幅度 + mask
-            im2 = axes[2].imshow(flow_mag, cmap='hot')
-            axes[2].contour(mask, levels=[0.5], colors='cyan', linewidths=2)
-            axes[2].set_title(f'Flow Magnitude + Mask')
-            axes[2].axis('off')
-            plt.colorbar(im2, ax=axes[2])
-            
-            plt.tight_layout()
-            plt.savefig(output_path / f"flow_{i:03d}.png", dpi=100, bbox_inches='tight')
-            plt.close()
-        
-        print(f"✓ 光流可视化已保存到: {output_path}")
-        
+
+        # 整个序列使用统一的幅度范围, 颜色在帧间可比
+        flow_mag = np.linalg.norm(
+            np.float32(flows[::max(1, len(flows) // 16)]), axis=1)
+        max_rad = max(float(np.percentile(flow_mag, 99)), 1e-3)
+        render_video(output_path / f"{scene_name}_flow.mp4",
+                     partial(render_flow_frames, str(flow_path), max_rad),
+                     len(flows), fps, workers,
+                     frames_dir=output_path if save_frames else None,
+                     frame_prefix='flow')
+
     except Exception as e:
         print(f"错误: 无法加载光流数据: {e}")
 
@@ -282,42 +429,59 @@ def main():
                         help='重建结果目录')
     parser.add_argument('--flow_dir', type=str, default='cache_flow',
                         help='光流缓存目录')
+    parser.add_argument('--cvd_dir', type=str, default='outputs_cvd',
+                        help='CVD 输出目录')
     parser.add_argument('--output_dir', type=str, default='visualizations',
                         help='输出目录')
     parser.add_argument('--mode', type=str, default='all',
-                        choices=['all', 'depth', 'reconstruction', 'flow'],
+                        choices=['all', 'depth', 'reconstruction', 'flow', 'cvd'],
                         help='可视化模式')
     parser.add_argument('--fps', type=int, default=10, help='视频帧率')
-    
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='渲染进程数')
+    parser.add_argument('--save_frames', action='store_true',
+                        help='除视频外另存每帧 PNG')
+
     args = parser.parse_args()
-    
+    render_args = dict(fps=args.fps, workers=args.workers,
+                       save_frames=args.save_frames)
+
     print(f"\n{'='*60}")
     print(f"MegaSaM 结果可视化工具")
     print(f"{'='*60}")
     print(f"场景: {args.scene_name}")
     print(f"模式: {args.mode}")
-    
+
     # 根据模式进行可视化
     if args.mode in ['all', 'depth']:
         depth_scene_dir = os.path.join(args.depth_dir, args.scene_name)
         if os.path.exists(depth_scene_dir):
-            visualize_depth_sequence(args.scene_name, depth_scene_dir, 
-                                    args.output_dir, args.fps)
+            visualize_depth_sequence(args.scene_name, depth_scene_dir,
+                                     args.output_dir, **render_args)
         else:
             print(f"\n警告: 深度目录不存在: {depth_scene_dir}")
-    
+
     if args.mode in ['all', 'reconstruction']:
         if os.path.exists(args.recon_dir):
-            visualize_reconstruction(args.scene_name, args.recon_dir, args.output_dir)
+            visualize_reconstruction(args.scene_name, args.recon_dir, args.output_dir,
+                                     **render_args)
         else:
             print(f"\n警告: 重建目录不存在: {args.recon_dir}")
-    
+
     if args.mode in ['all', 'flow']:
         if os.path.exists(args.flow_dir):
-            visualize_flow(args.scene_name, args.flow_dir, args.output_dir)
+            visualize_flow(args.scene_name, args.flow_dir, args.output_dir,
+                           **render_args)
         else:
             print(f"\n警告: 光流目录不存在: {args.flow_dir}")
-    
+
+    if args.mode in ['all', 'cvd']:
+        if os.path.exists(args.cvd_dir):
+            visualize_cvd_output(args.scene_name, args.cvd_dir, args.output_dir,
+                                 **render_args)
+        else:
+            print(f"\n警告: CVD 输出目录不存在: {args.cvd_dir}")
+
     print(f"\n{'='*60}")
     print(f"✓ 可视化完成！")
     print(f"{'='*60}\n")